@@ -0,0 +1,261 @@
+# Admission control for LLM generations
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    """ A generation was not admitted, carries the HTTP status and a Retry-After hint """
+
+    def __init__(self, message: str, status_code: int, retry_after: int):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class _ModelGate:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.waiting = 0
+        # batch generations, part of active and never counted in waiting
+        self.batch_active = 0
+        self.batch_waiting = 0
+        self.condition = threading.Condition()
+        # moving average of generation time, used for Retry-After
+        self.average_seconds: Optional[float] = None
+
+
+class AdmissionController:
+    """
+    Cap concurrent generations per model and bound the queue in front of them
+
+    Only generations go through the controller, cache hits never wait for a
+    slot. A request that finds the queue of its model full is rejected at
+    once (429); one that waits longer than the queue timeout gives up (503).
+    Both carry a Retry-After estimated from recent generation times, and
+    only limit + max_queue request threads can ever be tied up per model.
+    Limits are per process.
+
+    Batch generations never take the last free slot of a model with more
+    than one, and only start while no interactive generation is waiting, so
+    a batch job cannot starve interactive queries even with a single slot.
+
+    With an activity cache, a model with running or waiting generations is
+    also marked busy in that Django cache, refreshed every heartbeat_seconds,
+    so is_idle sees the generations of every process sharing the cache.
+    """
+
+    def __init__(
+        self,
+        limits: Dict[str, int],
+        default_limit: int = 2,
+        max_queue: int = 8,
+        queue_timeout: float = 30,
+        activity_cache: Optional[str] = None,
+        heartbeat_seconds: float = 1.0,
+    ):
+        self.limits = limits
+        self.default_limit = default_limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.activity_cache = activity_cache
+        self.heartbeat_seconds = heartbeat_seconds
+        self._gates: Dict[str, _ModelGate] = {}
+        self._lock = threading.Lock()
+        self._heartbeat = None
+        # model -> (checked at, busy) of the last activity cache lookup
+        self._busy_elsewhere: Dict[str, tuple] = {}
+
+    def _gate(self, model: str) -> _ModelGate:
+        with self._lock:
+            if model not in self._gates:
+                self._gates[model] = _ModelGate(self.limits.get(model, self.default_limit))
+            return self._gates[model]
+
+    def _retry_after(self, gate: _ModelGate) -> int:
+        """ Seconds until the queued generations should have drained """
+        per_generation = gate.average_seconds or 10.0
+        return max(1, math.ceil(per_generation * (gate.waiting + 1) / gate.limit))
+
+    def _batch_may_start(self, gate: _ModelGate) -> bool:
+        """ Whether a batch generation can take a slot without holding back interactive ones """
+        return (
+            gate.active < gate.limit
+            and gate.waiting == 0
+            and gate.batch_active < max(1, gate.limit - 1)
+        )
+
+    @contextmanager
+    def admit(self, model: str, enforce_queue: bool = True, batch: bool = False):
+        """
+        Hold a generation slot of a model for the duration of the block
+
+        Args:
+            model: LLM model name
+            enforce_queue: Reject when the queue is full or the wait times out,
+                background work such as summaries passes False and simply waits its turn
+            batch: Batch generation, waits without limit behind interactive
+                generations and leaves them a slot
+
+        Raises:
+            AdmissionRejected: queue full (429) or queue timeout (503)
+        """
+        gate = self._gate(model)
+        self._mark_busy(model)
+        with gate.condition:
+            if batch:
+                gate.batch_waiting += 1
+                try:
+                    while not self._batch_may_start(gate):
+                        gate.condition.wait()
+                finally:
+                    gate.batch_waiting -= 1
+                gate.batch_active += 1
+            elif gate.active >= gate.limit:
+                if enforce_queue and gate.waiting >= self.max_queue:
+                    raise AdmissionRejected(
+                        f"Too many queued generations for {model}", 429, self._retry_after(gate)
+                    )
+                gate.waiting += 1
+                try:
+                    give_up_at = time.monotonic() + self.queue_timeout
+                    while gate.active >= gate.limit:
+                        remaining = give_up_at - time.monotonic() if enforce_queue else None
+                        if remaining is not None and remaining <= 0:
+                            raise AdmissionRejected(
+                                f"Timed out waiting for a {model} generation slot", 503, self._retry_after(gate)
+                            )
+                        gate.condition.wait(remaining)
+                finally:
+                    gate.waiting -= 1
+                    # batch generations held back by this one may start now
+                    gate.condition.notify_all()
+            gate.active += 1
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            with gate.condition:
+                gate.active -= 1
+                if batch:
+                    gate.batch_active -= 1
+                if gate.average_seconds is None:
+                    gate.average_seconds = elapsed
+                else:
+                    gate.average_seconds = 0.8 * gate.average_seconds + 0.2 * elapsed
+                # waiting batch and interactive generations are admitted on different conditions
+                gate.condition.notify_all()
+
+    def limit(self, model: str) -> int:
+        """ Concurrent generations allowed for a model """
+        return self._gate(model).limit
+
+    def is_idle(self, model: str) -> bool:
+        """ True when no generation of the model is running or waiting, in this process or any sharing the activity cache """
+        with self._lock:
+            gate = self._gates.get(model)
+        if gate is not None and (gate.active or gate.waiting or gate.batch_waiting):
+            return False
+        return not self._is_busy_elsewhere(model)
+
+    def _activity_key(self, model: str) -> str:
+        return f"raglite:generating:{model}"
+
+    def _mark_busy(self, model: str) -> None:
+        """ Mark the model busy in the activity cache and keep it marked while it has generations """
+        if self.activity_cache is None:
+            return
+        try:
+            caches[self.activity_cache].set(self._activity_key(model), time.time(), timeout=3 * self.heartbeat_seconds)
+        except Exception as e:
+            logger.error(f"Publishing generation activity of {model} failed: {str(e)}")
+        if self._heartbeat is None or not self._heartbeat.is_alive():
+            with self._lock:
+                if self._heartbeat is None or not self._heartbeat.is_alive():
+                    self._heartbeat = threading.Thread(target=self._run_heartbeat, name='generation-heartbeat', daemon=True)
+                    self._heartbeat.start()
+
+    def _run_heartbeat(self) -> None:
+        # long generations outlive the mark, refresh it until the model has none left
+        while True:
+            time.sleep(self.heartbeat_seconds)
+            with self._lock:
+                gates = dict(self._gates)
+            for model, gate in gates.items():
+                if gate.active or gate.waiting or gate.batch_waiting:
+                    self._mark_busy(model)
+
+    def _is_busy_elsewhere(self, model: str) -> bool:
+        """ Whether the activity cache marks the model busy, looked up at most twice per heartbeat """
+        if self.activity_cache is None:
+            return False
+        checked_at, busy = self._busy_elsewhere.get(model, (0.0, False))
+        now = time.monotonic()
+        if now - checked_at >= self.heartbeat_seconds / 2:
+            try:
+                busy = caches[self.activity_cache].get(self._activity_key(model)) is not None
+            except Exception as e:
+                logger.error(f"Reading generation activity of {model} failed: {str(e)}")
+                busy = False
+            self._busy_elsewhere[model] = (now, busy)
+        return busy
+
+    def stats(self) -> Dict:
+        """ Active and waiting generations per model """
+        with self._lock:
+            gates = dict(self._gates)
+        return {
+            model: {
+                "limit": gate.limit,
+                "active": gate.active,
+                "waiting": gate.waiting,
+                "batch_active": gate.batch_active,
+                "batch_waiting": gate.batch_waiting,
+                "average_seconds": round(gate.average_seconds, 3) if gate.average_seconds else None,
+            }
+            for model, gate in gates.items()
+        }
+
+
+# singleton instance of the controller
+_admission_controller = None
+_admission_controller_lock = threading.Lock()
+
+def _reset_after_fork():
+    # slots held by the parent's threads do not exist in a forked worker
+    global _admission_controller, _admission_controller_lock
+    _admission_controller = None
+    _admission_controller_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def get_admission_controller() -> AdmissionController:
+    global _admission_controller
+    if _admission_controller is None:
+        with _admission_controller_lock:
+            if _admission_controller is None:
+                default_limit = getattr(settings, 'GENERATION_MAX_CONCURRENT', 2)
+                _admission_controller = AdmissionController(
+                    limits={
+                        entry['model']: entry.get('max_generations', default_limit)
+                        for entry in getattr(settings, 'LLM_URLS', [])
+                    },
+                    default_limit=default_limit,
+                    max_queue=getattr(settings, 'GENERATION_MAX_QUEUE', 8),
+                    queue_timeout=getattr(settings, 'GENERATION_QUEUE_TIMEOUT', 30),
+                    activity_cache=getattr(settings, 'GENERATION_ACTIVITY_CACHE', 'default'),
+                    heartbeat_seconds=getattr(settings, 'GENERATION_HEARTBEAT_SECONDS', 1.0),
+                )
+    return _admission_controller
@@ -1,5 +1,34 @@
+import os
+import sys
+
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class RagliteappConfig(AppConfig):
     name = "ragliteapp"
+    default_auto_field = "django.db.models.BigAutoField"
+
+    def ready(self):
+        if _serves_requests() and getattr(settings, 'WARMUP_ON_STARTUP', True):
+            from .warmup import start_warm_up
+            start_warm_up()
+
+
+# executables of the wsgi/asgi servers that run the project
+SERVER_ENTRY_POINTS = {"gunicorn", "uvicorn", "daphne", "hypercorn", "granian", "uwsgi", "waitress-serve"}
+
+
+def _serves_requests() -> bool:
+    """ Only warm up processes that serve requests, not migrate/shell/tests/etc. """
+    program = os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else ""
+    if program == "__main__.py":
+        # started with python -m <server>
+        program = os.path.basename(os.path.dirname(sys.argv[0]))
+    if program in SERVER_ENTRY_POINTS or "uwsgi" in sys.modules or "mod_wsgi" in sys.modules:
+        return True
+    if program not in ("manage.py", "django-admin") or len(sys.argv) < 2 or sys.argv[1] != 'runserver':
+        # other servers are warmed up by their first readiness probe
+        return False
+    # the autoreloader parent process only watches files, its child serves
+    return os.environ.get('RUN_MAIN') == 'true' or '--noreload' in sys.argv
@@ -0,0 +1,228 @@
+# Background writer batching Chat persistence off the response path
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from typing import List, Optional
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from .models import Chat, Document
+from .vectordb_services import get_chroma_service
+
+logger = logging.getLogger(__name__)
+
+
+class ChatWriter:
+    """
+    Persist Chat rows, their document links and semantic cache entries in batches
+
+    Views hand over unsaved Chat instances (their UUID is assigned on creation,
+    so the id can be returned right away, ChatViewSet flushes the writer when
+    a chat is not found yet) and a single background thread writes
+    them with bulk_create in one transaction, which keeps writes from
+    serializing on the database lock request by request. A failing batch is
+    retried with backoff and then saved row by row, so one bad row only loses
+    itself.
+    """
+
+    def __init__(self):
+        self.batch_size = getattr(settings, 'CHAT_WRITE_BATCH_SIZE', 50)
+        self.flush_interval = getattr(settings, 'CHAT_WRITE_FLUSH_INTERVAL', 0.5)
+        self.run_async = getattr(settings, 'CHAT_WRITE_ASYNC', True)
+        self.retries = getattr(settings, 'CHAT_WRITE_RETRIES', 3)
+        self.retry_backoff = getattr(settings, 'CHAT_WRITE_RETRY_BACKOFF', 0.5)
+        self.queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        # queued chats per conversation and per linked document, for flushing only those
+        self._pending = Counter()
+        self._pending_changed = threading.Condition()
+
+    def submit(self, chat: Chat, document_ids: Optional[List[str]] = None, cache_question: bool = True) -> None:
+        """
+        Queue a chat for persistence
+
+        Args:
+            chat: Unsaved Chat instance
+            document_ids: Documents to link the chat to
+            cache_question: Also add the question to the semantic cache
+        """
+        item = (chat, [str(document_id) for document_id in document_ids or []], cache_question)
+        if not self.run_async:
+            self._write([item])
+            return
+        self._ensure_thread()
+        with self._pending_changed:
+            self._pending.update(self._keys(item))
+        self.queue.put(item)
+
+    def flush(self, conversation_id: Optional[str] = None, document_id: Optional[str] = None) -> None:
+        """
+        Block until queued chats have been written
+
+        Args:
+            conversation_id: Only wait for the turns of this conversation
+            document_id: Only wait for the chats linked to this document
+
+        Without arguments waits for every queued chat.
+        """
+        if self._thread is None or not self._thread.is_alive():
+            return
+        if conversation_id is None and document_id is None:
+            self.queue.join()
+            return
+        keys = []
+        if conversation_id is not None:
+            keys.append(("conversation", str(conversation_id)))
+        if document_id is not None:
+            keys.append(("document", str(document_id)))
+        with self._pending_changed:
+            self._pending_changed.wait_for(lambda: not any(self._pending[key] for key in keys))
+
+    @staticmethod
+    def _keys(item):
+        chat, document_ids, _ = item
+        keys = [("document", document_id) for document_id in document_ids]
+        if chat.conversation_id is not None:
+            keys.append(("conversation", str(chat.conversation_id)))
+        return keys
+
+    def _ensure_thread(self):
+        # threads do not survive a fork, so a worker process starts its own
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='chat-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                logger.error(f"Error writing {len(batch)} chats: {str(e)}")
+            finally:
+                with self._pending_changed:
+                    for item in batch:
+                        for key in self._keys(item):
+                            self._pending[key] -= 1
+                            if self._pending[key] <= 0:
+                                del self._pending[key]
+                    self._pending_changed.notify_all()
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _write(self, batch):
+        """ Write one batch of chats and links, then add the saved ones to the semantic cache """
+        saved = self._save_with_retry(batch)
+
+        # cache only after the rows exist, so a cache hit always finds its chat
+        cached = [chat for chat, _, cache_question in saved if cache_question]
+        if cached:
+            try:
+                get_chroma_service().add_cached_questions(
+                    [chat.question for chat in cached],
+                    [str(chat.id) for chat in cached],
+                    [chat.answer for chat in cached]
+                )
+                logger.info(f"Cached {len(cached)} questions in ChromaDB")
+            except Exception as e:
+                # the chats are stored, only the cache misses them
+                logger.error(f"Error caching {len(cached)} questions: {str(e)}")
+
+    def _save_with_retry(self, batch):
+        """
+        Save a batch in one transaction, retrying with backoff, then row by row
+
+        Returns:
+            The items of the batch that were saved
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                self._save(batch)
+                return batch
+            except Exception as e:
+                if attempt == self.retries:
+                    logger.error(f"Error saving {len(batch)} chats, saving them one by one: {str(e)}")
+                    break
+                delay = self.retry_backoff * 2 ** attempt
+                logger.warning(f"Error saving {len(batch)} chats, retrying in {delay}s: {str(e)}")
+                time.sleep(delay)
+
+        saved = []
+        for item in batch:
+            try:
+                self._save([item])
+                saved.append(item)
+            except Exception as e:
+                logger.error(f"Dropping chat {item[0].id}: {str(e)}")
+        return saved
+
+    def _save(self, batch):
+        """ Insert the chats of a batch and their document links in one transaction """
+        close_old_connections()
+        chats = [chat for chat, _, _ in batch]
+        requested_ids = {document_id for _, document_ids, _ in batch for document_id in document_ids}
+        existing_ids = set()
+        if requested_ids:
+            existing_ids = {
+                str(document_id)
+                for document_id in Document.objects.filter(id__in=requested_ids).values_list('id', flat=True)
+            }
+        Link = Chat.documents.through
+        links = [
+            Link(chat_id=chat.id, document_id=document_id)
+            for chat, document_ids, _ in batch
+            for document_id in document_ids
+            if document_id in existing_ids
+        ]
+        with transaction.atomic():
+            Chat.objects.bulk_create(chats)
+            if links:
+                Link.objects.bulk_create(links, ignore_conflicts=True)
+        logger.info(f"Saved {len(chats)} chats")
+
+
+# singleton instance of the writer
+_chat_writer = None
+_chat_writer_lock = threading.Lock()
+
+def _reset_after_fork():
+    # a forked worker inherits the parent's queue, unfinished task count and
+    # pending counts but not its writer thread, so flush() could wait forever
+    global _chat_writer, _chat_writer_lock
+    _chat_writer = None
+    _chat_writer_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _flush_at_exit():
+    if _chat_writer is not None:
+        _chat_writer.flush()
+
+atexit.register(_flush_at_exit)
+
+def get_chat_writer() -> ChatWriter:
+    """ get or create chat writer instance """
+    global _chat_writer
+    if _chat_writer is None:
+        with _chat_writer_lock:
+            if _chat_writer is None:
+                _chat_writer = ChatWriter()
+    return _chat_writer
@@ -0,0 +1,167 @@
+# Conversation history for multi-turn chats
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .admission import get_admission_controller
+from .chat_writer import get_chat_writer
+from .llm_services import get_llm_service
+from .models import Conversation
+from .utils import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+
+def get_history(conversation: Conversation, model: str = "llama3.2") -> Tuple[str, List[Tuple[str, str]]]:
+    """
+    Summary and most recent turns of a conversation
+
+    The window holds at most CONVERSATION_HISTORY_TURNS turns and at most
+    CONVERSATION_HISTORY_TOKENS estimated tokens, older turns only reach the
+    prompt through the summary, so the prompt stays about the same size
+    however long the conversation gets. Turns that left the window before
+    the background update summarized them are returned with the window and
+    an update is scheduled, so no turn is ever dropped from both and no
+    summary is generated on the request path.
+
+    Args:
+        conversation: The conversation
+        model: LLM model name used for the summary
+
+    Returns:
+        Tuple of (summary, [(question, answer), ...] oldest first)
+    """
+    # queued turns of this conversation must be visible before reading it
+    get_chat_writer().flush(conversation_id=conversation.id)
+    unsummarized, turns, _ = _split_turns(conversation)
+    if unsummarized:
+        schedule_summary_update(conversation.id, model)
+    return conversation.summary, unsummarized + turns
+
+
+def _window_start(turns: List[Tuple[str, str]]) -> int:
+    """ Index of the oldest of the turns (oldest first) that fits the history window """
+    window = getattr(settings, 'CONVERSATION_HISTORY_TURNS', 4)
+    token_budget = getattr(settings, 'CONVERSATION_HISTORY_TOKENS', 800)
+    start = len(turns)
+    used_tokens = 0
+    while start > 0 and len(turns) - start < window:
+        question, answer = turns[start - 1]
+        tokens = estimate_tokens(question) + estimate_tokens(answer)
+        # the latest turn is always kept
+        if start < len(turns) and used_tokens + tokens > token_budget:
+            break
+        used_tokens += tokens
+        start -= 1
+    return start
+
+
+def _split_turns(conversation: Conversation) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str]], int]:
+    """
+    Turns before the history window that the summary does not cover yet, and the window
+
+    Returns:
+        Tuple of (unsummarized turns, turns in the window, turns the summary
+        should cover), the turns oldest first
+    """
+    window = getattr(settings, 'CONVERSATION_HISTORY_TURNS', 4)
+    total = conversation.chats.count()
+    recent = list(conversation.chats.order_by('-created_at').values_list('question', 'answer')[:window])
+    recent.reverse()
+    offset = _window_start(recent)
+    summarize_until = total - len(recent) + offset
+    unsummarized = []
+    if summarize_until > conversation.summarized_turns:
+        turns = conversation.chats.order_by('created_at').values_list('question', 'answer')
+        unsummarized = list(turns[conversation.summarized_turns:summarize_until])
+    return unsummarized, recent[offset:], summarize_until
+
+
+def _fold_into_summary(conversation: Conversation, model: str) -> None:
+    """
+    Summarize the turns before the history window that the summary does not cover yet
+
+    The summary holds a generation slot of the model like any answer, so it
+    waits for the queries in flight and counts as activity for the
+    background jobs waiting for an idle model. The conversation's summary
+    fields are updated in place. When the summary fails the turns it should
+    have covered stay in the history, the next update tries again.
+    """
+    unsummarized, _, summarize_until = _split_turns(conversation)
+    if not unsummarized:
+        return
+    with get_admission_controller().admit(model, enforce_queue=False):
+        summary = get_llm_service().summarize_conversation(conversation.summary, unsummarized, model_name=model)
+    if summary is None:
+        logger.warning(f"Keeping {len(unsummarized)} unsummarized turns of conversation {conversation.id}")
+        return
+    # a concurrent update that got there first wins, its summary covers the same turns
+    updated = Conversation.objects.filter(
+        id=conversation.id, summarized_turns=conversation.summarized_turns
+    ).update(summary=summary, summarized_turns=summarize_until, updated_at=timezone.now())
+    if updated:
+        conversation.summary = summary
+        conversation.summarized_turns = summarize_until
+        logger.info(f"Summarized {summarize_until} turns of conversation {conversation.id}")
+    else:
+        conversation.refresh_from_db(fields=['summary', 'summarized_turns'])
+
+
+def format_history(summary: str, turns: List[Tuple[str, str]]) -> str:
+    """ History text for the prompts, empty for a new conversation """
+    parts = [f"Summary of earlier turns: {summary}"] if summary else []
+    parts.extend(f"User: {question}\nAssistant: {answer}" for question, answer in turns)
+    return "\n".join(parts)
+
+
+def update_summary(conversation_id: str, model: str) -> None:
+    """
+    Fold the turns that left the history window into the conversation summary
+
+    Each update only summarizes the turns added since the previous one
+    together with the previous summary, so its cost does not grow with the
+    conversation.
+    """
+    try:
+        close_old_connections()
+        get_chat_writer().flush(conversation_id=conversation_id)
+        _fold_into_summary(Conversation.objects.get(id=conversation_id), model)
+    except Exception as e:
+        logger.error(f"Updating the summary of conversation {conversation_id} failed: {str(e)}")
+    finally:
+        with _pending_lock:
+            _pending.discard(conversation_id)
+        close_old_connections()
+
+
+# summaries are updated one at a time in the background, off the response path
+_executor = None
+_pending = set()
+_pending_lock = threading.Lock()
+
+def _reset_after_fork():
+    # the executor thread does not exist in a forked worker
+    global _executor, _pending_lock
+    _executor = None
+    _pending.clear()
+    _pending_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def schedule_summary_update(conversation_id: str, model: str) -> None:
+    """ Queue a summary update unless one is already pending for the conversation """
+    global _executor
+    conversation_id = str(conversation_id)
+    with _pending_lock:
+        if conversation_id in _pending:
+            return
+        _pending.add(conversation_id)
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='conversation-summary')
+    _executor.submit(update_summary, conversation_id, model)
@@ -0,0 +1,300 @@
+# Text extractors for the supported document formats
+import mmap
+import os
+import re
+import zipfile
+from html.parser import HTMLParser
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from xml.etree.ElementTree import iterparse
+
+# An extractor takes a file path and yields the text of the document one
+# section at a time (a page for PDF, a heading section for Markdown/HTML/DOCX)
+# so that chunking never needs the whole document in memory.
+Extractor = Callable[[str], Iterator[str]]
+
+# A fast chunker skips section extraction and yields
+# (section_number, chunk_index, chunk_text) straight from the file.
+FastChunker = Callable[[str, int, int], Iterator[Tuple[int, int, str]]]
+
+_extractors_by_extension: Dict[str, Extractor] = {}
+_extractors_by_mime_type: Dict[str, Extractor] = {}
+_fast_chunkers: Dict[str, FastChunker] = {}
+
+read_chunk_size = 64 * 1024 # 64KB read at a time by the streaming parsers
+# longer sections are yielded in parts, so no extractor holds more than this
+# many characters of a section; every part counts against the page limit
+max_section_size = 1024 * 1024
+# XML read from an Office archive at most, compressed members can expand a thousandfold
+max_archive_member_size = 64 * 1024 * 1024
+
+
+class DocumentTooLargeError(ValueError):
+    """ Raised when a document exceeds the configured page/section limit """
+
+
+def register_extractor(extensions: List[str], mime_types: List[str] = ()):
+    """
+    Register an extractor for the given extensions and MIME types
+
+    Args:
+        extensions: File extensions including the dot (e.g. ['.md', '.markdown'])
+        mime_types: MIME types sent by clients for this format
+    """
+    def decorator(func: Extractor) -> Extractor:
+        for extension in extensions:
+            _extractors_by_extension[extension.lower()] = func
+        for mime_type in mime_types:
+            _extractors_by_mime_type[mime_type.lower()] = func
+        return func
+    return decorator
+
+
+def register_fast_chunker(extensions: List[str]):
+    """
+    Register a chunker that bypasses section extraction for the given extensions
+
+    Args:
+        extensions: File extensions including the dot (e.g. ['.txt'])
+    """
+    def decorator(func: FastChunker) -> FastChunker:
+        for extension in extensions:
+            _fast_chunkers[extension.lower()] = func
+        return func
+    return decorator
+
+
+def supported_extensions() -> Tuple[str, ...]:
+    """ Extensions with a registered extractor """
+    return tuple(sorted(_extractors_by_extension))
+
+
+def supported_mime_types() -> Tuple[str, ...]:
+    """ MIME types with a registered extractor """
+    return tuple(sorted(_extractors_by_mime_type))
+
+
+def is_supported(file_name: str, content_type: Optional[str] = None) -> bool:
+    """ Whether get_extractor finds an extractor for the file, by extension or MIME type """
+    try:
+        get_extractor(file_name, content_type)
+    except ValueError:
+        return False
+    return True
+
+
+def get_extractor(file_path: str, content_type: Optional[str] = None) -> Extractor:
+    """
+    Find the extractor for a file
+
+    Args:
+        file_path: Path (or name) of the file, matched by extension first
+        content_type: Optional MIME type, used when the extension is unknown
+
+    Returns:
+        Extractor function
+
+    Raises:
+        ValueError: If the format is not supported
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+    extractor = _extractors_by_extension.get(extension)
+    if extractor is None and content_type:
+        extractor = _extractors_by_mime_type.get(content_type.split(';')[0].strip().lower())
+    if extractor is None:
+        raise ValueError(f"Unsupported file type: {extension or content_type}")
+    return extractor
+
+
+def get_fast_chunker(file_path: str) -> Optional[FastChunker]:
+    """ Return the fast chunker for a file, if its format has one """
+    return _fast_chunkers.get(os.path.splitext(file_path)[1].lower())
+
+
+# ===== PDF =====
+@register_extractor(['.pdf'], ['application/pdf'])
+def extract_pdf_pages(file_path: str) -> Iterator[str]:
+    """ Yield the text of each PDF page """
+    from PyPDF2 import PdfReader
+
+    reader = PdfReader(file_path)
+    for page in reader.pages:
+        yield page.extract_text() or ""
+
+
+# ===== PLAIN TEXT =====
+@register_extractor(['.txt'], ['text/plain'])
+def extract_text_file(file_path: str) -> Iterator[str]:
+    """ Yield a plain text file as a single section, in parts of max_section_size """
+    with open(file_path, encoding='utf-8', errors='replace') as f:
+        yield from iter(lambda: f.read(max_section_size), '')
+
+
+def _utf8_boundary(data: mmap.mmap, position: int) -> int:
+    """ Move position back to the start of a UTF-8 character """
+    while 0 < position < len(data) and (data[position] & 0xC0) == 0x80:
+        position -= 1
+    return position
+
+
+@register_fast_chunker(['.txt'])
+def chunk_text_file(file_path: str, chunk_size: int, overlap: int) -> Iterator[Tuple[int, int, str]]:
+    """
+    Chunk a plain text file straight from a memory-mapped view
+
+    No parsing or full read is done, each chunk is sliced from the mapping
+    and decoded on its own. Sizes are in bytes, which equals characters for
+    ASCII text; slices are aligned to UTF-8 character boundaries.
+    """
+    if os.path.getsize(file_path) == 0:
+        return
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        start = 0
+        chunk_index = 0
+        size = len(data)
+        while start < size:
+            end = _utf8_boundary(data, min(start + chunk_size, size))
+            if end <= start:
+                end = min(start + chunk_size, size)
+            yield 1, chunk_index, data[start:end].decode('utf-8', errors='replace')
+            chunk_index += 1
+            if end >= size:
+                break
+            start = max(_utf8_boundary(data, end - overlap), start + 1)
+
+
+# ===== MARKDOWN =====
+_markdown_heading = re.compile(r'^#{1,6}\s')
+
+
+@register_extractor(['.md', '.markdown'], ['text/markdown', 'text/x-markdown'])
+def extract_markdown_sections(file_path: str) -> Iterator[str]:
+    """ Yield Markdown sections, split on ATX headings """
+    section = []
+    size = 0
+    in_code_block = False
+    with open(file_path, encoding='utf-8', errors='replace') as f:
+        # lines are read in bounded pieces, a file without newlines is never one line in memory
+        for line in iter(lambda: f.readline(read_chunk_size), ''):
+            if line.lstrip().startswith('```'):
+                in_code_block = not in_code_block
+            if section and (size + len(line) > max_section_size or (not in_code_block and _markdown_heading.match(line))):
+                yield ''.join(section)
+                section = []
+                size = 0
+            section.append(line)
+            size += len(line)
+    if section:
+        yield ''.join(section)
+
+
+# ===== HTML =====
+class _SectionHTMLParser(HTMLParser):
+    """ Collects visible text and closes a section at every heading """
+    HEADINGS = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+    SKIPPED = {'script', 'style', 'noscript', 'template'}
+    BLOCKS = {'p', 'div', 'br', 'li', 'tr', 'section', 'article', 'pre', 'blockquote'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.sections = []
+        self._current = []
+        self._size = 0
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED:
+            self._skip_depth += 1
+        elif tag in self.HEADINGS:
+            self.close_section()
+        elif tag in self.BLOCKS:
+            self._append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED and self._skip_depth:
+            self._skip_depth -= 1
+        elif tag in self.HEADINGS or tag in self.BLOCKS:
+            self._append('\n')
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self._append(data)
+
+    def _append(self, text):
+        if self._size + len(text) > max_section_size:
+            self.close_section()
+        self._current.append(text)
+        self._size += len(text)
+
+    def close_section(self):
+        text = re.sub(r'\n\s*\n+', '\n\n', ''.join(self._current)).strip()
+        if text:
+            self.sections.append(text)
+        self._current = []
+        self._size = 0
+
+
+@register_extractor(['.html', '.htm'], ['text/html', 'application/xhtml+xml'])
+def extract_html_sections(file_path: str) -> Iterator[str]:
+    """ Yield the visible text of HTML sections, split on headings """
+    parser = _SectionHTMLParser()
+    with open(file_path, encoding='utf-8', errors='replace') as f:
+        for data in iter(lambda: f.read(read_chunk_size), ''):
+            parser.feed(data)
+            yield from parser.sections
+            parser.sections = []
+    parser.close()
+    parser.close_section()
+    yield from parser.sections
+
+
+# ===== DOCX =====
+_w = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+
+class _LimitedReader:
+    """ File wrapper raising DocumentTooLargeError once more than limit bytes were read """
+
+    def __init__(self, file, limit: int):
+        self.file = file
+        self.limit = limit
+        self.read_bytes = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.file.read(size if size is not None and size >= 0 else read_chunk_size)
+        self.read_bytes += len(data)
+        if self.read_bytes > self.limit:
+            raise DocumentTooLargeError(f"Document expands to more than {self.limit // (1024 * 1024)}MB")
+        return data
+
+
+@register_extractor(
+    ['.docx'],
+    ['application/vnd.openxmlformats-officedocument.wordprocessingml.document']
+)
+def extract_docx_sections(file_path: str) -> Iterator[str]:
+    """
+    Yield DOCX sections, split on paragraphs with a Heading/Title style
+
+    The document XML is decompressed while it is parsed and given up past
+    max_archive_member_size bytes, whatever size the archive declares.
+    """
+    section = []
+    size = 0
+    with zipfile.ZipFile(file_path) as archive, archive.open('word/document.xml') as xml:
+        for _event, element in iterparse(_LimitedReader(xml, max_archive_member_size), events=('end',)):
+            if element.tag != f'{_w}p':
+                continue
+            style = element.find(f'{_w}pPr/{_w}pStyle')
+            style_name = style.get(f'{_w}val', '') if style is not None else ''
+            text = ''.join(node.text or '' for node in element.iter(f'{_w}t'))
+            if section and (style_name.startswith(('Heading', 'Title')) or size + len(text) > max_section_size):
+                yield '\n'.join(section)
+                section = []
+                size = 0
+            if text:
+                section.append(text)
+                size += len(text)
+            # paragraphs are processed once, free them to keep memory flat
+            element.clear()
+    if section:
+        yield '\n'.join(section)
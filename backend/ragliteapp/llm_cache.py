@@ -0,0 +1,66 @@
+# Response cache for deterministic LLM generations
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+
+class LLMResponseCache:
+    """
+    Bounded in-process LRU cache of generated answers
+
+    Entries are keyed on a hash of the model, the final prompt and the
+    generation options, so it catches questions that differ in wording but
+    build a byte-identical prompt (same retrieved chunks), which the
+    question-level caches miss. Hits, misses and evictions are counted for
+    the stats endpoint.
+    """
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(model_name: str, prompt: str, options: Dict) -> str:
+        """ Hash of everything that determines the generated answer """
+        payload = json.dumps({"model": model_name, "prompt": prompt, "options": options}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            answer = self._entries.get(key)
+            if answer is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return answer
+
+    def set(self, key: str, answer: str) -> None:
+        with self._lock:
+            self._entries[key] = answer
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
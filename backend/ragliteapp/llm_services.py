@@ -1,13 +1,66 @@
 import requests
+import requests.adapters
+import json
 import logging
-from typing import Optional
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
 from django.conf import settings
 
+from .llm_cache import LLMResponseCache
+from .logging_utils import sample_payload
+
 logger = logging.getLogger(__name__)
 
+def generation_metrics(result: Dict) -> Dict:
+    """ Token counts and durations (in seconds) from the final line of an Ollama generation """
+    def seconds(nanoseconds):
+        return nanoseconds / 1e9 if nanoseconds is not None else None
+
+    return {
+        "prompt_eval_count": result.get("prompt_eval_count"),
+        "eval_count": result.get("eval_count"),
+        "prompt_eval_duration": seconds(result.get("prompt_eval_duration")),
+        "eval_duration": seconds(result.get("eval_duration")),
+        "load_duration": seconds(result.get("load_duration")),
+    }
+
+class GenerationError(Exception):
+    """ A generation failed on the backend, carries the HTTP status for the client (503, 504 past the deadline) """
+
+    def __init__(self, message: str, status_code: int = 503):
+        super().__init__(message)
+        self.status_code = status_code
+
 class LLMService:
     def __init__(self):
         self.urls = settings.LLM_URLS
+        # keep-alive connections to the Ollama backends, reused across requests
+        self.session = requests.Session()
+        # bounded number of concurrent generations per backend server, extra callers wait
+        default_concurrency = getattr(settings, 'LLM_BACKEND_CONCURRENCY', 4)
+        self.backend_limits = {}
+        for url_entry in self.urls:
+            self.backend_limits.setdefault(url_entry['url'], url_entry.get('max_concurrency', default_concurrency))
+        self._backend_slots = {url: threading.BoundedSemaphore(limit) for url, limit in self.backend_limits.items()}
+        # the session pool must hold a connection for every concurrent generation
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(self.backend_limits.values(), default=10))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # answers of deterministic generations, keyed on model + prompt + options
+        cache_settings = getattr(settings, 'LLM_RESPONSE_CACHE', {})
+        self.response_cache_always = cache_settings.get('ALWAYS', False)
+        self.response_cache = LLMResponseCache(max_entries=cache_settings.get('MAX_ENTRIES', 1000))
+
+    def get_backend_url(self, model_name: str) -> Optional[str]:
+        """ Backend url serving a model, None if the model is not configured """
+        return next((entry['url'] for entry in self.urls if entry['model'] == model_name), None)
+
+    def get_backend_concurrency(self, model_name: str) -> int:
+        """ Concurrent generations allowed on the backend serving a model """
+        return self.backend_limits.get(self.get_backend_url(model_name), 1)
     
     def generate_answer(
         self,
@@ -15,76 +68,196 @@ class LLMService:
         context:str,
         temperature:float =0.7,
         model_name:str = "llama3.2",
+        deadline:Optional[float] = None,
+        cancel_event:Optional[threading.Event] = None,
+        history:str = "",
+        metrics:Optional[Dict] = None,
     ) -> Optional[str]:
         """
         Generate an answer using Ollama LLM
+
+        The answer is streamed from Ollama so the generation can be abandoned
+        part way: once the deadline has passed or cancel_event is set the
+        connection is closed, which makes Ollama stop generating.
         
         Args:
             question: The user's question
             context: Retrieved context from documents
             temperature: LLM temperature (0.0 = deterministic, 1.0 = creative)
             model_name: LLM model name
+            deadline: Seconds the generation may take, defaults to no limit
+            cancel_event: Set by the caller to abort the generation
+            history: Conversation summary and recent turns, empty for standalone questions
+            metrics: Filled with Ollama's token counts and durations (see generation_metrics),
+                left empty when the answer came from the response cache
             
         Returns:
-            Generated answer or None if error
+            Generated answer, None if cancelled
+
+        Raises:
+            GenerationError: the model is not configured, the deadline passed or the backend failed
         """
     
         # build prompt
-        prompt = self._build_prompt(query, context)
+        prompt = self._build_prompt(query, context, history)
         try:
-            # fetching url based on model_name received from user input
-            target_url = None
-            for url_entry in self.urls:
-                if url_entry['model'] == model_name:
-                    target_url = url_entry['url']
-                    break
-            
-            if target_url is None:
-                logger.error(f"Model {model_name} not found")
-                return "Model not found"
-        
-            # make request to ollama
-            response = requests.post(
+            started = time.perf_counter()
+            metrics = {} if metrics is None else metrics
+            answer = self._generate(prompt, model_name, {"temperature": temperature}, deadline, cancel_event, metrics)
+            if answer is not None:
+                elapsed_ms = round(1000 * (time.perf_counter() - started), 2)
+                logger.info(
+                    f"Generated answer with {model_name}: {len(answer)} characters in {elapsed_ms} ms",
+                    extra={"event": "llm_generation", "model": model_name, "prompt_chars": len(prompt),
+                           "answer_chars": len(answer), "elapsed_ms": elapsed_ms, **metrics}
+                )
+                if sample_payload():
+                    logger.info(f"Generated answer: {answer}", extra={"event": "llm_generation_payload"})
+            return answer
+        except LookupError as e:
+            logger.error(str(e))
+            raise GenerationError(str(e)) from e
+        except (TimeoutError, requests.exceptions.Timeout) as e:
+            logger.error(f"Ollama generation timed out: {e}")
+            raise GenerationError(f"Generation with {model_name} timed out", 504) from e
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Ollama request failed: {e}")
+            raise GenerationError(f"Generation with {model_name} failed") from e
+        except Exception as e:
+            logger.error(f"Unexpected error: {e}")
+            raise GenerationError(f"Generation with {model_name} failed") from e
+
+    def cached_answer(
+        self,
+        query:str,
+        context:str,
+        temperature:float = 0.7,
+        model_name:str = "llama3.2",
+        history:str = "",
+    ) -> Optional[str]:
+        """
+        Answer generate_answer would return from the response cache, without generating
+
+        Lets callers skip waiting for a generation slot when the answer is cached.
+
+        Returns:
+            Cached answer, None on a miss or when answers at this temperature are not cached
+        """
+        cache_key = self._cache_key(self._build_prompt(query, context, history), model_name, {"temperature": temperature})
+        if cache_key is None:
+            return None
+        return self.response_cache.get(cache_key)
+
+    def _cache_key(self, prompt:str, model_name:str, options:Dict) -> Optional[str]:
+        # sampled answers are only reused when caching is enabled for every temperature
+        if options.get("temperature") == 0 or self.response_cache_always:
+            return LLMResponseCache.make_key(model_name, prompt, options)
+        return None
+
+    def _generate(
+        self,
+        prompt:str,
+        model_name:str,
+        options:Dict,
+        deadline:Optional[float] = None,
+        cancel_event:Optional[threading.Event] = None,
+        metrics:Optional[Dict] = None,
+        cache:bool = True,
+    ) -> Optional[str]:
+        """
+        Stream a completion from the Ollama backend serving the model
+
+        Args:
+            prompt: Final prompt
+            model_name: LLM model name
+            options: Ollama generation options
+            deadline: Seconds the generation may take
+            cancel_event: Set by the caller to abort the generation
+            metrics: Filled with the generation metrics of the final line
+            cache: Look the completion up in and add it to the response cache,
+                for callers whose prompts repeat (only complete streams are added)
+
+        Returns:
+            Generated text, None if cancelled
+
+        Raises:
+            LookupError: the model is not configured
+            TimeoutError: the deadline passed
+            requests.exceptions.RequestException: the request failed
+        """
+        cache_key = self._cache_key(prompt, model_name, options) if cache else None
+        if cache_key is not None:
+            cached_answer = self.response_cache.get(cache_key)
+            if cached_answer is not None:
+                logger.info(f"LLM response cache hit for model {model_name}")
+                return cached_answer
+
+        # fetching url based on model_name received from user input
+        target_url = self.get_backend_url(model_name)
+        if target_url is None:
+            raise LookupError(f"Model {model_name} not found")
+
+        # make request to ollama, waiting for a free slot on its server
+        with self._backend_slots[target_url]:
+            started = time.monotonic()
+            response = self.session.post(
                 target_url,
                 json={
                     "model": model_name,
                     "prompt": prompt,
-                    "stream": False,
-                    "options": {
-                        "temperature": temperature
-                    }
+                    "stream": True,
+                    "options": options
                 },
-                # timeout is set to 1 hour
-                timeout=3600
+                stream=True,
+                # connect timeout, then the longest wait for the next token (1 hour without deadline)
+                timeout=(10, deadline or 3600)
             )
-            response.raise_for_status()
-            result = response.json()
-            answer = result.get("response", "")
-            logger.info(f"Generated answer: {answer}")
-            return answer
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Ollama request failed: {e}")
-            return "OLF"
-        except requests.exceptions.Timeout as e:
-            logger.error(f"Ollama request timed out: {e}")
-            return "OLT"
-        except Exception as e:
-            logger.error(f"Unexpected error: {e}")
-            return "OLU"
+            try:
+                response.raise_for_status()
+                parts = []
+                done = False
+                for line in response.iter_lines():
+                    if cancel_event is not None and cancel_event.is_set():
+                        logger.info(f"Generation with {model_name} cancelled, aborting the Ollama request")
+                        return None
+                    if deadline is not None and time.monotonic() - started > deadline:
+                        raise TimeoutError(f"Generation with {model_name} passed its {deadline}s deadline, aborted")
+                    if not line:
+                        continue
+                    result = json.loads(line)
+                    parts.append(result.get("response", ""))
+                    if result.get("done"):
+                        done = True
+                        if metrics is not None:
+                            metrics.update(generation_metrics(result))
+                        break
+            finally:
+                # closing an unfinished stream drops the connection, Ollama then stops generating
+                response.close()
+        answer = "".join(parts)
+        if not done:
+            # the stream was cut short, the answer may be truncated
+            logger.warning(f"Generation with {model_name} ended before Ollama reported it done, not caching it")
+        elif cache_key and answer:
+            self.response_cache.set(cache_key, answer)
+        return answer
     
-    def _build_prompt(self, query:str, context:str) -> str:
+    def _build_prompt(self, query:str, context:str, history:str = "") -> str:
         """
         Build the prompt for the LLM
         
         Args:
             question: User's question
             context: Retrieved document context
+            history: Conversation summary and recent turns
             
         Returns:
             Formatted prompt
         """
+        conversation = f"""
+        Conversation so far: {history}""" if history else ""
         prompt = f""" You are a helpful assistant that answers questions based on provided context.
-        Context from documents: {context}
+        Context from documents: {context}{conversation}
         Question: {query}
         Instructions: 
         - Answer the question based ONLY on the provided context
@@ -93,7 +266,150 @@ class LLMService:
         - Cite specific details from the context when possible
         Answer:"""
         return prompt
+
+    def rewrite_query(self, query:str, history:str, model_name:str = "llama3.2") -> str:
+        """
+        Rewrite a follow-up question into a standalone question
+
+        Used for retrieval and caching, which see one question at a time.
+        Falls back to the original question if the rewrite fails.
+
+        Args:
+            query: Follow-up question
+            history: Conversation summary and recent turns
+            model_name: LLM model name
+
+        Returns:
+            Standalone question
+        """
+        prompt = f""" Rewrite the follow-up question so it can be understood without the conversation.
+        Resolve pronouns and references using the conversation. If it already stands alone, return it unchanged.
+        Reply with the rewritten question only.
+        Conversation: {history}
+        Follow-up question: {query}
+        Standalone question:"""
+        try:
+            # cached: the same follow-up at the same point of a conversation is rewritten the same way
+            rewritten = self._generate(
+                prompt,
+                model_name,
+                {"temperature": 0},
+                deadline=getattr(settings, 'GENERATION_DEADLINE', None)
+            )
+        except Exception as e:
+            logger.error(f"Query rewrite failed: {e}")
+            return query
+        rewritten = (rewritten or "").strip().splitlines()
+        rewritten = rewritten[0].strip().strip('"') if rewritten else ""
+        return rewritten or query
+
+    def summarize_conversation(self, summary:str, turns:List[Tuple[str, str]], model_name:str = "llama3.2") -> Optional[str]:
+        """
+        Fold older conversation turns into the running summary
+
+        Args:
+            summary: Summary of the turns before these
+            turns: (question, answer) pairs to add to the summary
+            model_name: LLM model name
+
+        Returns:
+            Updated summary or None if the generation failed
+        """
+        max_words = getattr(settings, 'CONVERSATION_SUMMARY_WORDS', 150)
+        transcript = "\n".join(f"User: {question}\nAssistant: {answer}" for question, answer in turns)
+        prompt = f""" Update the summary of a conversation with its next turns.
+        Keep facts, names and open questions the user may refer back to. Use at most {max_words} words.
+        Reply with the updated summary only.
+        Current summary: {summary or "(empty)"}
+        Next turns:
+        {transcript}
+        Updated summary:"""
+        try:
+            # every summary covers new turns, its prompt never repeats
+            updated = self._generate(
+                prompt,
+                model_name,
+                {"temperature": 0},
+                deadline=getattr(settings, 'GENERATION_DEADLINE', None),
+                cache=False
+            )
+        except Exception as e:
+            logger.error(f"Conversation summary failed: {e}")
+            return None
+        return updated.strip() if updated else None
+
+    def generate_questions(
+        self,
+        text:str,
+        count:int = 3,
+        model_name:str = "llama3.2",
+        cancel_event:Optional[threading.Event] = None
+    ) -> List[str]:
+        """
+        Generate questions a reader is likely to ask about a piece of a document
+
+        Args:
+            text: Section of a document
+            count: Number of questions
+            model_name: LLM model name
+            cancel_event: Set by the caller to abort the generation
+
+        Returns:
+            Questions, empty if the generation failed or was cancelled
+        """
+        prompt = f""" Write the {count} questions a reader of the following text would most likely ask.
+        Each question must be answerable from the text and understandable on its own.
+        Reply with one question per line and nothing else.
+        Text: {text}
+        Questions:"""
+        try:
+            # questions are generated once per document version
+            generated = self._generate(
+                prompt,
+                model_name,
+                {"temperature": 0},
+                deadline=getattr(settings, 'GENERATION_DEADLINE', None),
+                cancel_event=cancel_event,
+                cache=False
+            )
+        except Exception as e:
+            logger.error(f"Question generation failed: {e}")
+            return []
+        questions = []
+        for line in (generated or "").splitlines():
+            # drop list markers such as "1." or "-"
+            question = line.strip().lstrip("0123456789.)-* ").strip().strip('"')
+            if question.endswith("?"):
+                questions.append(question)
+        return questions[:count]
+        
+    def get_cache_stats(self) -> Dict:
+        """ Hit metrics of the LLM response cache """
+        return {**self.response_cache.stats(), "always": self.response_cache_always}
+
+    def preload_model(self, model_name: str) -> bool:
+        """
+        Ask Ollama to load a model into memory without generating anything
         
+        Args:
+            model_name: LLM model name
+            
+        Returns:
+            True if the model was loaded, False otherwise
+        """
+        target_url = self.get_backend_url(model_name)
+        if target_url is None:
+            logger.error(f"Model {model_name} not found")
+            return False
+        try:
+            # an empty prompt only loads the model
+            response = self.session.post(target_url, json={"model": model_name}, timeout=600)
+            response.raise_for_status()
+            return True
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Preloading model {model_name} failed: {e}")
+            return False
+
     def health_check(self) -> bool:
         """
         Check if the LLM service is healthy
@@ -109,10 +425,21 @@ class LLMService:
             return False
 # Singleton instance of LLMService
 _llm_service = None
+_llm_service_lock = threading.Lock()
+
+def _reset_after_fork():
+    # pooled connections must not be shared with the parent process
+    global _llm_service, _llm_service_lock
+    _llm_service = None
+    _llm_service_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
 
 def get_llm_service() -> LLMService:
     """ get or create llm service instance """
     global _llm_service
     if _llm_service is None:
-        _llm_service = LLMService()
+        with _llm_service_lock:
+            if _llm_service is None:
+                _llm_service = LLMService()
     return _llm_service
\ No newline at end of file
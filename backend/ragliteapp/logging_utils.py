@@ -0,0 +1,102 @@
+# Logging helpers: queue based handler, JSON formatter and payload sampling
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import weakref
+
+from django.conf import settings
+
+# attributes every LogRecord has, anything else was passed through extra=
+_RECORD_ATTRIBUTES = set(logging.makeLogRecord({}).__dict__) | {'message', 'asctime', 'taskName'}
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    One JSON object per line
+
+    Fields passed with extra= (event name, sizes, timings) are added next to
+    the standard ones, so the log can be filtered and aggregated by field.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        event = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        event.update(
+            (key, value) for key, value in record.__dict__.items() if key not in _RECORD_ATTRIBUTES
+        )
+        if record.exc_info:
+            event["exception"] = self.formatException(record.exc_info)
+        return json.dumps(event, default=str)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+    Hand records to a background thread that runs the real handlers
+
+    Configured through LOGGING with a "handlers" list, dictConfig creates
+    the listener and this handler starts it with the first record (again
+    in forked workers), so formatting and file I/O stay off the request
+    threads. Records are queued as they are, the queue never leaves the
+    process.
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self._listener_pid = None
+        self._start_lock = threading.Lock()
+        _queue_handlers.add(self)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if self._listener_pid != os.getpid():
+            self._start_listener()
+        super().emit(record)
+
+    def _start_listener(self) -> None:
+        with self._start_lock:
+            if self._listener_pid == os.getpid() or self.listener is None:
+                return
+            if self._listener_pid is None:
+                # the remaining records are written out before the process exits
+                atexit.register(self._stop_listener)
+            self.listener.start()
+            self._listener_pid = os.getpid()
+
+    def _stop_listener(self) -> None:
+        if self._listener_pid == os.getpid() and self.listener._thread is not None:
+            self.listener.stop()
+
+    def _reset_after_fork(self) -> None:
+        # the listener thread does not exist in a forked worker, and the
+        # queue may have been locked by one of the parent's threads
+        self.queue = queue.Queue()
+        self._start_lock = threading.Lock()
+        if self.listener is not None:
+            self.listener.queue = self.queue
+            self.listener._thread = None
+
+
+_queue_handlers = weakref.WeakSet()
+
+def _reset_after_fork():
+    for handler in list(_queue_handlers):
+        handler._reset_after_fork()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def sample_payload() -> bool:
+    """ Whether to log the full payload of this event, at LOG_PAYLOAD_SAMPLE_RATE """
+    rate = getattr(settings, 'LOG_PAYLOAD_SAMPLE_RATE', 0.0)
+    return rate > 0 and random.random() < rate
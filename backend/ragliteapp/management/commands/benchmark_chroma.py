@@ -0,0 +1,117 @@
+# ragliteapp/management/commands/benchmark_chroma.py
+import multiprocessing
+import os
+import resource
+import time
+from typing import Dict
+
+from django.core.management.base import BaseCommand, CommandError
+
+SAMPLE_QUERIES = [
+    "What is the main topic of the document?",
+    "Summarize the key findings",
+    "Which risks are mentioned?",
+    "What are the payment terms?",
+    "Who is responsible for maintenance?",
+    "List the deadlines in the agreement",
+    "How is the data stored and secured?",
+    "What does the warranty cover?",
+]
+
+
+def _run_worker(mode: str, queries: int, k: int, ready, results) -> None:
+    """ Run one worker process: open the vector store, then time its queries """
+    # the benchmark measures the store alone, skip the app start-up warm-up
+    os.environ['WARMUP_ON_STARTUP'] = 'False'
+    import django
+    django.setup()
+
+    from ragliteapp.vectordb_services import ChromaDBService
+
+    opened = time.perf_counter()
+    service = ChromaDBService(mode=mode)
+    service.warm_up()
+    open_seconds = time.perf_counter() - opened
+
+    # all workers start querying together so they contend like real traffic
+    ready.wait()
+    started = time.perf_counter()
+    for i in range(queries):
+        service.search_document_chunks(SAMPLE_QUERIES[i % len(SAMPLE_QUERIES)], k=k)
+    elapsed = time.perf_counter() - started
+
+    results.put({
+        "open_seconds": open_seconds,
+        "elapsed": elapsed,
+        "queries": queries,
+        # ru_maxrss is in kilobytes on Linux
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark vector store access from N worker processes. Reports per-worker "
+        "peak memory, total memory and aggregate query throughput for the embedded "
+        "and/or http ChromaDB modes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', default='1,2,4',
+            help='Comma separated worker counts to benchmark'
+        )
+        parser.add_argument(
+            '--modes', default='embedded,http',
+            help="Comma separated ChromaDB modes ('embedded', 'http')"
+        )
+        parser.add_argument('--queries', type=int, default=200, help='Queries per worker')
+        parser.add_argument('--k', type=int, default=3, help='Results per query')
+
+    def handle(self, *args, **options):
+        worker_counts = [int(count) for count in options['workers'].split(',')]
+        modes = options['modes'].split(',')
+        for mode in modes:
+            if mode not in ('embedded', 'http'):
+                raise CommandError(f"Unknown mode {mode}")
+
+        self.stdout.write(
+            f"{'mode':<10}{'workers':>8}{'open s':>10}{'rss/worker MB':>15}"
+            f"{'total rss MB':>14}{'queries/s':>12}{'mean ms':>9}"
+        )
+        for mode in modes:
+            for workers in worker_counts:
+                row = self._benchmark(mode, workers, options['queries'], options['k'])
+                self.stdout.write(
+                    f"{mode:<10}{workers:>8}{row['open_seconds']:>10.2f}{row['rss_per_worker']:>15.1f}"
+                    f"{row['total_rss']:>14.1f}{row['throughput']:>12.1f}{row['mean_latency_ms']:>9.1f}"
+                )
+
+    def _benchmark(self, mode: str, workers: int, queries: int, k: int) -> Dict:
+        """ Run one configuration in fresh (spawned) processes """
+        context = multiprocessing.get_context('spawn')
+        ready = context.Barrier(workers + 1)
+        results = context.Queue()
+        processes = [
+            context.Process(target=_run_worker, args=(mode, queries, k, ready, results))
+            for _ in range(workers)
+        ]
+        for process in processes:
+            process.start()
+
+        # released once every worker has opened its client
+        ready.wait()
+        rows = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+        wall = max(row['elapsed'] for row in rows)
+        total_queries = sum(row['queries'] for row in rows)
+        total_rss = sum(row['max_rss_mb'] for row in rows)
+        return {
+            "open_seconds": max(row['open_seconds'] for row in rows),
+            "rss_per_worker": total_rss / workers,
+            "total_rss": total_rss,
+            "throughput": total_queries / wall if wall else 0.0,
+            "mean_latency_ms": 1000 * sum(row['elapsed'] for row in rows) / total_queries,
+        }
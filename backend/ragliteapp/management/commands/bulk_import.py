@@ -0,0 +1,240 @@
+# ragliteapp/management/commands/bulk_import.py
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Tuple
+
+from django.conf import settings
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from ragliteapp.extractors import supported_extensions
+from ragliteapp.models import Document
+from ragliteapp.utils import calculate_file_hash, chunk_file
+from ragliteapp.vectordb_services import get_chroma_service
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Bulk import every supported file under a directory. "
+        "Files are deduplicated by hash, extracted and chunked in a process pool "
+        "and written to ChromaDB in large batches. Re-running the command with the "
+        "same checkpoint file resumes where the previous run stopped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Directory to import (walked recursively)')
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help='Number of processes used for hashing, extraction and chunking'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=200,
+            help='Number of files handled per batch (one dedupe query and one bulk_create per batch)'
+        )
+        parser.add_argument(
+            '--embed-batch-size', type=int, default=2000,
+            help='Number of chunks embedded and written to ChromaDB per call'
+        )
+        parser.add_argument(
+            '--checkpoint', default='bulk_import.checkpoint',
+            help='File recording imported paths, used to resume an interrupted import'
+        )
+
+    def handle(self, *args, **options):
+        directory = os.path.abspath(options['directory'])
+        if not os.path.isdir(directory):
+            raise CommandError(f"{directory} is not a directory")
+
+        checkpoint_path = options['checkpoint']
+        done = self._load_checkpoint(checkpoint_path)
+        # files changed since they were recorded go through the hash check again
+        paths = [path for path in self._walk(directory) if done.get(path) != self._signature(path)]
+        self.stdout.write(f"Found {len(paths)} files to import ({len(done)} already in checkpoint)")
+
+        totals = {'imported': 0, 'duplicates': 0, 'failed': 0, 'chunks': 0}
+        batch_size = options['batch_size']
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor, \
+                open(checkpoint_path, 'a') as checkpoint:
+            for start in range(0, len(paths), batch_size):
+                batch = paths[start:start + batch_size]
+                stats, completed = self._import_batch(executor, batch, options['embed_batch_size'])
+                for key, value in stats.items():
+                    totals[key] += value
+
+                # only files whose rows and chunks are persisted are recorded, failed ones are retried
+                checkpoint.write(''.join(f"{path}\t{self._signature(path)}\n" for path in completed))
+                checkpoint.flush()
+                self.stdout.write(
+                    f"[{start + len(batch)}/{len(paths)}] imported={totals['imported']} "
+                    f"duplicates={totals['duplicates']} failed={totals['failed']} chunks={totals['chunks']}"
+                )
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Bulk import finished: {totals['imported']} imported, {totals['duplicates']} duplicates, "
+            f"{totals['failed']} failed, {totals['chunks']} chunks"
+        ))
+
+    def _walk(self, directory: str) -> List[str]:
+        """ Collect supported files under the directory in a stable order """
+        extensions = supported_extensions()
+        paths = []
+        for root, _dirs, files in os.walk(directory):
+            for name in files:
+                if name.lower().endswith(extensions):
+                    paths.append(os.path.join(root, name))
+        paths.sort()
+        return paths
+
+    def _signature(self, path: str) -> str:
+        """ Modification time and size of a file, a file that changed is checked again """
+        stat = os.stat(path)
+        return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+    def _load_checkpoint(self, checkpoint_path: str) -> Dict[str, str]:
+        """ Read the paths imported by previous runs with their signature """
+        if not os.path.exists(checkpoint_path):
+            return {}
+        done = {}
+        with open(checkpoint_path) as f:
+            for line in f:
+                if line.strip():
+                    path, _, signature = line.rstrip('\n').partition('\t')
+                    done[path] = signature
+        return done
+
+    def _import_batch(
+        self, executor: ProcessPoolExecutor, paths: List[str], embed_batch_size: int
+    ) -> Tuple[Dict[str, int], List[str]]:
+        """
+        Import one batch of files
+
+        Flow:
+        1. Hash files in the process pool
+        2. Dedupe against Document.file_hash with a single query, documents left
+           'processing' or 'failed' by an interrupted run are imported again
+        3. Copy new files to storage and bulk_create Document rows
+        4. Extract and chunk in the process pool
+        5. Write chunks to ChromaDB in large batches
+        6. bulk_update document status and counts
+
+        Returns:
+            Tuple of (counts, paths whose document is completed, including duplicates)
+        """
+        stats = {'imported': 0, 'duplicates': 0, 'failed': 0, 'chunks': 0}
+
+        # Step 1: Hash files
+        hashes = list(executor.map(calculate_file_hash, paths, chunksize=16))
+
+        # Step 2: Dedupe against database and within the batch
+        existing = {
+            document.file_hash: document
+            for document in Document.objects.filter(file_hash__in=set(hashes))
+        }
+        new_files = {}
+        resumed = []
+        seen = set()
+        for path, file_hash in zip(paths, hashes):
+            document = existing.get(file_hash)
+            if file_hash in seen or (document is not None and document.status not in ('processing', 'failed')):
+                stats['duplicates'] += 1
+                continue
+            seen.add(file_hash)
+            if document is None:
+                new_files[file_hash] = path
+            else:
+                # created by a run that stopped before its chunks were stored
+                resumed.append((document, path))
+        completed = {
+            file_hash for file_hash, document in existing.items() if document.status not in ('processing', 'failed')
+        }
+        if not new_files and not resumed:
+            return stats, [path for path, file_hash in zip(paths, hashes) if file_hash in completed]
+
+        # Step 3: Store files and create documents
+        chroma_service = get_chroma_service()
+        documents = []
+        for file_hash, path in new_files.items():
+            document = Document(name=os.path.basename(path), file_hash=file_hash, status='processing')
+            with open(path, 'rb') as f:
+                document.file.save(document.name, File(f), save=False)
+            documents.append(document)
+        Document.objects.bulk_create(documents)
+        for document, path in resumed:
+            if not document.file or not os.path.exists(document.file.path):
+                with open(path, 'rb') as f:
+                    document.file.save(document.name, File(f), save=False)
+            # chunks written before the interruption would be stored twice
+            chroma_service.delete_document_chunks(str(document.id))
+            document.status = 'processing'
+            documents.append(document)
+        if resumed:
+            logger.info(f"Importing {len(resumed)} documents left unfinished by a previous run again")
+
+        # Step 4: Extract and chunk
+        pending_docs, pending_chunks, pending_metadatas, pending_ids = [], [], [], []
+
+        def flush():
+            # Step 5: Embed and store a large batch in ChromaDB
+            if not pending_chunks:
+                return
+            duplicates = {}
+            try:
+                chroma_service.add_document_chunks(pending_chunks, pending_metadatas, pending_ids, duplicates=duplicates)
+                for document in pending_docs:
+                    document.status = 'completed'
+                    document.duplicate_chunk_count = duplicates.get(str(document.id), 0)
+                stats['chunks'] += len(pending_chunks)
+            except Exception as e:
+                logger.error(f"Error storing {len(pending_chunks)} chunks in ChromaDB: {str(e)}")
+                for document in pending_docs:
+                    document.status = 'failed'
+            pending_docs.clear()
+            pending_chunks.clear()
+            pending_metadatas.clear()
+            pending_ids.clear()
+
+        futures = {
+            executor.submit(
+                chunk_file, document.file.path, str(document.id),
+                max_pages=getattr(settings, 'MAX_DOCUMENT_PAGES', None)
+            ): document
+            for document in documents
+        }
+        for future in as_completed(futures):
+            document = futures[future]
+            try:
+                chunks, metadatas, ids, file_stats = future.result()
+            except Exception as e:
+                logger.error(f"Error processing document {document.name}: {str(e)}")
+                document.status = 'failed'
+                continue
+            document.page_count = file_stats['pages']
+            document.chunk_count = len(chunks)
+            if not chunks:
+                document.status = 'completed'
+                continue
+            pending_docs.append(document)
+            pending_chunks.extend(chunks)
+            pending_metadatas.extend(metadatas)
+            pending_ids.extend(ids)
+            if len(pending_chunks) >= embed_batch_size:
+                flush()
+        flush()
+
+        # Step 6: Update document status
+        now = timezone.now()
+        for document in documents:
+            document.updated_at = now
+            if document.status == 'completed':
+                stats['imported'] += 1
+            else:
+                stats['failed'] += 1
+        Document.objects.bulk_update(
+            documents, ['file', 'status', 'page_count', 'chunk_count', 'duplicate_chunk_count', 'updated_at']
+        )
+        completed.update(document.file_hash for document in documents if document.status == 'completed')
+        return stats, [path for path, file_hash in zip(paths, hashes) if file_hash in completed]
@@ -0,0 +1,19 @@
+# ragliteapp/management/commands/compact_chunk_metadata.py
+from django.core.management.base import BaseCommand
+
+from ragliteapp.vectordb_services import get_chroma_service
+
+
+class Command(BaseCommand):
+    help = (
+        "Remove the file path and chunk type from the metadata of stored chunks. "
+        "Chunks stored before these were looked up from the Document table repeat "
+        "them; ids, documents and embeddings are kept. Safe to re-run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Chunks read and updated per call')
+
+    def handle(self, *args, **options):
+        rewritten = get_chroma_service().compact_chunk_metadata(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Compacted the metadata of {rewritten} chunks"))
@@ -0,0 +1,82 @@
+# ragliteapp/management/commands/dedup_chunks.py
+import json
+import statistics
+import time
+from typing import Dict, List
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ragliteapp.vectordb_services import get_chroma_service
+
+
+class Command(BaseCommand):
+    help = (
+        "Store near-duplicate document chunks once. Stored chunks are fingerprinted, "
+        "chunks within CHUNK_DEDUP MAX_DISTANCE bits of an earlier one are removed and "
+        "their documents linked to the kept chunk. Reports the index size saved and the retrieval latency measured "
+        "before and after. Safe to re-run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Chunks read and updated per call')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the near-duplicates')
+        parser.add_argument(
+            '--queries', type=int, default=50,
+            help='Searches timed before and after, with text of stored chunks as queries (0 to skip)'
+        )
+
+    def handle(self, *args, **options):
+        chroma_service = get_chroma_service()
+        queries = self._sample_queries(options['queries'])
+        before = self._time_searches(queries)
+        try:
+            result = chroma_service.deduplicate_chunks(options['batch_size'], dry_run=options['dry_run'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        after = self._time_searches(queries) if not options['dry_run'] else None
+
+        report = {
+            **result,
+            "dry_run": options['dry_run'],
+            "index": chroma_service.deduplication_stats(fresh=True),
+            "retrieval_ms": {"queries": len(queries), "before": before, "after": after},
+        }
+        self.stdout.write(json.dumps(report, indent=2))
+        self.stdout.write(self.style.SUCCESS(
+            f"{'Found' if options['dry_run'] else 'Removed'} {result['removed']} near-duplicate chunks "
+            f"of {result['scanned']}"
+        ))
+
+    def _sample_queries(self, count: int) -> List[str]:
+        """ Opening words of chunks spread over the first shard """
+        if count <= 0:
+            return []
+        collection = get_chroma_service().get_or_create_documents_collection(0)
+        step = max(1, collection.count() // count)
+        queries = []
+        for offset in range(0, step * count, step):
+            page = collection.get(include=["documents"], limit=1, offset=offset)
+            if not page['ids']:
+                break
+            queries.append(" ".join((page['documents'][0] or "").split()[:12]))
+        return [query for query in queries if query]
+
+    def _time_searches(self, queries: List[str]) -> Dict:
+        """ p50 / p95 / mean latency of searching every query once """
+        if not queries:
+            return None
+        chroma_service = get_chroma_service()
+        k = getattr(settings, 'RETRIEVAL_K', 3)
+        chroma_service.search_document_chunks(queries[0], k=k)
+        timings = []
+        for query in queries:
+            started = time.perf_counter()
+            chroma_service.search_document_chunks(query, k=k)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        return {
+            "p50": round(statistics.median(timings), 2),
+            "p95": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 2),
+            "mean": round(statistics.fmean(timings), 2),
+        }
@@ -0,0 +1,34 @@
+# ragliteapp/management/commands/prewarm_faqs.py
+import json
+
+from django.core.management.base import BaseCommand
+
+from ragliteapp.chat_writer import get_chat_writer
+from ragliteapp.models import Document
+from ragliteapp.prewarm import prewarm_document, prewarm_report
+
+
+class Command(BaseCommand):
+    help = (
+        "Pre-warm the semantic cache with generated FAQs of existing documents, "
+        "e.g. after a bulk import. Generations only run while this process has no "
+        "live traffic for the model. Prints the hit-rate report of the pre-warmed answers."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--document', action='append', default=[],
+            help='Document id to pre-warm, repeatable (default: every completed document)'
+        )
+        parser.add_argument('--report', action='store_true', help='Only print the hit-rate report')
+
+    def handle(self, *args, **options):
+        if not options['report']:
+            documents = Document.objects.filter(status='completed')
+            if options['document']:
+                documents = documents.filter(id__in=options['document'])
+            for document_id in documents.values_list('id', flat=True):
+                cached = prewarm_document(str(document_id))
+                self.stdout.write(f"  {document_id}: {cached} answers cached")
+            get_chat_writer().flush()
+        self.stdout.write(json.dumps(prewarm_report(), indent=2))
@@ -0,0 +1,34 @@
+# ragliteapp/management/commands/rebalance_shards.py
+from django.core.management.base import BaseCommand, CommandError
+
+from ragliteapp.vectordb_services import get_chroma_service
+
+
+class Command(BaseCommand):
+    help = (
+        "Move document chunks to their shard after DOCUMENT_SHARDS changed. "
+        "Chunks are copied with their stored embeddings and removed from the old "
+        "shard; collections of removed shards are dropped once empty. "
+        "Safe to re-run if interrupted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--from-shards', type=int, required=True,
+            help='Number of shards before the change'
+        )
+        parser.add_argument('--batch-size', type=int, default=500, help='Chunks moved per call')
+
+    def handle(self, *args, **options):
+        if options['from_shards'] < 1:
+            raise CommandError("--from-shards must be at least 1")
+        chroma_service = get_chroma_service()
+        self.stdout.write(
+            f"Rebalancing document chunks from {options['from_shards']} to {chroma_service.num_shards} shards"
+        )
+        moved = chroma_service.rebalance_shards(options['from_shards'], options['batch_size'])
+        for name, count in sorted(moved.items()):
+            self.stdout.write(f"  {name}: {count} chunks moved in")
+        for shard in chroma_service.get_collection_stats()['documents']['shards']:
+            self.stdout.write(f"  {shard['name']}: {shard['count']} chunks")
+        self.stdout.write(self.style.SUCCESS(f"Rebalance finished: {sum(moved.values())} chunks moved"))
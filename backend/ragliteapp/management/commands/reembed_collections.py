@@ -0,0 +1,51 @@
+# ragliteapp/management/commands/reembed_collections.py
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ragliteapp.vectordb_services import get_chroma_service
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-embed the document chunks and cached questions with another embedding "
+        "model into a new collection version while the current one keeps serving "
+        "queries, then switch over and drop the old collections. "
+        "Safe to re-run if interrupted, the build resumes."
+    )
+
+    def add_arguments(self, parser):
+        backfill = getattr(settings, 'EMBEDDING_BACKFILL', {})
+        parser.add_argument('--model', required=True, help='Embedding model of the new version')
+        parser.add_argument(
+            '--batch-size', type=int, default=backfill.get('BATCH_SIZE', 64),
+            help='Rows re-embedded per batch'
+        )
+        parser.add_argument(
+            '--pause', type=float, default=backfill.get('PAUSE', 0.5),
+            help='Seconds to sleep between batches'
+        )
+        parser.add_argument('--keep-old', action='store_true', help='Keep the collections of the old version')
+
+    def handle(self, *args, **options):
+        chroma_service = get_chroma_service()
+        active, building = chroma_service.get_versions()
+        if building is None and active.model_name == options['model']:
+            self.stdout.write(f"Embedding version {active.version} already uses {active.model_name}")
+            return
+        self.stdout.write(
+            f"Re-embedding from {active.model_name} (version {active.version}) to {options['model']}"
+            + (f", resuming version {building.version}" if building else "")
+        )
+        try:
+            version = chroma_service.reembed(
+                options['model'],
+                batch_size=options['batch_size'],
+                pause=options['pause'],
+                keep_old=options['keep_old']
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(
+            f"Embedding version {version.version} ({version.model_name}) is active: "
+            f"{version.embedded_chunks} chunks and {version.embedded_questions} cached questions"
+        ))
@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-19 08:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ragliteapp", "0002_chat_model"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chat",
+            name="invalidated_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
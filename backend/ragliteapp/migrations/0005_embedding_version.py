@@ -0,0 +1,32 @@
+# Generated by Django 6.0 on 2026-10-19 08:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ragliteapp", "0004_conversation"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EmbeddingVersion",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("version", models.PositiveIntegerField(unique=True)),
+                ("model_name", models.CharField(max_length=255)),
+                ("status", models.CharField(choices=[("building", "Building"), ("active", "Active"), ("retired", "Retired")], default="building", max_length=20)),
+                ("total_chunks", models.IntegerField(default=0)),
+                ("embedded_chunks", models.IntegerField(default=0)),
+                ("embedded_questions", models.IntegerField(default=0)),
+                ("error", models.TextField(blank=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("activated_at", models.DateTimeField(blank=True, null=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                "ordering": ["-version"],
+            },
+        ),
+    ]
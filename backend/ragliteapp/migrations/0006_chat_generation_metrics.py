@@ -0,0 +1,38 @@
+# Generated by Django 6.0 on 2026-10-19 08:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ragliteapp", "0005_embedding_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chat",
+            name="eval_count",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="chat",
+            name="eval_duration",
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="chat",
+            name="load_duration",
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="chat",
+            name="prompt_eval_count",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="chat",
+            name="prompt_eval_duration",
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-19 09:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ragliteapp", "0006_chat_generation_metrics"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chat",
+            name="prewarmed",
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-19 09:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ragliteapp", "0007_chat_prewarmed"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="document",
+            name="duplicate_chunk_count",
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -18,6 +18,7 @@ class Document(models.Model):
     # Meta data for the document
     page_count = models.IntegerField(null=True, blank=True)
     chunk_count = models.IntegerField(null=True, blank=True)
+    duplicate_chunk_count = models.IntegerField(default=0) # chunks linked to a stored duplicate instead of stored (CHUNK_DEDUP, dedup_chunks)
 
     # Timestamps
     created_at = models.DateTimeField(auto_now_add=True)
@@ -29,6 +30,25 @@ class Document(models.Model):
     def __str__(self):
         return self.name
 
+# ===== MODEL FOR GROUPING CHAT TURNS INTO CONVERSATIONS =====
+class Conversation(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    title = models.CharField(max_length=255, blank=True)
+
+    # rolling summary of the turns older than the history window, and how many turns it covers
+    summary = models.TextField(blank=True)
+    summarized_turns = models.IntegerField(default=0)
+
+    # timestamps
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return self.title or str(self.id)
+
 # ===== MODEL FOR TRACKING AND STORING CHAT CONVERSATIONS =====
 class Chat(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -39,11 +59,30 @@ class Chat(models.Model):
     
     # document reference
     documents = models.ManyToManyField(Document,related_name='chats')
+
+    # conversation the turn belongs to, None for standalone questions
+    conversation = models.ForeignKey(
+        Conversation, null=True, blank=True, on_delete=models.CASCADE, related_name='chats'
+    )
     
     # metadata for debugging
     source_chunks_metadata = models.JSONField(null=True, blank=True)
     similarity_score = models.FloatField(null=True, blank=True)
     model = models.CharField(max_length=20, null=True, blank=True)
+
+    # generation metrics reported by Ollama (token counts, durations in seconds),
+    # empty for answers served from a cache
+    prompt_eval_count = models.IntegerField(null=True, blank=True)
+    eval_count = models.IntegerField(null=True, blank=True)
+    prompt_eval_duration = models.FloatField(null=True, blank=True)
+    eval_duration = models.FloatField(null=True, blank=True)
+    load_duration = models.FloatField(null=True, blank=True)
+
+    # set when a source document is deleted or updated, the answer is no longer served from cache
+    invalidated_at = models.DateTimeField(null=True, blank=True)
+
+    # answered ahead of time from generated FAQs of a new document (see prewarm.py)
+    prewarmed = models.BooleanField(default=False)
     
     # timestamps
     created_at = models.DateTimeField(auto_now_add=True)
@@ -57,3 +96,32 @@ class Chat(models.Model):
     
     def __str__(self):
         return f"{self.question[:50]}..."
+
+# ===== MODEL FOR TRACKING WHICH EMBEDDING MODEL THE VECTOR COLLECTIONS USE =====
+class EmbeddingVersion(models.Model):
+    # version 1 owns the original unsuffixed collections, later versions get their own
+    version = models.PositiveIntegerField(unique=True)
+    model_name = models.CharField(max_length=255)
+    STATUS_CHOICES = (
+        ('building', 'Building'),
+        ('active', 'Active'),
+        ('retired', 'Retired'),
+    )
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='building')
+
+    # backfill progress of a building version, error of its last interrupted run
+    total_chunks = models.IntegerField(default=0)
+    embedded_chunks = models.IntegerField(default=0)
+    embedded_questions = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+
+    # timestamps
+    created_at = models.DateTimeField(auto_now_add=True)
+    activated_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-version']
+
+    def __str__(self):
+        return f"v{self.version} {self.model_name} ({self.status})"
@@ -0,0 +1,14 @@
+from rest_framework.pagination import CursorPagination
+
+
+class CreatedAtCursorPagination(CursorPagination):
+    """
+    Cursor pagination over the newest-first created_at ordering
+
+    Pages are fetched with an indexed range filter instead of OFFSET/COUNT,
+    so listing stays cheap however long the history grows.
+    """
+    ordering = '-created_at'
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
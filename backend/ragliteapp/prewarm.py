@@ -0,0 +1,219 @@
+# Idle-time pre-warming of the semantic cache with generated FAQs
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .admission import get_admission_controller
+from .chat_writer import get_chat_writer
+from .llm_services import GenerationError, get_llm_service
+from .models import Chat
+from .serializers import retrieval_options
+from .vectordb_services import get_chroma_service
+
+logger = logging.getLogger(__name__)
+
+def _options() -> Dict:
+    options = {
+        "ENABLED": False,
+        "MODEL": "llama3.2",
+        "SECTIONS": 5,
+        "QUESTIONS_PER_SECTION": 3,
+        "MAX_CONCURRENT": 1,
+        "IDLE_POLL_SECONDS": 2,
+        "ATTEMPTS": 5,
+    }
+    options.update(getattr(settings, 'FAQ_PREWARM', {}))
+    return options
+
+
+class _YieldToTraffic:
+    """
+    Cancel event of a pre-warm generation, set once live traffic wants the model
+
+    Pre-warm generations do not take admission slots, so any live
+    generation running or queued for the model aborts them, in this process
+    or in any other one sharing GENERATION_ACTIVITY_CACHE.
+    """
+
+    def __init__(self, model: str):
+        self.model = model
+
+    def is_set(self) -> bool:
+        return not get_admission_controller().is_idle(self.model)
+
+
+def _wait_until_idle(model: str, poll_seconds: float) -> None:
+    while not get_admission_controller().is_idle(model):
+        time.sleep(poll_seconds)
+
+
+def _sections(document_id: str, count: int) -> List[str]:
+    """ Chunks spread evenly over the document, in document order """
+    chroma_service = get_chroma_service()
+    rows = chroma_service.get_or_create_documents_collection(chroma_service.shard_for_document(document_id)).get(
+        where=chroma_service.document_filter(document_id), include=["documents", "metadatas"]
+    )
+    ordered = sorted(
+        zip(rows['documents'], rows['metadatas']),
+        key=lambda row: ((row[1] or {}).get("page", 0), (row[1] or {}).get("chunk_index", 0))
+    )
+    step = max(1, math.ceil(len(ordered) / count))
+    return [document for document, _ in ordered[::step][:count]]
+
+
+def prewarm_document(document_id: str) -> int:
+    """
+    Generate likely questions about a document and cache their answers
+
+    Runs only while the model has no live generations and gives way as soon
+    as one arrives, retrying once the model is idle again. Answers go
+    through the same retrieval as live queries and are saved as prewarmed
+    chats, which also adds their questions to the semantic cache.
+
+    Args:
+        document_id: UUID of the document
+
+    Returns:
+        Number of answers cached
+    """
+    options = _options()
+    model = options["MODEL"]
+    yield_event = _YieldToTraffic(model)
+    llm_service = get_llm_service()
+    chroma_service = get_chroma_service()
+    # the same retrieval defaults a live query without options gets
+    retrieval = retrieval_options({})
+
+    def run(generate):
+        for _ in range(options["ATTEMPTS"]):
+            _wait_until_idle(model, options["IDLE_POLL_SECONDS"])
+            result = generate()
+            if result is not None or not yield_event.is_set():
+                return result
+        return None
+
+    cached = 0
+    seen = set()
+    for section in _sections(str(document_id), options["SECTIONS"]):
+        questions = run(lambda: llm_service.generate_questions(
+            section, options["QUESTIONS_PER_SECTION"], model_name=model, cancel_event=yield_event
+        ) or None) or []
+        for question in questions:
+            if question.lower() in seen or Chat.objects.filter(question__iexact=question).exists():
+                continue
+            seen.add(question.lower())
+            search_results = chroma_service.search_document_chunks(question, **retrieval)
+            chunks, metadatas = search_results['documents'][0], search_results['metadatas'][0]
+            if not chunks:
+                continue
+            metrics = {}
+            try:
+                answer = run(lambda: llm_service.generate_answer(
+                    question,
+                    "\n\n---\n\n".join(chunks),
+                    model_name=model,
+                    deadline=getattr(settings, 'GENERATION_DEADLINE', None),
+                    cancel_event=yield_event,
+                    metrics=metrics
+                ))
+            except GenerationError:
+                continue
+            if not answer:
+                continue
+            chat = Chat(
+                question=question,
+                answer=answer,
+                model=model,
+                source_chunks_metadata=metadatas,
+                prewarmed=True,
+                **metrics
+            )
+            document_ids = {str(document_id)}
+            document_ids.update(metadata['document_id'] for metadata in metadatas if metadata.get('document_id'))
+            get_chat_writer().submit(chat, sorted(document_ids))
+            cached += 1
+    logger.info(f"Pre-warmed {cached} answers for document {document_id}")
+    return cached
+
+
+def _run(document_id: str) -> None:
+    try:
+        close_old_connections()
+        prewarm_document(document_id)
+    except Exception as e:
+        logger.error(f"Pre-warming document {document_id} failed: {str(e)}")
+    finally:
+        with _pending_lock:
+            _pending.discard(document_id)
+        close_old_connections()
+
+
+# documents are pre-warmed in the background, at most MAX_CONCURRENT at a time
+_executor = None
+_pending = set()
+_pending_lock = threading.Lock()
+
+def _reset_after_fork():
+    # the executor threads do not exist in a forked worker
+    global _executor, _pending_lock
+    _executor = None
+    _pending.clear()
+    _pending_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def schedule_prewarm(document_id: str) -> None:
+    """ Queue a newly ingested document for pre-warming, if FAQ_PREWARM is enabled """
+    global _executor
+    options = _options()
+    if not options["ENABLED"]:
+        return
+    document_id = str(document_id)
+    with _pending_lock:
+        if document_id in _pending:
+            return
+        _pending.add(document_id)
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=options["MAX_CONCURRENT"], thread_name_prefix='faq-prewarm')
+    _executor.submit(_run, document_id)
+
+
+def prewarm_report() -> Dict:
+    """
+    Hit rate of the pre-warmed answers
+
+    Hits are the cache hits recorded on the cached questions, exact and
+    similar matches alike.
+
+    Returns:
+        Dict with the number of prewarmed answers still served, how many of
+        them were hit at least once, total hits and the hit rate
+    """
+    chat_ids = [
+        str(chat_id) for chat_id in
+        Chat.objects.filter(prewarmed=True, invalidated_at__isnull=True).values_list('id', flat=True)
+    ]
+    collection = get_chroma_service().get_or_create_queries_collection()
+    cached = hit = hits = 0
+    for start in range(0, len(chat_ids), 500):
+        entries = collection.get(ids=chat_ids[start:start + 500], include=["metadatas"])
+        for metadata in entries['metadatas']:
+            hit_count = (metadata or {}).get("hit_count", 0)
+            cached += 1
+            hits += hit_count
+            hit += hit_count > 0
+    return {
+        "prewarmed": len(chat_ids),
+        "cached": cached,
+        "hit": hit,
+        "hits": hits,
+        "hit_rate": round(hit / cached, 4) if cached else 0.0,
+        "pending_documents": len(_pending),
+    }
@@ -0,0 +1,359 @@
+# On-demand profiling of single API requests (REQUEST_PROFILING)
+import cProfile
+import json
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils import timezone
+from rest_framework import exceptions
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+logger = logging.getLogger(__name__)
+
+# profile ids are uuid4 hex, anything else never reaches the file system
+_profile_id_re = re.compile(r"^[0-9a-f]{32}$")
+
+# cProfile hooks the whole interpreter (Python 3.12), so only one request is profiled with it at a time
+_cprofile_lock = threading.Lock()
+
+
+def _options() -> Dict:
+    options = {
+        "ENABLED": False,
+        "PATH": os.path.join(settings.BASE_DIR, "profiles"),
+        "HEADER": "X-Profile",
+        "QUERY_PARAM": "profile",
+        "SAMPLE_INTERVAL": 0.001,
+        "MAX_PROFILES": 100,
+    }
+    options.update(getattr(settings, 'REQUEST_PROFILING', {}))
+    return options
+
+
+class _SamplingProfiler:
+    """
+    Record the stack of one thread every interval seconds
+
+    Cheaper than cProfile on long requests and blind to other threads, so
+    concurrent requests can be sampled at the same time. Stacks are kept in
+    time order for the speedscope export.
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.frames = []
+        self.samples = []
+        self.weights = []
+        self._frame_ids = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            now = time.perf_counter()
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                key = (code.co_qualname, code.co_filename, code.co_firstlineno)
+                if key not in self._frame_ids:
+                    self._frame_ids[key] = len(self.frames)
+                    self.frames.append({"name": key[0], "file": key[1], "line": key[2]})
+                stack.append(self._frame_ids[key])
+                frame = frame.f_back
+            if stack:
+                # speedscope wants the outermost frame first
+                self.samples.append(stack[::-1])
+                self.weights.append(now - last)
+            last = now
+
+    def speedscope(self, name: str) -> Dict:
+        """ The samples in speedscope's file format """
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "raglite",
+            "shared": {"frames": self.frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": name,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(self.weights),
+                "samples": self.samples,
+                "weights": self.weights,
+            }],
+        }
+
+
+class _RequestProfile:
+    """ One profiled request: the profiler running it and where the result is stored """
+
+    def __init__(self, profiler: str, options: Dict):
+        self.id = uuid.uuid4().hex
+        self.options = options
+        self.profiler = profiler
+        if profiler == "cprofile":
+            self._profiler = cProfile.Profile()
+        else:
+            self._profiler = _SamplingProfiler(threading.get_ident(), options["SAMPLE_INTERVAL"])
+        self._started = time.perf_counter()
+        self._saved = False
+
+    def start(self) -> None:
+        if self.profiler == "cprofile":
+            self._profiler.enable()
+        else:
+            self._profiler.start()
+
+    def pause(self) -> None:
+        if self.profiler == "cprofile":
+            self._profiler.disable()
+
+    def resume(self) -> None:
+        if self.profiler == "cprofile":
+            self._profiler.enable()
+
+    def finish(self, request, status_code: int) -> None:
+        """ Stop profiling and write the profile with its request details """
+        if self._saved:
+            return
+        self._saved = True
+        duration = time.perf_counter() - self._started
+        try:
+            if self.profiler == "cprofile":
+                self._profiler.disable()
+            else:
+                self._profiler.stop()
+        finally:
+            if self.profiler == "cprofile":
+                _cprofile_lock.release()
+        try:
+            os.makedirs(self.options["PATH"], exist_ok=True)
+            name = f"{request.method} {request.path}"
+            if self.profiler == "cprofile":
+                file_name = f"{self.id}.prof"
+                self._profiler.dump_stats(os.path.join(self.options["PATH"], file_name))
+            else:
+                file_name = f"{self.id}.speedscope.json"
+                with open(os.path.join(self.options["PATH"], file_name), "w") as f:
+                    json.dump(self._profiler.speedscope(name), f)
+            user = getattr(request, 'user', None)
+            with open(os.path.join(self.options["PATH"], f"{self.id}.json"), "w") as f:
+                json.dump({
+                    "id": self.id,
+                    "method": request.method,
+                    "path": request.path,
+                    "status": status_code,
+                    "profiler": self.profiler,
+                    "duration_ms": round(duration * 1000, 2),
+                    "user": user.get_username() if user is not None and user.is_authenticated else None,
+                    "created_at": timezone.now().isoformat(),
+                    "file": file_name,
+                }, f)
+            logger.info(
+                f"Profiled {name} as {self.id}",
+                extra={"event": "request_profile", "profile_id": self.id, "profiler": self.profiler,
+                       "elapsed_ms": round(duration * 1000, 2)}
+            )
+            _prune(self.options)
+        except OSError as e:
+            logger.error(f"Storing profile {self.id} failed: {str(e)}")
+
+
+def _prune(options: Dict) -> None:
+    """ Keep the newest MAX_PROFILES profiles """
+    for profile in list_profiles()[options["MAX_PROFILES"]:]:
+        for file_name in (profile["file"], f"{profile['id']}.json"):
+            try:
+                os.remove(os.path.join(options["PATH"], file_name))
+            except OSError:
+                pass
+
+
+def _is_admin(request) -> bool:
+    """ Whether the request comes from a staff user, with session or API (basic) authentication """
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return user.is_staff
+    # API clients authenticate per request, which DRF only does once the view runs
+    drf_request = Request(request)
+    for authentication_class in api_settings.DEFAULT_AUTHENTICATION_CLASSES:
+        try:
+            result = authentication_class().authenticate(drf_request)
+        except exceptions.APIException:
+            return False
+        if result is not None:
+            return result[0].is_staff
+    return False
+
+
+class ProfilingMiddleware:
+    """
+    Profile single requests on demand
+
+    Staff users add the X-Profile header or the ?profile= flag (names set in
+    REQUEST_PROFILING): "sample" runs the request under the stack sampler
+    (stored for speedscope), any other value under cProfile (stored as
+    pstats). The profile id is returned in the X-Profile-Id header and the
+    hottest functions are listed at /ragengine/profiles/<id>/. Flags of other
+    users are ignored. Without REQUEST_PROFILING.ENABLED the middleware
+    removes itself from the chain, so requests pay nothing.
+    """
+
+    def __init__(self, get_response):
+        self.options = _options()
+        if not self.options["ENABLED"]:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.header = "HTTP_" + self.options["HEADER"].upper().replace("-", "_")
+
+    def __call__(self, request):
+        flag = request.META.get(self.header) or request.GET.get(self.options["QUERY_PARAM"])
+        if not flag or not _is_admin(request):
+            return self.get_response(request)
+
+        profiler = "sample" if flag.lower() == "sample" else "cprofile"
+        if profiler == "cprofile" and not _cprofile_lock.acquire(blocking=False):
+            # another request holds cProfile, sample this one instead
+            profiler = "sample"
+        profile = _RequestProfile(profiler, self.options)
+        try:
+            profile.start()
+        except ValueError:
+            # a debugger or coverage run holds the profiling hook
+            _cprofile_lock.release()
+            profile = _RequestProfile("sample", self.options)
+            profile.start()
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            profile.finish(request, 500)
+            raise
+        profile.pause()
+        response["X-Profile-Id"] = profile.id
+
+        if response.streaming and not getattr(response, 'is_async', False):
+            # streamed answers are generated while the server sends them
+            response.streaming_content = self._profile_stream(response.streaming_content, profile, request, response)
+        else:
+            profile.finish(request, response.status_code)
+        return response
+
+    def _profile_stream(self, content, profile: _RequestProfile, request, response):
+        iterator = iter(content)
+        try:
+            while True:
+                profile.resume()
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    profile.pause()
+                yield chunk
+        finally:
+            profile.finish(request, response.status_code)
+
+
+def list_profiles() -> List[Dict]:
+    """
+    Stored profiles, newest first
+
+    Returns:
+        Request details of every profile (id, method, path, status, profiler, duration_ms, user, created_at, file)
+    """
+    path = _options()["PATH"]
+    if not os.path.isdir(path):
+        return []
+    profiles = []
+    for file_name in os.listdir(path):
+        if not file_name.endswith(".json") or not _profile_id_re.match(file_name[:-5]):
+            continue
+        try:
+            with open(os.path.join(path, file_name)) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    profiles.sort(key=lambda profile: profile.get("created_at", ""), reverse=True)
+    return profiles
+
+
+def get_profile(profile_id: str) -> Optional[Dict]:
+    """ Request details of a stored profile, with the path of its file as file_path, None if there is none """
+    if not _profile_id_re.match(profile_id or ""):
+        return None
+    path = _options()["PATH"]
+    try:
+        with open(os.path.join(path, f"{profile_id}.json")) as f:
+            profile = json.load(f)
+    except (OSError, ValueError):
+        return None
+    profile["file_path"] = os.path.join(path, profile["file"])
+    return profile
+
+
+def hottest_functions(profile: Dict, limit: int = 30, sort: str = "self") -> List[Dict]:
+    """
+    Functions of a stored profile that took the most time
+
+    Args:
+        profile: Profile from get_profile
+        limit: Number of functions returned
+        sort: "self" (time in the function itself) or "total" (including callees)
+
+    Returns:
+        List of {function, file, line, calls, self_seconds, total_seconds},
+        calls is None for sampled profiles
+    """
+    functions = []
+    if profile["profiler"] == "cprofile":
+        for (file_name, line, name), (_, calls, self_time, total_time, _) in pstats.Stats(profile["file_path"]).stats.items():
+            functions.append({
+                "function": name, "file": file_name, "line": line, "calls": calls,
+                "self_seconds": self_time, "total_seconds": total_time,
+            })
+    else:
+        with open(profile["file_path"]) as f:
+            speedscope = json.load(f)
+        frames = speedscope["shared"]["frames"]
+        sampled = speedscope["profiles"][0]
+        self_time = defaultdict(float)
+        total_time = defaultdict(float)
+        for stack, weight in zip(sampled["samples"], sampled["weights"]):
+            self_time[stack[-1]] += weight
+            # recursive frames count once per sample
+            for frame in set(stack):
+                total_time[frame] += weight
+        for frame, total in total_time.items():
+            functions.append({
+                "function": frames[frame]["name"], "file": frames[frame]["file"], "line": frames[frame]["line"],
+                "calls": None, "self_seconds": self_time[frame], "total_seconds": total,
+            })
+    key = "total_seconds" if sort == "total" else "self_seconds"
+    functions.sort(key=lambda function: function[key], reverse=True)
+    for function in functions:
+        function["self_seconds"] = round(function["self_seconds"], 6)
+        function["total_seconds"] = round(function["total_seconds"], 6)
+    return functions[:limit]
@@ -1,11 +1,13 @@
+from django.conf import settings
 from rest_framework import serializers
-from .models import Document, Chat
+from .models import Document, Chat, Conversation
+from .extractors import is_supported, supported_extensions, supported_mime_types
 
 class DocumentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Document
         fields = '__all__'
-        read_only_fields = ['id', 'created_at', 'updated_at','file_hash','status','page_count','chunk_count']
+        read_only_fields = ['id', 'created_at', 'updated_at','file_hash','status','page_count','chunk_count','duplicate_chunk_count']
 
 class ChatSerializer(serializers.ModelSerializer):
     documents = DocumentSerializer(many=True, read_only=True)
@@ -14,24 +16,62 @@ class ChatSerializer(serializers.ModelSerializer):
         fields = '__all__'
         read_only_fields = ['id', 'created_at', 'updated_at']
 
+class ChatListSerializer(serializers.ModelSerializer):
+    # slim serializer for chat history lists, leaves out source_chunks_metadata
+    # and nested documents (only their ids, served from prefetch_related)
+    documents = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
+    class Meta:
+        model = Chat
+        fields = ['id', 'question', 'answer', 'model', 'similarity_score', 'documents', 'conversation', 'created_at']
+        read_only_fields = fields
+
+class ConversationSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Conversation
+        fields = '__all__'
+        read_only_fields = ['id', 'summary', 'summarized_turns', 'created_at', 'updated_at']
+
 class DocumentUploadSerializer(serializers.Serializer):
     # serializer for document upload
     file = serializers.FileField()
 
     def validate_file(self, value):
-        if not (value.name.endswith('.pdf') or value.name.endswith('.txt')):
-            raise serializers.ValidationError("File must be a PDF or TXT")
-        return value
+        # files without a known extension are accepted by their MIME type
+        if not is_supported(value.name, getattr(value, 'content_type', None)):
+            raise serializers.ValidationError(
+                f"File must be one of: {', '.join(supported_extensions() + supported_mime_types())}"
+            )
 
-        if value.size > 15 * 1024 * 1024:
-            raise serializers.ValidationError("File size should be less than 15MB")
+        max_size = getattr(settings, 'MAX_UPLOAD_SIZE', 15 * 1024 * 1024)
+        if value.size > max_size:
+            raise serializers.ValidationError(f"File size should be less than {max_size // (1024 * 1024)}MB")
         return value
-class QuerySerializer(serializers.Serializer):
+class RetrievalOptionsSerializer(serializers.Serializer):
+    # retrieval options shared by the query endpoints, defaults come from settings
+    k = serializers.IntegerField(min_value=1, max_value=20, required=False)
+    max_distance = serializers.FloatField(min_value=0.0, required=False)
+    mmr = serializers.BooleanField(required=False)
+
+def retrieval_options(validated_data) -> dict:
+    """ Search keyword arguments from the query options, falling back to settings """
+    mmr = validated_data.get('mmr', getattr(settings, 'RETRIEVAL_MMR', True))
+    return {
+        'k': validated_data.get('k', getattr(settings, 'RETRIEVAL_K', 3)),
+        'max_distance': validated_data.get('max_distance', getattr(settings, 'RETRIEVAL_MAX_DISTANCE', None)),
+        'mmr_lambda': getattr(settings, 'RETRIEVAL_MMR_LAMBDA', 0.5) if mmr else None,
+        'token_budget': getattr(settings, 'CONTEXT_TOKEN_BUDGET', None),
+    }
+
+class QuerySerializer(RetrievalOptionsSerializer):
     # serializer for query requests
     query = serializers.CharField(max_length=1000, required=False)
     question = serializers.CharField(max_length=1000, required=False)
     document_id = serializers.UUIDField(required=False)
+    conversation_id = serializers.UUIDField(required=False)
     model = serializers.CharField(max_length=50, required=False)
+    temperature = serializers.FloatField(min_value=0.0, max_value=2.0, required=False)
+    # answer as NDJSON, a client that closes the connection aborts the generation
+    stream = serializers.BooleanField(default=False)
 
     def validate(self, data):
         if not data.get('query') and not data.get('question'):
@@ -41,4 +81,23 @@ class QuerySerializer(serializers.Serializer):
         if not value.strip():
             raise serializers.ValidationError("Query cannot be empty")
         return value
-            
\ No newline at end of file
+            
+
+class BatchQuerySerializer(RetrievalOptionsSerializer):
+    # serializer for batch query requests, e.g. evaluation runs
+    queries = serializers.ListField(
+        child=serializers.CharField(max_length=1000),
+        allow_empty=False
+    )
+    document_id = serializers.UUIDField(required=False)
+    model = serializers.CharField(max_length=50, required=False)
+    temperature = serializers.FloatField(min_value=0.0, max_value=2.0, required=False)
+    stream = serializers.BooleanField(default=False)
+
+    def validate_queries(self, value):
+        max_questions = getattr(settings, 'BATCH_QUERY_MAX_QUESTIONS', 5000)
+        if len(value) > max_questions:
+            raise serializers.ValidationError(f"At most {max_questions} queries per batch")
+        if any(not query.strip() for query in value):
+            raise serializers.ValidationError("Queries cannot be empty")
+        return value
@@ -0,0 +1,80 @@
+# Request coalescing for identical in-flight work
+import threading
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """
+    Collapse concurrent calls that share a key into a single execution
+
+    The first caller (the leader) runs the function, callers arriving while it
+    is still running (followers) block until it finishes and receive the same
+    result, or the same exception. Keys are forgotten once the call completes,
+    so this is deduplication of in-flight work only, not a cache.
+    Coalescing is per process; each worker leads its own calls.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        Run fn once for all concurrent callers with the same key
+
+        Args:
+            key: Identity of the work
+            fn: Function producing the result
+
+        Returns:
+            Tuple of (result, shared) where shared is True for followers
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                call.followers += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def followers(self, key: Hashable) -> int:
+        """ Number of callers that joined the in-flight call of a key, 0 when none is running """
+        with self._lock:
+            call = self._calls.get(key)
+            return call.followers if call is not None else 0
+
+    def running(self, key: Hashable) -> bool:
+        """ Whether a call of the key is in flight, a call made now would most likely follow it """
+        with self._lock:
+            return key in self._calls
+
+    def in_flight(self) -> int:
+        """ Number of keys currently being computed """
+        with self._lock:
+            return len(self._calls)
@@ -1,3 +1,1518 @@
-from django.test import TestCase
+import atexit
+import importlib.util
+import io
+import json
+import logging
+import logging.handlers
+import os
+import pathlib
+import queue
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import chat_writer, extractors, warmup
+from .admission import AdmissionController, AdmissionRejected
+from .chat_writer import ChatWriter, get_chat_writer
+from .conversations import _window_start, get_history, update_summary
+from .extractors import (
+    DocumentTooLargeError, extract_docx_sections, extract_html_sections, extract_markdown_sections,
+    extract_text_file, get_extractor, is_supported
+)
+from .llm_cache import LLMResponseCache
+from .llm_services import LLMService
+from .logging_utils import JSONFormatter, QueueHandler, sample_payload
+from .models import Chat, Conversation, Document
+from .prewarm import prewarm_document, prewarm_report
+from .serializers import QuerySerializer, retrieval_options
+from .singleflight import SingleFlight
+from .upload_handlers import MULTIPART_OVERHEAD, MaxSizeUploadHandler
+from .utils import chunk_file, hamming_distance, normalized_text_hash, simhash, simhash_bands, simhash_from_bands
+from .vectordb_services import ChromaDBService, _FingerprintIndex, jump_consistent_hash, mmr_order, select_chunks
+from .vectorstores import FaissClient, _where_to_sql
+from .views import ChatViewSet, DocumentViewSet, _query_flights, normalize_query
+
+
+class JumpConsistentHashTests(SimpleTestCase):
+    keys = [(i * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF for i in range(2000)]
+
+    def test_bucket_in_range_and_deterministic(self):
+        for buckets in (1, 2, 7, 16):
+            for key in self.keys[:200]:
+                bucket = jump_consistent_hash(key, buckets)
+                self.assertTrue(0 <= bucket < buckets)
+                self.assertEqual(bucket, jump_consistent_hash(key, buckets))
+
+    def test_single_bucket(self):
+        self.assertEqual({jump_consistent_hash(key, 1) for key in self.keys}, {0})
+
+    def test_growing_only_moves_keys_to_the_new_bucket(self):
+        for buckets in (1, 3, 8):
+            moved = 0
+            for key in self.keys:
+                before, after = jump_consistent_hash(key, buckets), jump_consistent_hash(key, buckets + 1)
+                if before != after:
+                    self.assertEqual(after, buckets)
+                    moved += 1
+            # about 1 / (buckets + 1) of the keys move
+            self.assertAlmostEqual(moved / len(self.keys), 1 / (buckets + 1), delta=0.05)
+
+    def test_keys_spread_evenly(self):
+        counts = [0] * 4
+        for key in self.keys:
+            counts[jump_consistent_hash(key, 4)] += 1
+        for count in counts:
+            self.assertAlmostEqual(count / len(self.keys), 0.25, delta=0.05)
+
+
+class SimHashTests(SimpleTestCase):
+    footer = (
+        "This report is confidential and intended only for the named recipient. "
+        "Do not copy or forward it without written permission of the author. Page 3 of 12"
+    )
+
+    def test_same_words_same_fingerprint(self):
+        self.assertEqual(simhash(self.footer), simhash(self.footer.upper().replace(".", " ")))
+        self.assertEqual(simhash(""), 0)
+
+    def test_small_edit_is_close_unrelated_text_is_far(self):
+        edited = self.footer.replace("Page 3", "Page 4")
+        unrelated = "Quarterly revenue grew by twelve percent on strong widget sales in the northern region."
+        self.assertLess(hamming_distance(simhash(self.footer), simhash(edited)), 16)
+        self.assertGreater(hamming_distance(simhash(self.footer), simhash(unrelated)), 16)
+
+    def test_bands_round_trip(self):
+        generator = random.Random(48)
+        for fingerprint in [0, 2 ** 64 - 1] + [generator.getrandbits(64) for _ in range(500)]:
+            bands = simhash_bands(fingerprint)
+            self.assertEqual(len(bands), 4)
+            self.assertEqual(simhash_from_bands(bands), fingerprint)
+            # bands are tagged with their position, so equal values in different bands differ
+            self.assertEqual(len(set(bands)), 4)
+
+    def test_close_fingerprints_share_a_band(self):
+        generator = random.Random(3)
+        for _ in range(500):
+            fingerprint = generator.getrandbits(64)
+            near = fingerprint
+            for bit in generator.sample(range(64), 3):
+                near ^= 1 << bit
+            self.assertTrue(set(simhash_bands(fingerprint)) & set(simhash_bands(near)))
+
+    def test_fingerprint_index(self):
+        index = _FingerprintIndex(max_distance=3)
+        index.add("a", 0b1111 << 40)
+        self.assertEqual(index.find((0b1111 << 40) ^ 0b111), "a")
+        self.assertIsNone(index.find((0b1111 << 40) ^ 0b1111))
+
+    def test_normalized_text_hash(self):
+        self.assertEqual(normalized_text_hash("Hello,  World!"), normalized_text_hash("hello world"))
+        self.assertNotEqual(normalized_text_hash("hello world"), normalized_text_hash("hello there"))
+
+
+class ChunkSelectionTests(SimpleTestCase):
+    # candidates 0 and 1 are the same chunk, 2 is farther from the query but different
+    embeddings = np.array([[1.0, 0.0], [1.0, 0.0], [0.6, 0.8]], dtype=np.float32)
+    distances = np.array([0.1, 0.1, 0.8], dtype=np.float32)
+
+    def test_mmr_relevance_only_keeps_distance_order(self):
+        self.assertEqual(mmr_order(self.embeddings, self.distances, 1.0), [0, 1, 2])
+
+    def test_mmr_prefers_a_different_chunk_over_a_duplicate(self):
+        self.assertEqual(mmr_order(self.embeddings, self.distances, 0.5), [0, 2, 1])
+
+    def test_select_top_k(self):
+        self.assertEqual(select_chunks(["a", "b", "c", "d"], [0.1, 0.2, 0.3, 0.4], k=2), [0, 1])
+
+    def test_select_drops_candidates_past_max_distance(self):
+        self.assertEqual(select_chunks(["a", "b", "c"], [0.1, 0.5, 0.9], k=3, max_distance=0.5), [0, 1])
+        self.assertEqual(select_chunks(["a"], [0.9], k=3, max_distance=0.5), [])
+
+    def test_select_with_mmr(self):
+        selected = select_chunks(["a", "a", "b"], list(self.distances), self.embeddings, k=2, mmr_lambda=0.5)
+        self.assertEqual(selected, [0, 2])
+
+    def test_select_within_token_budget(self):
+        documents = ["x" * 400, "y" * 4000, "z" * 400]
+        # the oversized second chunk is skipped, the smaller third one still fits
+        self.assertEqual(select_chunks(documents, [0.1, 0.2, 0.3], k=3, token_budget=250), [0, 2])
+        # the best chunk is kept even when it alone exceeds the budget
+        self.assertEqual(select_chunks(documents[1:], [0.1, 0.2], k=3, token_budget=10), [0])
+
+
+class WhereToSqlTests(SimpleTestCase):
+    rows = {
+        "a": {"document_id": "d1", "page": 1},
+        "b": {"document_id": "d2", "page": 2, "document_ids": ["d2", "d1"]},
+        "c": {"document_id": "d3", "page": 3, "simhash": [7, 65543]},
+    }
+
+    def setUp(self):
+        self.db = sqlite3.connect(":memory:")
+        self.db.execute("CREATE TABLE rows (id TEXT, metadata TEXT)")
+        self.db.executemany("INSERT INTO rows VALUES (?, ?)", [(key, json.dumps(value)) for key, value in self.rows.items()])
+
+    def tearDown(self):
+        self.db.close()
+
+    def matching(self, where):
+        sql, params = _where_to_sql(where)
+        return sorted(row[0] for row in self.db.execute(f"SELECT id FROM rows WHERE {sql}", params))
+
+    def test_no_filter(self):
+        self.assertEqual(_where_to_sql(None), ("1", []))
+        self.assertEqual(self.matching({}), ["a", "b", "c"])
+
+    def test_equality_and_comparisons(self):
+        self.assertEqual(self.matching({"document_id": "d1"}), ["a"])
+        self.assertEqual(self.matching({"page": {"$ne": 2}}), ["a", "c"])
+        self.assertEqual(self.matching({"page": {"$gte": 2, "$lt": 3}}), ["b"])
+
+    def test_in_and_nin(self):
+        self.assertEqual(self.matching({"document_id": {"$in": ["d1", "d3"]}}), ["a", "c"])
+        self.assertEqual(self.matching({"document_id": {"$nin": ["d1"]}}), ["b", "c"])
+        self.assertEqual(self.matching({"document_id": {"$in": []}}), [])
+        self.assertEqual(self.matching({"document_id": {"$nin": []}}), ["a", "b", "c"])
+
+    def test_contains_list_values(self):
+        self.assertEqual(self.matching({"document_ids": {"$contains": "d1"}}), ["b"])
+        self.assertEqual(self.matching({"simhash": {"$contains": 65543}}), ["c"])
+        # rows without the key never match
+        self.assertEqual(self.matching({"document_ids": {"$contains": "d3"}}), [])
+
+    def test_and_or(self):
+        document_filter = {"$or": [{"document_id": "d1"}, {"document_ids": {"$contains": "d1"}}]}
+        self.assertEqual(self.matching(document_filter), ["a", "b"])
+        self.assertEqual(self.matching({"$and": [document_filter, {"page": {"$gt": 1}}]}), ["b"])
+
+    def test_unsupported_operator(self):
+        with self.assertRaises(ValueError):
+            _where_to_sql({"page": {"$regex": "1"}})
+
+
+@skipUnless(importlib.util.find_spec("faiss"), "faiss-cpu is not installed")
+class FaissCollectionTests(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path, ignore_errors=True)
+        self.client = self.open_client()
+        self.collection = self.client.get_or_create_collection("chunks")
+
+    def open_client(self):
+        client = FaissClient(self.path, index_type='flat', persist_every=3)
+        self.addCleanup(atexit.unregister, client.close)
+        return client
+
+    def add(self, collection, *ids):
+        collection.add(
+            ids=list(ids), documents=[f"text {row_id}" for row_id in ids],
+            metadatas=[{"row": row_id} for row_id in ids],
+            embeddings=[[float(i), 1.0] for i, _ in enumerate(ids, start=collection.count())]
+        )
+
+    def index_version(self, collection):
+        return collection._info('index_version', 0)
+
+    def test_unfiltered_delete_is_refused(self):
+        self.add(self.collection, "a", "b")
+        with self.assertRaises(ValueError):
+            self.collection.delete()
+        self.collection.delete(ids=[])
+        self.assertEqual(self.collection.count(), 2)
+
+    def test_get_offset_without_limit(self):
+        self.add(self.collection, "a", "b", "c", "d")
+        self.assertEqual(self.collection.get(offset=2, include=[])['ids'], ["c", "d"])
+        self.assertEqual(self.collection.get(offset=1, limit=2, include=[])['ids'], ["b", "c"])
+
+    def test_failed_upsert_keeps_the_replaced_rows(self):
+        self.add(self.collection, "a", "b")
+        with self.assertRaises(sqlite3.IntegrityError):
+            # the second "a" violates the unique id, after the first one replaced the stored row
+            self.collection.upsert(ids=["a", "a"], documents=["new", "new"], embeddings=[[5.0, 5.0], [5.0, 5.0]])
+        rows = self.collection.get(ids=["a"], include=["documents"])
+        self.assertEqual(rows['documents'], ["text a"])
+        hits = self.collection.query(query_embeddings=[[0.0, 1.0]], n_results=1, include=["documents"])
+        self.assertEqual(hits['ids'], [["a"]])
+
+    def test_index_is_persisted_in_batches(self):
+        self.add(self.collection, "a")
+        self.add(self.collection, "b")
+        self.assertEqual(self.index_version(self.collection), 0)
+        # another process sees the rows the persisted index does not cover yet
+        other = self.open_client().get_or_create_collection("chunks")
+        other_client_hits = other.query(query_embeddings=[[1.0, 1.0]], n_results=2, include=[])
+        self.assertEqual(other_client_hits['ids'], [["b", "a"]])
+
+        self.add(self.collection, "c")
+        self.assertEqual(self.index_version(self.collection), 1)
+        self.add(self.collection, "d")
+        self.client.close()
+        self.assertEqual(self.index_version(self.collection), 2)
+        self.assertEqual(self.collection._info('indexed_upto'), 4)
+
+    def test_concurrent_calls_share_one_execution(self):
+        flights = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def work():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return "answer"
+
+        with ThreadPoolExecutor(4) as executor:
+            futures = [executor.submit(flights.do, "key", work)]
+            started.wait(5)
+            futures += [executor.submit(flights.do, "key", work) for _ in range(3)]
+            # give the followers time to join the call before it finishes
+            threading.Event().wait(0.1)
+            self.assertEqual(flights.in_flight(), 1)
+            self.assertEqual(flights.followers("key"), 3)
+            release.set()
+            results = [future.result(5) for future in futures]
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(shared for _, shared in results), [False, True, True, True])
+        self.assertEqual({result for result, _ in results}, {"answer"})
+        self.assertEqual(flights.in_flight(), 0)
+        self.assertEqual(flights.followers("key"), 0)
+
+    def test_keys_are_forgotten_after_the_call(self):
+        flights = SingleFlight()
+        self.assertEqual(flights.do("key", lambda: 1), (1, False))
+        self.assertEqual(flights.do("key", lambda: 2), (2, False))
+
+    def test_error_reaches_every_caller(self):
+        flights = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+
+        def fail():
+            started.set()
+            release.wait(5)
+            raise RuntimeError("backend down")
+
+        with ThreadPoolExecutor(2) as executor:
+            leader = executor.submit(flights.do, "key", fail)
+            started.wait(5)
+            follower = executor.submit(flights.do, "key", fail)
+            # give the follower time to join the call before it fails
+            threading.Event().wait(0.1)
+            release.set()
+            for future in (leader, follower):
+                with self.assertRaises(RuntimeError):
+                    future.result(5)
+        self.assertEqual(flights.in_flight(), 0)
+
+
+class AdmissionControllerTests(SimpleTestCase):
+    def hold(self, controller, model, release, **options):
+        """ Take a slot of the model in another thread until release is set """
+        admitted = threading.Event()
+
+        def run():
+            with controller.admit(model, **options):
+                admitted.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread, admitted
+
+    def test_limit_per_model(self):
+        controller = AdmissionController({"small": 1}, default_limit=2, max_queue=0, queue_timeout=1)
+        self.assertEqual(controller.limit("small"), 1)
+        self.assertEqual(controller.limit("other"), 2)
+        release = threading.Event()
+        thread, admitted = self.hold(controller, "small", release)
+        admitted.wait(5)
+        self.assertFalse(controller.is_idle("small"))
+        self.assertTrue(controller.is_idle("other"))
+        # other models have their own slots
+        with controller.admit("other"):
+            pass
+        with self.assertRaises(AdmissionRejected) as rejected:
+            with controller.admit("small"):
+                pass
+        self.assertEqual(rejected.exception.status_code, 429)
+        self.assertGreaterEqual(rejected.exception.retry_after, 1)
+        release.set()
+        thread.join(5)
+        self.assertTrue(controller.is_idle("small"))
+        self.assertEqual(controller.stats()["small"]["active"], 0)
+
+    def test_queue_timeout(self):
+        controller = AdmissionController({}, default_limit=1, max_queue=1, queue_timeout=0.1)
+        release = threading.Event()
+        thread, admitted = self.hold(controller, "model", release)
+        admitted.wait(5)
+        with self.assertRaises(AdmissionRejected) as rejected:
+            with controller.admit("model"):
+                pass
+        self.assertEqual(rejected.exception.status_code, 503)
+        release.set()
+        thread.join(5)
+
+    def test_waiter_gets_the_freed_slot(self):
+        controller = AdmissionController({}, default_limit=1, max_queue=0, queue_timeout=0.1)
+        release = threading.Event()
+        thread, admitted = self.hold(controller, "model", release)
+        admitted.wait(5)
+        # background work is never rejected, it waits past the queue limit and timeout
+        waiter_release = threading.Event()
+        waiter, waiter_admitted = self.hold(controller, "model", waiter_release, enforce_queue=False)
+        self.assertFalse(waiter_admitted.wait(0.3))
+        self.assertEqual(controller.stats()["model"]["waiting"], 1)
+        release.set()
+        self.assertTrue(waiter_admitted.wait(5))
+        waiter_release.set()
+        thread.join(5)
+        waiter.join(5)
+
+    def test_batch_leaves_a_slot_to_interactive_generations(self):
+        controller = AdmissionController({}, default_limit=2, max_queue=0, queue_timeout=0.1)
+        release = threading.Event()
+        first, first_admitted = self.hold(controller, "model", release, batch=True)
+        second, second_admitted = self.hold(controller, "model", release, batch=True)
+        self.assertTrue(first_admitted.wait(5))
+        self.assertFalse(second_admitted.wait(0.3))
+        self.assertEqual(controller.stats()["model"]["batch_waiting"], 1)
+        # the reserved slot is free although a batch generation is waiting
+        with controller.admit("model"):
+            pass
+        release.set()
+        self.assertTrue(second_admitted.wait(5))
+        first.join(5)
+        second.join(5)
+
+    def test_batch_waits_behind_interactive_generations_with_one_slot(self):
+        controller = AdmissionController({}, default_limit=1, max_queue=1, queue_timeout=5)
+        release, batch_release = threading.Event(), threading.Event()
+        holder, held = self.hold(controller, "model", release)
+        held.wait(5)
+        batch, batch_admitted = self.hold(controller, "model", batch_release, batch=True)
+        interactive_release = threading.Event()
+        interactive, interactive_admitted = self.hold(controller, "model", interactive_release)
+        while controller.stats()["model"]["waiting"] != 1:
+            time.sleep(0.01)
+        release.set()
+        self.assertTrue(interactive_admitted.wait(5))
+        self.assertFalse(batch_admitted.is_set())
+        interactive_release.set()
+        self.assertTrue(batch_admitted.wait(5))
+        batch_release.set()
+        for thread in (holder, batch, interactive):
+            thread.join(5)
+
+
+class LLMResponseCacheTests(SimpleTestCase):
+    def test_key_covers_model_prompt_and_options(self):
+        key = LLMResponseCache.make_key("llama3.2", "prompt", {"temperature": 0, "top_k": 1})
+        self.assertEqual(key, LLMResponseCache.make_key("llama3.2", "prompt", {"top_k": 1, "temperature": 0}))
+        self.assertNotEqual(key, LLMResponseCache.make_key("mistral", "prompt", {"temperature": 0, "top_k": 1}))
+        self.assertNotEqual(key, LLMResponseCache.make_key("llama3.2", "prompt ", {"temperature": 0, "top_k": 1}))
+        self.assertNotEqual(key, LLMResponseCache.make_key("llama3.2", "prompt", {"temperature": 0.7, "top_k": 1}))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = LLMResponseCache(max_entries=2)
+        cache.set("a", "answer a")
+        cache.set("b", "answer b")
+        self.assertEqual(cache.get("a"), "answer a")
+        cache.set("c", "answer c")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "answer a")
+        self.assertEqual(cache.get("c"), "answer c")
+        self.assertEqual(cache.stats(), {
+            "entries": 2, "max_entries": 2, "hits": 3, "misses": 1, "evictions": 1, "hit_rate": 0.75,
+        })
+
+    def test_clear(self):
+        cache = LLMResponseCache()
+        cache.set("a", "answer a")
+        cache.clear()
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["entries"], 0)
+
+
+def _temporary_chroma_service(test) -> ChromaDBService:
+    """ Embedded ChromaDB service in a temporary directory, removed after the test """
+    path = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, path, ignore_errors=True)
+    with override_settings(CHROMA_DB_PATH=path, CHROMA_MODE='embedded', VECTOR_STORE_BACKEND='chroma', DOCUMENT_SHARDS=1):
+        return ChromaDBService()
+
+
+class ReembedCopyTests(SimpleTestCase):
+    """ The backfill of a new embedding version while rows are deleted from the live one """
+
+    class _DeletingCollection:
+        """ Source collection that deletes rows already returned by the first page, shifting the offsets """
+
+        def __init__(self, collection, delete_ids):
+            self._collection = collection
+            self._delete_ids = delete_ids
+            self.name = collection.name
+
+        def get(self, **kwargs):
+            page = self._collection.get(**kwargs)
+            if self._delete_ids and kwargs.get('offset') == 0:
+                self._collection.delete(ids=self._delete_ids)
+                self._delete_ids = None
+            return page
+
+    def setUp(self):
+        self.service = _temporary_chroma_service(self)
+        self.service.embed_queries = lambda texts, version=None: [[float(len(text)), 1.0] for text in texts]
+        self.source = self.service.client.get_or_create_collection('source', embedding_function=None)
+        self.target = self.service.client.get_or_create_collection('target', embedding_function=None)
+        ids = [f"chunk_{i:02d}" for i in range(10)]
+        self.source.add(
+            ids=ids, documents=[f"text {i}" for i in range(10)],
+            metadatas=[{"n": i} for i in range(10)], embeddings=self.service.embed_queries(ids)
+        )
+        self.version = SimpleNamespace(embedded_chunks=0, save=lambda **kwargs: None)
+
+    def test_rows_skipped_by_deletes_during_copy_are_reconciled(self):
+        first_page = self.source.get(include=[], limit=3, offset=0)['ids']
+        source = self._DeletingCollection(self.source, first_page[:2])
+
+        self.service._copy_rows(source, self.target, self.version, 'embedded_chunks', 3, 0)
+        skipped = set(self.source.get(include=[])['ids']) - set(self.target.get(include=[])['ids'])
+        self.assertTrue(skipped)
+
+        self.service._reconcile_rows(source, self.target, self.version, 3)
+        self.assertEqual(sorted(self.target.get(include=[])['ids']), sorted(self.source.get(include=[])['ids']))
+        self.assertEqual(self.source.count(), 8)
+        rows = self.target.get(ids=sorted(skipped), include=["documents", "metadatas"])
+        for row_id, document, metadata in zip(rows['ids'], rows['documents'], rows['metadatas']):
+            self.assertEqual(document, f"text {int(row_id[-2:])}")
+            self.assertEqual(metadata, {"n": int(row_id[-2:])})
+
+    def test_rows_deleted_from_source_are_dropped_from_target(self):
+        self.service._copy_rows(self.source, self.target, self.version, 'embedded_chunks', 4, 0)
+        self.assertEqual(self.version.embedded_chunks, 10)
+        self.source.delete(ids=["chunk_03", "chunk_07"])
+
+        self.service._reconcile_rows(self.source, self.target, self.version, 4)
+        self.assertEqual(sorted(self.target.get(include=[])['ids']), sorted(self.source.get(include=[])['ids']))
+
+
+class LoggingUtilsTests(SimpleTestCase):
+    class _Collect(logging.Handler):
+        def __init__(self):
+            super().__init__()
+            self.records = []
+
+        def emit(self, record):
+            self.records.append(record)
+
+    def _record(self, **extra):
+        record = logging.makeLogRecord({
+            "name": "ragliteapp.views", "levelno": logging.INFO, "levelname": "INFO",
+            "msg": "answered %s in %.1fs", "args": ("q1", 1.25),
+        })
+        record.__dict__.update(extra)
+        return record
+
+    def test_json_formatter_adds_extra_fields(self):
+        line = JSONFormatter().format(self._record(event="query", chunks=5, path=pathlib.PurePosixPath("/tmp/a")))
+        event = json.loads(line)
+        self.assertEqual(event["level"], "INFO")
+        self.assertEqual(event["logger"], "ragliteapp.views")
+        self.assertEqual(event["message"], "answered q1 in 1.2s")
+        self.assertEqual(event["event"], "query")
+        self.assertEqual(event["chunks"], 5)
+        self.assertEqual(event["path"], "/tmp/a")
+        self.assertNotIn("args", event)
+        self.assertNotIn("exception", event)
+
+    def test_json_formatter_includes_exception(self):
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            record = self._record(exc_info=sys.exc_info())
+        event = json.loads(JSONFormatter().format(record))
+        self.assertIn("ValueError: boom", event["exception"])
+
+    def test_prepare_queues_the_record_unformatted(self):
+        handler = QueueHandler(queue.Queue())
+        record = self._record()
+        self.assertIs(handler.prepare(record), record)
+        self.assertEqual(record.args, ("q1", 1.25))
+        self.assertEqual(record.msg, "answered %s in %.1fs")
+
+    def test_records_are_written_by_the_listener(self):
+        records = queue.Queue()
+        collect = self._Collect()
+        handler = QueueHandler(records)
+        handler.listener = logging.handlers.QueueListener(records, collect, respect_handler_level=True)
+        handler.emit(self._record())
+        handler._stop_listener()
+        self.assertEqual([record.getMessage() for record in collect.records], ["answered q1 in 1.2s"])
+
+    def test_sample_payload_follows_rate(self):
+        with override_settings(LOG_PAYLOAD_SAMPLE_RATE=0.0):
+            self.assertFalse(any(sample_payload() for _ in range(100)))
+        with override_settings(LOG_PAYLOAD_SAMPLE_RATE=1.0):
+            self.assertTrue(all(sample_payload() for _ in range(100)))
+        with override_settings(LOG_PAYLOAD_SAMPLE_RATE=0.25):
+            with mock.patch('ragliteapp.logging_utils.random.random', side_effect=[0.1, 0.3]):
+                self.assertEqual([sample_payload(), sample_payload()], [True, False])
+
+
+class ChatWriterTests(TestCase):
+    def _chat(self, question="What is RAG?"):
+        return Chat(question=question, answer="Retrieval augmented generation", model="llama3.2")
+
+    @override_settings(CHAT_WRITE_BATCH_SIZE=3, CHAT_WRITE_FLUSH_INTERVAL=0.2)
+    def test_queued_chats_are_written_in_batches(self):
+        writer = ChatWriter()
+        batches = []
+        conversation = Conversation.objects.create()
+        with mock.patch.object(writer, '_write', side_effect=batches.append):
+            with mock.patch.object(writer, '_ensure_thread'):
+                for i in range(7):
+                    chat = self._chat(f"question {i}")
+                    chat.conversation = conversation
+                    writer.submit(chat, cache_question=False)
+            writer._ensure_thread()
+            writer.flush(conversation_id=conversation.id)
+        self.assertEqual([len(batch) for batch in batches], [3, 3, 1])
+        self.assertEqual([chat.question for batch in batches for chat, _, _ in batch], [f"question {i}" for i in range(7)])
+        self.assertFalse(writer._pending)
+
+    @override_settings(CHAT_WRITE_RETRIES=3, CHAT_WRITE_RETRY_BACKOFF=0.5)
+    def test_failing_batch_is_retried_with_backoff(self):
+        writer = ChatWriter()
+        batch = [(self._chat(), [], False)]
+        with mock.patch.object(writer, '_save', side_effect=[OperationalError("locked"), OperationalError("locked"), None]) as save, \
+                mock.patch('ragliteapp.chat_writer.time.sleep') as sleep:
+            self.assertEqual(writer._save_with_retry(batch), batch)
+        self.assertEqual(save.call_count, 3)
+        self.assertEqual([call.args[0] for call in sleep.call_args_list], [0.5, 1.0])
+
+    @override_settings(CHAT_WRITE_RETRIES=1, CHAT_WRITE_RETRY_BACKOFF=0.5)
+    def test_batch_falls_back_to_row_by_row_saves(self):
+        writer = ChatWriter()
+        good, bad, other = self._chat("good"), self._chat("bad"), self._chat("other")
+        batch = [(good, [], False), (bad, [], False), (other, [], False)]
+
+        def save(items):
+            if any(chat is bad for chat, _, _ in items):
+                raise IntegrityError("bad row")
+
+        with mock.patch.object(writer, '_save', side_effect=save), mock.patch('ragliteapp.chat_writer.time.sleep') as sleep:
+            saved = writer._save_with_retry(batch)
+        self.assertEqual([chat.question for chat, _, _ in saved], ["good", "other"])
+        sleep.assert_called_once_with(0.5)
+
+    @override_settings(CHAT_WRITE_ASYNC=False)
+    def test_chat_and_existing_document_links_are_saved(self):
+        document = Document.objects.create(name="a.txt", file="documents/a.txt", file_hash="a" * 32)
+        chat = self._chat()
+        ChatWriter().submit(chat, document_ids=[document.id, uuid.uuid4()], cache_question=False)
+        saved = Chat.objects.get(id=chat.id)
+        self.assertEqual([str(d.id) for d in saved.documents.all()], [str(document.id)])
+
+    def test_forked_worker_gets_its_own_writer(self):
+        writer = get_chat_writer()
+        chat_writer._reset_after_fork()
+        self.assertIsNot(get_chat_writer(), writer)
+
+
+@override_settings(CONVERSATION_HISTORY_TURNS=2, CONVERSATION_HISTORY_TOKENS=800)
+class ConversationHistoryTests(TestCase):
+    def setUp(self):
+        self.conversation = Conversation.objects.create()
+        self.started = timezone.now()
+
+    def _add_turns(self, count):
+        start = self.conversation.chats.count()
+        for i in range(start, start + count):
+            chat = Chat.objects.create(question=f"q{i}", answer=f"a{i}", conversation=self.conversation)
+            Chat.objects.filter(id=chat.id).update(created_at=self.started + timedelta(seconds=i))
+
+    def test_window_keeps_the_latest_turns_within_the_token_budget(self):
+        turns = [("q" * 400, "a" * 400), ("short", "answer"), ("latest", "answer")]
+        with override_settings(CONVERSATION_HISTORY_TURNS=3, CONVERSATION_HISTORY_TOKENS=50):
+            self.assertEqual(_window_start(turns), 1)
+        with override_settings(CONVERSATION_HISTORY_TURNS=2, CONVERSATION_HISTORY_TOKENS=800):
+            self.assertEqual(_window_start(turns), 1)
+        # the latest turn is kept even when it alone exceeds the budget
+        with override_settings(CONVERSATION_HISTORY_TURNS=3, CONVERSATION_HISTORY_TOKENS=10):
+            self.assertEqual(_window_start([("q" * 400, "a" * 400)]), 0)
+
+    def test_history_keeps_unsummarized_turns_and_schedules_the_summary(self):
+        self._add_turns(5)
+        llm = mock.Mock()
+        with mock.patch('ragliteapp.conversations.schedule_summary_update') as schedule, \
+                mock.patch('ragliteapp.conversations.get_llm_service', return_value=llm):
+            summary, turns = get_history(self.conversation, "llama3.2")
+        self.assertEqual(summary, "")
+        self.assertEqual(turns, [(f"q{i}", f"a{i}") for i in range(5)])
+        schedule.assert_called_once_with(self.conversation.id, "llama3.2")
+        llm.summarize_conversation.assert_not_called()
+
+    def test_summary_is_updated_incrementally_under_admission(self):
+        controller = AdmissionController(limits={}, default_limit=1)
+        llm = mock.Mock()
+        llm.summarize_conversation.side_effect = lambda summary, turns, model_name: f"{summary}+{len(turns)}"
+
+        def summarize(*args, **kwargs):
+            self.assertFalse(controller.is_idle("llama3.2"))
+            return llm.summarize_conversation(*args, **kwargs)
+
+        with mock.patch('ragliteapp.conversations.get_admission_controller', return_value=controller), \
+                mock.patch('ragliteapp.conversations.get_llm_service', return_value=mock.Mock(summarize_conversation=summarize)), \
+                mock.patch('ragliteapp.conversations.get_chat_writer'), \
+                mock.patch('ragliteapp.conversations.close_old_connections'):
+            self._add_turns(3)
+            update_summary(str(self.conversation.id), "llama3.2")
+            self._add_turns(2)
+            update_summary(str(self.conversation.id), "llama3.2")
+            summary, turns = get_history(Conversation.objects.get(id=self.conversation.id), "llama3.2")
+
+        self.assertEqual(
+            [call.args[:2] for call in llm.summarize_conversation.call_args_list],
+            [("", [("q0", "a0")]), ("+1", [("q1", "a1"), ("q2", "a2")])]
+        )
+        self.assertEqual(summary, "+1+2")
+        self.assertEqual(turns, [("q3", "a3"), ("q4", "a4")])
+        self.assertTrue(controller.is_idle("llama3.2"))
+
+
+class CompactChunkMetadataCommandTests(TestCase):
+    def test_command_drops_redundant_keys_only(self):
+        service = _temporary_chroma_service(self)
+        collection = service.get_or_create_documents_collection()
+        collection.add(
+            ids=["doc_0", "doc_1", "doc_2"],
+            documents=["first", "second", "third"],
+            metadatas=[
+                {"document_id": "d1", "chunk_index": 0, "source": "/tmp/a.pdf", "chunk_type": "text"},
+                {"document_id": "d1", "chunk_index": 1, "source": "/tmp/a.pdf"},
+                {"document_id": "d2", "chunk_index": 0},
+            ],
+            embeddings=[[1.0, 0.0], [0.0, 1.0], [1.0, 1.0]],
+        )
+        out = io.StringIO()
+        with mock.patch('ragliteapp.management.commands.compact_chunk_metadata.get_chroma_service', return_value=service):
+            call_command('compact_chunk_metadata', '--batch-size', '2', stdout=out)
+            self.assertIn("Compacted the metadata of 2 chunks", out.getvalue())
+            call_command('compact_chunk_metadata', stdout=out)
+            self.assertIn("Compacted the metadata of 0 chunks", out.getvalue())
+
+        rows = collection.get(ids=["doc_0", "doc_1", "doc_2"], include=["metadatas", "documents"])
+        self.assertEqual(dict(zip(rows['ids'], rows['metadatas'])), {
+            "doc_0": {"document_id": "d1", "chunk_index": 0},
+            "doc_1": {"document_id": "d1", "chunk_index": 1},
+            "doc_2": {"document_id": "d2", "chunk_index": 0},
+        })
+        self.assertEqual(dict(zip(rows['ids'], rows['documents'])), {"doc_0": "first", "doc_1": "second", "doc_2": "third"})
+
+
+@override_settings(LLM_RESPONSE_CACHE={'ALWAYS': False, 'MAX_ENTRIES': 10})
+class AnswerAdmissionTests(SimpleTestCase):
+    chunks = ["RAG retrieves context before generating."]
+    metadatas = [{"chunk_index": 0}]
+
+    def setUp(self):
+        self.llm = LLMService()
+        self.controller = AdmissionController(limits={}, default_limit=1, max_queue=0, queue_timeout=0.1)
+        for target, value in (('get_llm_service', self.llm), ('get_admission_controller', self.controller)):
+            patcher = mock.patch(f'ragliteapp.views.{target}', return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @contextmanager
+    def only_slot_taken(self):
+        """ Hold the model's only generation slot in another thread for the duration of the block """
+        release, held = threading.Event(), threading.Event()
+
+        def hold():
+            with self.controller.admit("llama3.2"):
+                held.set()
+                release.wait(5)
+
+        with ThreadPoolExecutor(1) as executor:
+            executor.submit(hold)
+            held.wait(5)
+            try:
+                yield
+            finally:
+                release.set()
+
+    def answer(self):
+        return ChatViewSet()._answer_from_chunks(
+            "What is RAG?", None, "llama3.2", self.chunks, self.metadatas, temperature=0, sources={}, persist=False
+        )
+
+    def test_cached_answer_does_not_wait_for_a_generation_slot(self):
+        prompt = self.llm._build_prompt("What is RAG?", self.chunks[0])
+        self.llm.response_cache.set(self.llm._cache_key(prompt, "llama3.2", {"temperature": 0}), "Cached answer")
+        with self.only_slot_taken(), mock.patch.object(self.llm, 'generate_answer') as generate:
+            payload, status_code = self.answer()
+        generate.assert_not_called()
+        self.assertEqual((payload['answer'], status_code), ("Cached answer", 200))
+
+    def test_generation_is_rejected_without_a_free_slot(self):
+        with self.only_slot_taken(), mock.patch.object(self.llm, 'generate_answer') as generate:
+            with self.assertRaises(AdmissionRejected):
+                self.answer()
+        generate.assert_not_called()
+
+
+@override_settings(
+    LLM_URLS=[{"url": "http://ollama.test/api/generate", "model": "llama3.2"}],
+    LLM_RESPONSE_CACHE={'ALWAYS': False, 'MAX_ENTRIES': 10}
+)
+class GenerateCachingTests(SimpleTestCase):
+    def stream(self, *lines):
+        response = mock.Mock()
+        response.iter_lines.return_value = [json.dumps(line).encode() for line in lines]
+        return response
+
+    def generate(self, llm, *lines, **kwargs):
+        with mock.patch.object(llm.session, 'post', return_value=self.stream(*lines)) as post:
+            answer = llm._generate("prompt", "llama3.2", {"temperature": 0}, **kwargs)
+        return answer, post.call_count
+
+    def test_complete_stream_is_cached(self):
+        llm = LLMService()
+        lines = ({"response": "Hello ", "done": False}, {"response": "world", "done": True, "eval_count": 2})
+        self.assertEqual(self.generate(llm, *lines), ("Hello world", 1))
+        self.assertEqual(self.generate(llm, *lines), ("Hello world", 0))
+
+    def test_truncated_stream_is_not_cached(self):
+        llm = LLMService()
+        self.assertEqual(self.generate(llm, {"response": "Hel", "done": False}), ("Hel", 1))
+        self.assertEqual(llm.response_cache.stats()["entries"], 0)
+
+    def test_callers_can_skip_the_cache(self):
+        llm = LLMService()
+        lines = ({"response": "Summary", "done": True},)
+        self.assertEqual(self.generate(llm, *lines, cache=False), ("Summary", 1))
+        self.assertEqual(self.generate(llm, *lines, cache=False), ("Summary", 1))
+        self.assertEqual(llm.response_cache.stats()["entries"], 0)
+
+
+class BulkImportCommandTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        media = tempfile.mkdtemp()
+        for path in (self.directory, media):
+            self.addCleanup(shutil.rmtree, path, ignore_errors=True)
+        self.checkpoint = os.path.join(media, 'bulk_import.checkpoint')
+        settings = override_settings(MEDIA_ROOT=media, MAX_DOCUMENT_PAGES=None)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.chroma = mock.Mock()
+        patcher = mock.patch('ragliteapp.management.commands.bulk_import.get_chroma_service', return_value=self.chroma)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, name, text):
+        with open(os.path.join(self.directory, name), 'w') as f:
+            f.write(text)
+
+    def run_import(self):
+        out = io.StringIO()
+        call_command('bulk_import', self.directory, '--workers', '1', '--checkpoint', self.checkpoint, stdout=out)
+        return out.getvalue()
+
+    def checkpointed(self):
+        with open(self.checkpoint) as f:
+            return sorted(os.path.basename(line.split('\t')[0]) for line in f)
+
+    def test_import_dedupes_and_resumes_from_the_checkpoint(self):
+        self.write('a.txt', "Alpha document text. " * 20)
+        self.write('b.txt', "Beta document text. " * 20)
+        self.write('copy_of_a.txt', "Alpha document text. " * 20)
+        self.assertIn("2 imported, 1 duplicates, 0 failed", self.run_import())
+        self.assertEqual(Document.objects.filter(status='completed').count(), 2)
+        self.assertEqual(self.checkpointed(), ['a.txt', 'b.txt', 'copy_of_a.txt'])
+
+        self.assertIn("Found 0 files to import (3 already in checkpoint)", self.run_import())
+
+    def test_failed_files_are_not_checkpointed_and_retried(self):
+        self.write('a.txt', "Alpha document text. " * 20)
+        self.chroma.add_document_chunks.side_effect = RuntimeError("chroma down")
+        self.assertIn("0 imported, 0 duplicates, 1 failed", self.run_import())
+        self.assertEqual(self.checkpointed(), [])
+        self.assertEqual(Document.objects.get().status, 'failed')
+
+        self.chroma.add_document_chunks.side_effect = None
+        self.assertIn("1 imported, 0 duplicates, 0 failed", self.run_import())
+        self.assertEqual(Document.objects.get().status, 'completed')
+        self.assertEqual(self.checkpointed(), ['a.txt'])
+
+    def test_changed_file_at_a_checkpointed_path_is_imported(self):
+        self.write('a.txt', "Alpha document text. " * 20)
+        self.run_import()
+        self.write('a.txt', "Rewritten alpha document with other content. " * 20)
+        self.assertIn("Found 1 files to import", self.run_import())
+        self.assertEqual(Document.objects.count(), 2)
+
+
+@override_settings(QUERY_CACHE_MAX_ENTRIES=10, QUERY_CACHE_TTL=100, QUERY_CACHE_EVICTION_POLICY='lru',
+                   QUERY_CACHE_HIT_FLUSH_INTERVAL=3600)
+class SemanticCachePolicyTests(TestCase):
+    def setUp(self):
+        with override_settings(QUERY_CACHE_MAX_ENTRIES=10, QUERY_CACHE_TTL=100, QUERY_CACHE_HIT_FLUSH_INTERVAL=3600):
+            self.service = _temporary_chroma_service(self)
+        # question i is embedded at (i, 1), so each question only matches itself
+        self.service.embed_queries = lambda texts, version=None: [[float(text.split()[-1]), 1.0] for text in texts]
+        self.collection = self.service.get_or_create_queries_collection()
+
+    def add(self, *numbers):
+        self.service.add_cached_questions(
+            [f"question {n}" for n in numbers], [f"chat-{n}" for n in numbers], [f"answer {n}" for n in numbers]
+        )
+
+    def set_metadata(self, chat_id, **metadata):
+        self.collection.update(ids=[chat_id], metadatas=[metadata])
+
+    def metadata(self, chat_id):
+        return self.collection.get(ids=[chat_id], include=["metadatas"])['metadatas'][0]
+
+    def test_expired_entries_are_not_served_and_swept(self):
+        self.add(1, 2)
+        self.set_metadata("chat-1", created_at=time.time() - 200)
+        self.assertIsNone(self.service.find_similar_question("question 1", threshold=0.5))
+        self.assertIsNotNone(self.service.find_similar_question("question 2", threshold=0.5))
+        self.set_metadata("chat-2", created_at=time.time() - 200)
+        self.assertEqual(self.service.enforce_cache_policy(force=True), 1)
+        self.assertEqual(self.collection.count(), 0)
+
+    def test_hits_are_recorded_in_batches(self):
+        self.add(1)
+        before = self.metadata("chat-1")
+        for _ in range(3):
+            self.assertEqual(self.service.find_similar_question("question 1", threshold=0.5)[0], "chat-1")
+        self.assertEqual(self.metadata("chat-1")["hit_count"], 0)
+        self.service.flush_cache_hits()
+        after = self.metadata("chat-1")
+        self.assertEqual(after["hit_count"], 3)
+        self.assertGreaterEqual(after["last_hit_at"], before["last_hit_at"])
+        self.assertEqual(after["answer"], "answer 1")
+
+    def test_least_recently_hit_entries_are_evicted(self):
+        self.add(*range(10))
+        now = time.time()
+        for n in range(10):
+            self.set_metadata(f"chat-{n}", last_hit_at=now - 100 + (n * 7) % 10)
+        self.add(10, 11)
+        self.service.enforce_cache_policy(force=True)
+        remaining = set(self.collection.get(include=[])['ids'])
+        # trimmed to 90% of the cap: the three least recently hit entries went
+        evicted = sorted(range(10), key=lambda n: (n * 7) % 10)[:3]
+        self.assertEqual(remaining, {f"chat-{n}" for n in range(12) if n not in evicted})
+
+    def test_least_hit_entries_are_evicted(self):
+        self.service.cache_eviction_policy = 'lfu'
+        self.add(*range(10))
+        for n in range(10):
+            self.set_metadata(f"chat-{n}", hit_count=20 - n)
+        # the new entry has no hits yet, it goes with the least hit older one
+        self.add(10)
+        self.assertEqual(sorted(self.collection.get(include=[])['ids']), sorted(f"chat-{n}" for n in range(9)))
+
+    def test_invalidated_questions_are_removed(self):
+        self.add(1, 2)
+        self.service.invalidate_cached_questions(["chat-1"])
+        self.assertIsNone(self.service.find_similar_question("question 1", threshold=0.5))
+        self.assertEqual(self.collection.get(include=[])['ids'], ["chat-2"])
+
+
+class QueryCoalescingTests(TestCase):
+    question = "What is RAG?"
+
+    def setUp(self):
+        self.chroma = mock.Mock()
+        self.chroma.probe_cache_and_search.return_value = (None, None)
+        self.writer = mock.Mock()
+        for target, value in (('get_chroma_service', self.chroma), ('get_chat_writer', self.writer)):
+            patcher = mock.patch(f'ragliteapp.views.{target}', return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def flight_key(self, question):
+        serializer = QuerySerializer(data={'query': question})
+        serializer.is_valid(raise_exception=True)
+        return (normalize_query(question), None, 'llama3.2', 0.7, tuple(sorted(retrieval_options(serializer.validated_data).items())), None)
+
+    def test_follower_records_its_own_chat_and_hit_without_retrieving(self):
+        key = self.flight_key(self.question)
+        leader = Chat(question=self.question, answer="Retrieval augmented generation.", model="llama3.2",
+                      source_chunks_metadata=[{"document_id": "doc", "chunk_index": 0}])
+        started = threading.Event()
+
+        def generate():
+            started.set()
+            # released once the request below joined the flight
+            while not _query_flights.followers(key):
+                time.sleep(0.01)
+            payload = {'answer': leader.answer, 'source': 'generated', 'chat_id': leader.id, 'source_chunks': []}
+            return payload, 201, {'chat': leader, 'document_ids': ["doc"]}
+
+        with ThreadPoolExecutor(1) as executor:
+            flight = executor.submit(_query_flights.do, key, generate)
+            started.wait(5)
+            response = APIClient().post('/ragengine/chats/query/', {'query': "  what is RAG? "}, format='json')
+            flight.result(5)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['source'], 'cache coalesced')
+        self.assertEqual(response.data['answer'], leader.answer)
+        self.assertEqual(self.chroma.probe_cache_and_search.call_args.kwargs['retrieve'], False)
+        self.chroma.record_cache_hit.assert_called_once_with(str(leader.id))
+        chat, document_ids = self.writer.submit.call_args.args
+        self.assertEqual(self.writer.submit.call_args.kwargs, {'cache_question': False})
+        self.assertNotEqual(chat.id, leader.id)
+        self.assertEqual(response.data['chat_id'], chat.id)
+        self.assertEqual((chat.question, chat.answer, document_ids), ("what is RAG?", leader.answer, ["doc"]))
+
+    def test_query_without_flight_in_progress_retrieves(self):
+        self.chroma.probe_cache_and_search.return_value = (None, mock.Mock())
+        with mock.patch.object(ChatViewSet, '_generate_answer', return_value=({'message': 'No relevant documents found.'}, 404)):
+            response = APIClient().post('/ragengine/chats/query/', {'query': self.question}, format='json')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.chroma.probe_cache_and_search.call_args.kwargs['retrieve'], True)
+
+
+@override_settings(LLM_URLS=[{"url": "http://ollama.test/api/generate", "model": "llama3.2", "concurrency": 4}])
+class BatchQueryAdmissionTests(SimpleTestCase):
+    def setUp(self):
+        self.controller = AdmissionController(limits={}, default_limit=1, max_queue=1, queue_timeout=5)
+        self.llm = LLMService()
+        self.chroma = mock.Mock()
+        self.chroma.search_document_chunks_batch.side_effect = lambda queries, **options: {
+            'documents': [["RAG retrieves context."] for _ in queries],
+            'metadatas': [[{"chunk_index": 0}] for _ in queries],
+        }
+        for target, value in (
+            ('get_admission_controller', self.controller), ('get_llm_service', self.llm), ('get_chroma_service', self.chroma)
+        ):
+            patcher = mock.patch(f'ragliteapp.views.{target}', return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.generating = queue.Queue()
+        self.finish = threading.Semaphore(0)
+
+        def generate_answer(query, context, **kwargs):
+            self.generating.put(query)
+            self.finish.acquire(timeout=5)
+            return f"Answer to {query}"
+        patcher = mock.patch.object(self.llm, 'generate_answer', side_effect=generate_answer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_interactive_query_goes_before_the_rest_of_a_batch_with_one_slot(self):
+        with ThreadPoolExecutor(2) as executor:
+            batch = executor.submit(
+                APIClient().post, '/ragengine/chats/batch_query/',
+                {'queries': ["first", "second"], 'temperature': 0}, format='json'
+            )
+            self.assertEqual(self.generating.get(timeout=5), "first")
+
+            def interactive():
+                return ChatViewSet()._answer_from_chunks(
+                    "interactive", None, "llama3.2", ["RAG retrieves context."], [{"chunk_index": 0}],
+                    temperature=0, sources={}, persist=False
+                )
+            query = executor.submit(interactive)
+            while self.controller.stats()["llama3.2"]["waiting"] != 1:
+                time.sleep(0.01)
+            for _ in range(3):
+                self.finish.release()
+            self.assertEqual(self.generating.get(timeout=5), "interactive")
+            self.assertEqual(self.generating.get(timeout=5), "second")
+            response = batch.result(5)
+            self.assertEqual(query.result(5)[1], 200)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['answer'] for result in response.data['results']], ["Answer to first", "Answer to second"])
+
+    def test_batch_holds_one_slot_less_than_the_model_has(self):
+        self.controller.default_limit = 3
+        with ThreadPoolExecutor(1) as executor:
+            batch = executor.submit(
+                APIClient().post, '/ragengine/chats/batch_query/',
+                {'queries': ["first", "second", "third"], 'temperature': 0}, format='json'
+            )
+            self.generating.get(timeout=5)
+            self.generating.get(timeout=5)
+            self.assertEqual(self.controller.stats()["llama3.2"]["batch_active"], 2)
+            for _ in range(3):
+                self.finish.release()
+            response = batch.result(5)
+        self.assertEqual(response.data['count'], 3)
+
+
+class ChunkDeduplicationTests(TestCase):
+    text = "retrieval augmented generation grounds the answers of a language model in documents"
+
+    def setUp(self):
+        self.service = _temporary_chroma_service(self)
+        self.collection = self.service.get_or_create_documents_collection(0)
+        self.documents = [
+            Document.objects.create(name=f"doc{n}.txt", file_hash=f"hash{n}", status='completed', chunk_count=1) for n in range(3)
+        ]
+
+    def add_chunk(self, chunk_id, document, text, embedding):
+        self.collection.add(
+            ids=[chunk_id], documents=[text], embeddings=[embedding],
+            metadatas=[{"document_id": str(document.id), "chunk_index": 0}]
+        )
+
+    def test_duplicates_are_linked_and_removed_page_by_page(self):
+        self.add_chunk("a", self.documents[0], self.text, [1.0, 0.0])
+        self.add_chunk("b", self.documents[1], self.text.upper(), [1.0, 0.1])
+        self.add_chunk("c", self.documents[2], "an unrelated chunk about sharding the vector index by document id", [0.0, 1.0])
+        result = self.service.deduplicate_chunks(batch_size=1)
+        self.assertEqual(result, {"scanned": 3, "removed": 1, "linked": 1})
+        stored = self.collection.get(include=["metadatas"])
+        metadatas = dict(zip(stored['ids'], stored['metadatas']))
+        self.assertEqual(sorted(metadatas), ["a", "c"])
+        self.assertEqual(metadatas["a"]["document_ids"], [str(self.documents[0].id), str(self.documents[1].id)])
+        self.assertTrue(metadatas["c"]["simhash"] and metadatas["c"]["text_hash"])
+        self.documents[1].refresh_from_db()
+        self.assertEqual(self.documents[1].duplicate_chunk_count, 1)
+        # a second run finds nothing left to merge
+        self.assertEqual(self.service.deduplicate_chunks(batch_size=1)["removed"], 0)
+
+    def test_stats_are_cached_until_fresh(self):
+        self.add_chunk("a", self.documents[0], self.text, [1.0, 0.0])
+        self.assertEqual(self.service.deduplication_stats()["document_chunks"], 3)
+        Document.objects.filter(id=self.documents[0].id).update(duplicate_chunk_count=1)
+        self.assertEqual(self.service.deduplication_stats()["duplicate_chunks"], 0)
+        stats = self.service.deduplication_stats(fresh=True)
+        self.assertEqual((stats["duplicate_chunks"], stats["stored_chunks"]), (1, 1))
+
+    def test_lock_file_follows_the_store(self):
+        faiss_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, faiss_path, ignore_errors=True)
+        with override_settings(VECTOR_STORE_BACKEND='faiss', FAISS_INDEX_PATH=faiss_path):
+            self.assertEqual(self.service._dedup_lock_path(), os.path.join(faiss_path, 'dedup.lock'))
+        self.service.mode = 'http'
+        with override_settings(CHROMA_HOST='chroma.internal', CHROMA_PORT=8002):
+            self.assertEqual(
+                self.service._dedup_lock_path(), os.path.join(tempfile.gettempdir(), "raglite-dedup-chroma.internal-8002.lock")
+            )
+        with override_settings(CHUNK_DEDUP={'LOCK_PATH': '/run/raglite/dedup.lock'}):
+            self.assertEqual(self.service._dedup_lock_path(), '/run/raglite/dedup.lock')
+        with override_settings(CHUNK_DEDUP={'LOCK_PATH': os.path.join(tempfile.gettempdir(), f"dedup-{uuid.uuid4()}.lock")}):
+            with self.service._dedup_locked():
+                self.assertTrue(os.path.exists(self.service._dedup_lock_path()))
+            os.remove(self.service._dedup_lock_path())
+
+
+class PrewarmTests(TestCase):
+    question = "What is RAG?"
+
+    def test_questions_are_answered_with_the_live_query_retrieval(self):
+        Chat.objects.create(question="Already asked?", answer="Yes.", model="llama3.2")
+        chroma = mock.Mock()
+        chroma.search_document_chunks.return_value = {'documents': [["RAG retrieves context."]], 'metadatas': [[{"chunk_index": 0}]]}
+        llm = mock.Mock()
+        llm.generate_questions.return_value = [self.question, "already asked?"]
+        llm.generate_answer.return_value = "Retrieval augmented generation."
+        writer = mock.Mock()
+        document_id = str(uuid.uuid4())
+        with override_settings(RETRIEVAL_K=5), \
+                mock.patch('ragliteapp.prewarm._sections', return_value=["RAG retrieves context."]), \
+                mock.patch('ragliteapp.prewarm.get_chroma_service', return_value=chroma), \
+                mock.patch('ragliteapp.prewarm.get_llm_service', return_value=llm), \
+                mock.patch('ragliteapp.prewarm.get_chat_writer', return_value=writer):
+            self.assertEqual(prewarm_document(document_id), 1)
+            retrieval = retrieval_options({})
+        self.assertEqual(retrieval['k'], 5)
+        chroma.search_document_chunks.assert_called_once_with(self.question, **retrieval)
+        chat, document_ids = writer.submit.call_args.args
+        self.assertEqual((chat.question, chat.prewarmed, document_ids), (self.question, True, [document_id]))
+
+    def test_exact_match_hits_count_in_the_report(self):
+        service = _temporary_chroma_service(self)
+        service.embed_queries = lambda texts, version=None: [[1.0, float(len(text))] for text in texts]
+        chat = Chat.objects.create(question=self.question, answer="Retrieval augmented generation.", model="llama3.2", prewarmed=True)
+        service.add_cached_questions([chat.question], [str(chat.id)], [chat.answer])
+        with mock.patch('ragliteapp.views.get_chroma_service', return_value=service), \
+                mock.patch('ragliteapp.prewarm.get_chroma_service', return_value=service):
+            self.assertEqual(prewarm_report()["hit"], 0)
+            response = APIClient().post('/ragengine/chats/query/', {'query': "what is rag?"}, format='json')
+            self.assertEqual(response.data['source'], 'cache match')
+            service.flush_cache_hits()
+            report = prewarm_report()
+        self.assertEqual((report["prewarmed"], report["hit"], report["hits"], report["hit_rate"]), (1, 1, 1, 1.0))
+
+
+@override_settings(WARMUP_ON_STARTUP=True, WARMUP_RETRY_INTERVAL=30)
+class ReadinessTests(SimpleTestCase):
+    def setUp(self):
+        saved = dict(warmup._state, timings=dict(warmup._state["timings"]))
+        self.addCleanup(warmup._state.update, saved)
+        warmup._state.update(status="pending", started_at=None, finished_at=None, timings={}, error=None)
+
+    def ready(self):
+        return APIClient().get('/ragengine/health/ready/')
+
+    def test_first_probe_starts_the_warm_up(self):
+        with mock.patch('ragliteapp.warmup.threading.Thread') as thread:
+            response = self.ready()
+        self.assertEqual((response.status_code, response.data['status']), (503, "warming"))
+        thread.return_value.start.assert_called_once()
+        # a running warm-up is not started twice
+        with mock.patch('ragliteapp.warmup.threading.Thread') as thread:
+            self.assertEqual(self.ready().status_code, 503)
+        thread.assert_not_called()
+
+    def test_warm_up_makes_the_process_ready(self):
+        chroma, llm = mock.Mock(), mock.Mock()
+        with override_settings(WARMUP_LLM_MODELS=["llama3.2"]), \
+                mock.patch('ragliteapp.vectordb_services.get_chroma_service', return_value=chroma), \
+                mock.patch('ragliteapp.llm_services.get_llm_service', return_value=llm):
+            warmup.warm_up()
+        llm.preload_model.assert_called_once_with("llama3.2")
+        response = self.ready()
+        self.assertEqual((response.status_code, response.data['status']), (200, "ready"))
+        self.assertIn("llm_llama3.2", response.data['timings'])
+
+    def test_failed_warm_up_is_retried_after_the_interval(self):
+        with mock.patch('ragliteapp.vectordb_services.get_chroma_service', side_effect=RuntimeError("chroma down")):
+            warmup.warm_up()
+        with mock.patch('ragliteapp.warmup.threading.Thread') as thread:
+            response = self.ready()
+        self.assertEqual((response.status_code, response.data['error']), (503, "chroma down"))
+        thread.assert_not_called()
+        warmup._state["finished_at"] -= 31
+        with mock.patch('ragliteapp.warmup.threading.Thread') as thread:
+            self.ready()
+        thread.return_value.start.assert_called_once()
+
+    def test_forked_worker_resets_without_starting_a_thread(self):
+        warmup._state.update(status="ready", timings={"chroma_client": 0.1})
+        with mock.patch('ragliteapp.warmup.threading.Thread') as thread:
+            warmup._reset_after_fork()
+        thread.assert_not_called()
+        self.assertEqual((warmup._state["status"], warmup._state["timings"]), ("pending", {}))
+
+    @override_settings(WARMUP_ON_STARTUP=False)
+    def test_disabled_warm_up_is_always_ready(self):
+        response = self.ready()
+        self.assertEqual((response.status_code, response.data['status']), (200, "disabled"))
+
+
+class ExtractorTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb' if isinstance(content, bytes) else 'w', encoding=None if isinstance(content, bytes) else 'utf-8') as f:
+            f.write(content)
+        return path
+
+    def write_docx(self, name, paragraphs):
+        w = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+        body = ''.join(
+            f'<w:p><w:pPr><w:pStyle w:val="{style}"/></w:pPr><w:r><w:t>{text}</w:t></w:r></w:p>'
+            for style, text in paragraphs
+        )
+        path = os.path.join(self.directory, name)
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('word/document.xml', f'<w:document xmlns:w="{w}"><w:body>{body}</w:body></w:document>')
+        return path
+
+    def test_extractors_are_found_by_extension_then_mime_type(self):
+        self.assertIs(get_extractor("notes.MD"), extractors.extract_markdown_sections)
+        self.assertIs(get_extractor("upload", "text/html; charset=utf-8"), extractors.extract_html_sections)
+        # the extension wins over the MIME type sent by the client
+        self.assertIs(get_extractor("report.pdf", "text/plain"), extractors.extract_pdf_pages)
+        self.assertFalse(is_supported("archive.zip", "application/zip"))
+        with self.assertRaises(ValueError):
+            get_extractor("archive.zip")
+
+    def test_sections_follow_headings(self):
+        markdown = self.write("notes.md", "# One\nfirst\n```\n# not a heading\n```\n## Two\nsecond\n")
+        self.assertEqual(list(extract_markdown_sections(markdown)), ["# One\nfirst\n```\n# not a heading\n```\n", "## Two\nsecond\n"])
+        html = self.write("page.html", "<h1>One</h1><p>first</p><script>skip()</script><h2>Two</h2><p>second</p>")
+        self.assertEqual(list(extract_html_sections(html)), ["One\n\nfirst", "Two\n\nsecond"])
+        docx = self.write_docx("report.docx", [("Title", "Report"), ("Normal", "intro"), ("Heading1", "Part"), ("Normal", "body")])
+        self.assertEqual(list(extract_docx_sections(docx)), ["Report\nintro", "Part\nbody"])
+
+    def test_long_sections_are_split(self):
+        with mock.patch.object(extractors, 'max_section_size', 100):
+            markdown = self.write("long.md", "".join(f"line {n} of a section without headings\n" for n in range(20)))
+            self.assertTrue(all(len(section) <= 100 for section in extract_markdown_sections(markdown)))
+            html = self.write("long.html", "<p>a paragraph of text</p>" * 20)
+            sections = list(extract_html_sections(html))
+            self.assertGreater(len(sections), 1)
+            self.assertTrue(all(len(section) <= 100 for section in sections))
+            docx = self.write_docx("long.docx", [("Normal", "x" * 60) for _ in range(5)])
+            self.assertEqual(len(list(extract_docx_sections(docx))), 5)
+            text = self.write("long.txt", "y" * 250)
+            self.assertEqual([len(section) for section in extract_text_file(text)], [100, 100, 50])
+
+    def test_docx_expanding_past_the_limit_is_rejected(self):
+        docx = self.write_docx("bomb.docx", [("Normal", "z" * 200000)])
+        self.assertLess(os.path.getsize(docx), 10000)
+        with mock.patch.object(extractors, 'max_archive_member_size', 100000):
+            with self.assertRaises(DocumentTooLargeError):
+                list(extract_docx_sections(docx))
+
+    def test_split_sections_count_against_the_page_limit(self):
+        docx = self.write_docx("pages.docx", [("Heading1", f"section {n}") for n in range(5)])
+        self.assertEqual(chunk_file(docx, "doc", max_pages=5)[3]["pages"], 5)
+        with self.assertRaises(DocumentTooLargeError):
+            chunk_file(docx, "doc", max_pages=4)
+
+    def test_text_files_are_chunked_from_the_mapping(self):
+        path = self.write("notes.txt", "héllo wörld " * 50)
+        with mock.patch.object(extractors, 'extract_text_file', side_effect=AssertionError("extractor used")):
+            chunks, metadatas, ids, stats = chunk_file(path, "doc", chunk_size=100, overlap=20)
+        self.assertEqual(stats, {"pages": 1, "characters": 600})
+        self.assertTrue(all(len(chunk.encode('utf-8')) <= 100 and '�' not in chunk for chunk in chunks))
+        self.assertEqual([metadata["chunk_index"] for metadata in metadatas], list(range(len(chunks))))
+        self.assertEqual(chunks[0][:5], "héllo")
+        self.assertEqual(len(set(ids)), len(chunks))
+        self.assertEqual(chunk_file(self.write("empty.txt", ""), "doc")[0], [])
+
+
+@override_settings(MAX_UPLOAD_SIZE=1024, MAX_DOCUMENT_PAGES=2)
+class DocumentUploadLimitTests(TestCase):
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        override = override_settings(MEDIA_ROOT=media)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def upload(self, name, content):
+        return APIClient().post(
+            '/ragengine/documents/upload/', {'file': SimpleUploadedFile(name, content)}, format='multipart'
+        )
+
+    def test_oversized_upload_is_stopped_while_streaming(self):
+        response = self.upload("big.txt", b"x" * 4096)
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(Document.objects.exists())
+
+    def test_upload_declaring_an_oversized_body_is_not_read(self):
+        handler = MaxSizeUploadHandler(request=SimpleNamespace())
+        result = handler.handle_raw_input(io.BytesIO(), {}, 1024 + MULTIPART_OVERHEAD + 1, b"boundary")
+        self.assertEqual(result[1], {})
+        self.assertIn("less than", handler.request.upload_rejected)
+        self.assertIsNone(handler.handle_raw_input(io.BytesIO(), {}, 512, b"boundary"))
+
+    def test_document_with_too_many_sections_is_rejected_and_removed(self):
+        response = self.upload("notes.md", b"# One\na\n# Two\nb\n# Three\nc\n")
+        self.assertEqual(response.status_code, 413)
+        self.assertIn("more than 2 pages", response.data['file'][0])
+        self.assertFalse(Document.objects.exists())
+
+
+class ListEndpointTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        start = timezone.now() - timedelta(hours=1)
+        self.chats = []
+        for n in range(5):
+            chat = Chat.objects.create(question=f"Question {n}?", answer=f"Answer {n}.", model="llama3.2")
+            Chat.objects.filter(id=chat.id).update(created_at=start + timedelta(minutes=n))
+            self.chats.append(chat)
+
+    def test_chats_are_listed_newest_first_by_cursor(self):
+        first = self.client.get('/ragengine/chats/?page_size=2')
+        self.assertEqual([chat['question'] for chat in first.data['results']], ["Question 4?", "Question 3?"])
+        self.assertNotIn('count', first.data)
+        self.assertIsNone(first.data['previous'])
+        # list items leave out the stored source chunks
+        self.assertNotIn('source_chunks_metadata', first.data['results'][0])
+        second = self.client.get(first.data['next'])
+        self.assertEqual([chat['question'] for chat in second.data['results']], ["Question 2?", "Question 1?"])
+        third = self.client.get(second.data['next'])
+        self.assertEqual([chat['question'] for chat in third.data['results']], ["Question 0?"])
+        self.assertIsNone(third.data['next'])
+
+    def test_unchanged_list_answers_not_modified(self):
+        response = self.client.get('/ragengine/chats/')
+        etag = response['ETag']
+        cached = self.client.get('/ragengine/chats/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((cached.status_code, cached['ETag']), (304, etag))
+        # another page is another representation
+        self.assertEqual(self.client.get('/ragengine/chats/?page_size=2', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        Chat.objects.create(question="Question 5?", answer="Answer 5.", model="llama3.2")
+        self.assertEqual(self.client.get('/ragengine/chats/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_invalidated_answers_change_the_etag(self):
+        document = Document.objects.create(name="doc.txt", file_hash="hash", status='completed')
+        self.chats[0].documents.add(document)
+        etag = self.client.get('/ragengine/chats/')['ETag']
+        with mock.patch('ragliteapp.views.get_chroma_service') as chroma, \
+                mock.patch('ragliteapp.views.get_chat_writer'):
+            DocumentViewSet()._invalidate_cached_answers(document)
+        chroma.return_value.invalidate_cached_questions.assert_called_once_with([self.chats[0].id])
+        self.chats[0].refresh_from_db()
+        self.assertIsNotNone(self.chats[0].invalidated_at)
+        response = self.client.get('/ragengine/chats/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class CacheProbeTests(TestCase):
+    def setUp(self):
+        self.service = _temporary_chroma_service(self)
+        self.embedded = []
+
+        def embed_queries(texts, version=None):
+            self.embedded.extend(texts)
+            return [[1.0, 0.0] if "rag" in text.lower() else [0.0, 1.0] for text in texts]
+        self.service.embed_queries = embed_queries
+        self.service.get_or_create_documents_collection(0).add(
+            ids=["chunk"], documents=["RAG retrieves context before generating."], embeddings=[[1.0, 0.0]],
+            metadatas=[{"document_id": "doc", "page": 1, "chunk_index": 0}]
+        )
+
+    def test_miss_retrieves_with_the_same_embedding(self):
+        similar, retrieval = self.service.probe_cache_and_search("What is RAG?", k=1)
+        self.assertIsNone(similar)
+        self.assertEqual(retrieval.result(5)['ids'][0], ["chunk"])
+        self.assertEqual(self.embedded, ["What is RAG?"])
+
+    def test_hit_is_found_while_retrieving(self):
+        self.service.add_cached_questions(["Explain RAG"], ["chat-1"], ["RAG retrieves context."])
+        self.embedded.clear()
+        similar, retrieval = self.service.probe_cache_and_search("What is RAG?", threshold=0.1, k=1)
+        self.assertEqual(similar[0], "chat-1")
+        self.assertIsNotNone(retrieval)
+        retrieval.cancel()
+        self.assertEqual(self.embedded, ["What is RAG?"])
+
+    def test_probe_without_retrieval(self):
+        similar, retrieval = self.service.probe_cache_and_search("Unrelated question", retrieve=False)
+        self.assertEqual((similar, retrieval), (None, None))
+
+    def test_query_answers_a_similar_hit_and_drops_the_retrieval(self):
+        chat = Chat.objects.create(question="Explain RAG", answer="RAG retrieves context.", model="llama3.2")
+        chroma, retrieval = mock.Mock(), mock.Mock()
+        chroma.probe_cache_and_search.return_value = ((str(chat.id), 0.05), retrieval)
+        with mock.patch('ragliteapp.views.get_chroma_service', return_value=chroma):
+            response = APIClient().post('/ragengine/chats/query/', {'query': "What is RAG?"}, format='json')
+        self.assertEqual((response.status_code, response.data['source']), (200, 'cache similar'))
+        self.assertAlmostEqual(response.data['similarity_score'], 0.95)
+        retrieval.cancel.assert_called_once()
+
+
+@override_settings(LLM_URLS=[{"url": "http://ollama.test/api/generate", "model": "llama3.2"}], LLM_COLD_LOAD_SECONDS=1.0)
+class StatsEndpointTests(TestCase):
+    def setUp(self):
+        for target in ('ragliteapp.views.get_chroma_service', 'ragliteapp.prewarm.get_chroma_service'):
+            patcher = mock.patch(target)
+            patcher.start().return_value.get_collection_stats.return_value = {}
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch('ragliteapp.views.get_llm_service', return_value=LLMService())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def stats(self, hours=None):
+        return APIClient().get('/ragengine/stats/', {'hours': hours} if hours is not None else {})
+
+    def test_invalid_windows_are_rejected(self):
+        for hours in ("abc", "0", "-1", "nan", "inf", "1e300"):
+            with self.subTest(hours=hours):
+                self.assertEqual(self.stats(hours).status_code, 400)
+
+    def test_generations_in_the_window_are_aggregated_per_model_and_backend(self):
+        metrics = {"prompt_eval_count": 200, "eval_count": 100, "prompt_eval_duration": 0.5, "eval_duration": 2.0}
+        Chat.objects.create(question="Warm?", answer="Yes.", model="llama3.2", load_duration=0.1, **metrics)
+        Chat.objects.create(question="Cold?", answer="Yes.", model="llama3.2", load_duration=3.0, **metrics)
+        old = Chat.objects.create(question="Old?", answer="Yes.", model="llama3.2", load_duration=0.1, **metrics)
+        Chat.objects.filter(id=old.id).update(created_at=timezone.now() - timedelta(hours=3))
+        # cache hits have no generation metrics
+        Chat.objects.create(question="Cached?", answer="Yes.", model="llama3.2")
+        response = self.stats("2")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['llm']['window_hours'], 2.0)
+        model = response.data['llm']['models']['llama3.2']
+        self.assertEqual((model['generations'], model['completion_tokens'], model['cold_loads']), (2, 200, 1))
+        self.assertEqual((model['tokens_per_second'], model['prompt_tokens_per_second']), (50.0, 400.0))
+        backend = response.data['llm']['backends']['http://ollama.test/api/generate']
+        self.assertEqual((backend['models'], backend['generations'], backend['tokens_per_second']), (['llama3.2'], 2, 50.0))
+        self.assertEqual(self.stats().data['llm']['models']['llama3.2']['generations'], 3)
+
+
+class RequestProfilingTests(TestCase):
+    def setUp(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path, ignore_errors=True)
+        override = override_settings(REQUEST_PROFILING={'ENABLED': True, 'PATH': path, 'MAX_PROFILES': 2})
+        override.enable()
+        self.addCleanup(override.disable)
+        self.staff = APIClient()
+        self.staff.force_login(User.objects.create_user("admin", password="secret", is_staff=True))
+        self.user = APIClient()
+        self.user.force_login(User.objects.create_user("user", password="secret"))
+
+    def test_staff_request_is_profiled_with_cprofile(self):
+        response = self.staff.get('/ragengine/health/?profile=1')
+        profile_id = response['X-Profile-Id']
+        self.assertEqual([profile['id'] for profile in self.staff.get('/ragengine/profiles/').data], [profile_id])
+        detail = self.staff.get(f'/ragengine/profiles/{profile_id}/?limit=5&sort=total')
+        self.assertEqual((detail.data['profiler'], detail.data['status'], detail.data['path']), ("cprofile", 200, "/ragengine/health/"))
+        self.assertEqual(len(detail.data['functions']), 5)
+        self.assertTrue(all(function['calls'] for function in detail.data['functions']))
+        # a zero or negative limit still lists the hottest function
+        self.assertEqual(len(self.staff.get(f'/ragengine/profiles/{profile_id}/?limit=0').data['functions']), 1)
+        self.assertEqual(len(self.staff.get(f'/ragengine/profiles/{profile_id}/?limit=-3').data['functions']), 1)
+        download = self.staff.get(f'/ragengine/profiles/{profile_id}/download/')
+        self.assertEqual(download.status_code, 200)
+        self.assertIn(f'{profile_id}.prof', download['Content-Disposition'])
+
+    def test_sampled_profile_is_stored_for_speedscope(self):
+        profile_id = self.staff.get('/ragengine/health/', HTTP_X_PROFILE='sample')['X-Profile-Id']
+        detail = self.staff.get(f'/ragengine/profiles/{profile_id}/')
+        self.assertEqual(detail.data['profiler'], "sample")
+        self.assertTrue(all(function['calls'] is None for function in detail.data['functions']))
+
+    def test_only_the_newest_profiles_are_kept(self):
+        ids = [self.staff.get('/ragengine/health/?profile=1')['X-Profile-Id'] for _ in range(3)]
+        kept = {profile['id'] for profile in self.staff.get('/ragengine/profiles/').data}
+        self.assertEqual(len(kept), 2)
+        self.assertIn(ids[-1], kept)
+
+    def test_flags_of_other_users_are_ignored(self):
+        response = self.user.get('/ragengine/health/?profile=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('X-Profile-Id', response)
+        self.assertEqual(self.user.get('/ragengine/profiles/').status_code, 403)
+
+    def test_invalid_options_and_unknown_profiles(self):
+        profile_id = self.staff.get('/ragengine/health/?profile=1')['X-Profile-Id']
+        self.assertEqual(self.staff.get(f'/ragengine/profiles/{profile_id}/?limit=abc').status_code, 400)
+        self.assertEqual(self.staff.get(f'/ragengine/profiles/{profile_id}/?sort=calls').status_code, 400)
+        self.assertEqual(self.staff.get(f'/ragengine/profiles/{uuid.uuid4().hex}/').status_code, 404)
+        self.assertEqual(self.staff.get('/ragengine/profiles/..%2Fsettings/').status_code, 404)
+
+    @override_settings(REQUEST_PROFILING={'ENABLED': False})
+    def test_disabled_middleware_leaves_requests_alone(self):
+        self.assertNotIn('X-Profile-Id', APIClient().get('/ragengine/health/?profile=1'))
@@ -0,0 +1,56 @@
+# Upload handlers enforcing size limits while the request body is streaming in
+import logging
+
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+from django.http import QueryDict
+from django.utils.datastructures import MultiValueDict
+
+logger = logging.getLogger(__name__)
+
+# slack for the multipart boundaries and headers around the file itself
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+class MaxSizeUploadHandler(FileUploadHandler):
+    """
+    Abort uploads larger than settings.MAX_UPLOAD_SIZE as early as possible
+
+    Must be first in FILE_UPLOAD_HANDLERS. When Content-Length is already too
+    large the body is never read, otherwise bytes are counted per file as they
+    arrive and the upload is stopped once the limit is crossed. Rejections are
+    flagged on the request as `upload_rejected` so the view can answer 413.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.max_size = getattr(settings, 'MAX_UPLOAD_SIZE', 15 * 1024 * 1024)
+        self.received = 0
+
+    def _reject(self, size: int):
+        message = f"File size should be less than {self.max_size // (1024 * 1024)}MB"
+        logger.info(f"Upload rejected after {size} bytes: {message}")
+        if self.request is not None:
+            self.request.upload_rejected = message
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        if content_length and content_length > self.max_size + MULTIPART_OVERHEAD:
+            self._reject(content_length)
+            # returning a result skips parsing, the body is never read
+            return QueryDict(encoding=encoding), MultiValueDict()
+        return None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.received = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > self.max_size:
+            self._reject(self.received)
+            raise StopUpload(connection_reset=True)
+        return raw_data
+
+    def file_complete(self, file_size):
+        # the remaining handlers build the actual file object
+        return None
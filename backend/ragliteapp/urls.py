@@ -1,10 +1,14 @@
 from django.urls import path,include
 from rest_framework import routers
-from .views import DocumentViewSet, ChatViewSet
+from .views import DocumentViewSet, ChatViewSet, ConversationViewSet, HealthViewSet, StatsViewSet, ProfileViewSet
 
 router = routers.DefaultRouter()
 router.register(r'documents', DocumentViewSet,basename='documents')
 router.register(r'chats', ChatViewSet,basename='chats')
+router.register(r'conversations', ConversationViewSet,basename='conversations')
+router.register(r'health', HealthViewSet,basename='health')
+router.register(r'stats', StatsViewSet,basename='stats')
+router.register(r'profiles', ProfileViewSet,basename='profiles')
 
 urlpatterns = [
     path('', include(router.urls)),
@@ -1,11 +1,17 @@
-from PyPDF2 import PdfReader
 import hashlib
 import logging
+import os
+import re
 import uuid
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, Optional
+
+import numpy as np
 from django.core.files.uploadedfile import UploadedFile
 
+from .extractors import DocumentTooLargeError, get_extractor, get_fast_chunker
+
 bytes_chunk_size = 4096 # 4KB will be read at a time while calculating hash
+file_read_chunk_size = 1024 * 1024 # 1MB reads when hashing files from disk
 
 def calculate_hash(file: UploadedFile) -> str:
     """
@@ -28,6 +34,24 @@ def calculate_hash(file: UploadedFile) -> str:
     
     return hash_md5.hexdigest()
 
+def calculate_file_hash(file_path: str) -> str:
+    """
+    Calculate MD5 hash of a file on disk
+    
+    Args:
+        file_path: Path to the file
+        
+    Returns:
+        MD5 hash as hexadecimal string
+    """
+    # same hash as calculate_hash, used when files are read from disk
+    # instead of being uploaded (e.g. bulk import)
+    hash_md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(file_read_chunk_size), b''):
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
 def extract_text_from_pdf(pdf_path: str) -> Tuple[str, int]:
     """
     Extract all text from a PDF file
@@ -38,6 +62,8 @@ def extract_text_from_pdf(pdf_path: str) -> Tuple[str, int]:
     Returns:
         Tuple of (extracted_text, page_count)
     """
+    from PyPDF2 import PdfReader
+
     reader = PdfReader(pdf_path)
     full_text = ""
     
@@ -48,73 +74,227 @@ def extract_text_from_pdf(pdf_path: str) -> Tuple[str, int]:
     
     return full_text, len(reader.pages)
 
+def extract_text(file_path: str, content_type: Optional[str] = None) -> Tuple[str, int]:
+    """
+    Extract all text from any supported file
+    
+    Args:
+        file_path: Path to the file
+        content_type: Optional MIME type, used when the extension is unknown
+        
+    Returns:
+        Tuple of (extracted_text, section_count)
+    """
+    sections = list(get_extractor(file_path, content_type)(file_path))
+    return "\n".join(section for section in sections if section), len(sections)
+
 def chunk_text_by_page(pdf_path: str, document_id: str) -> Tuple[List[str], List[Dict], List[str]]:
     """
-    Extract and chunk PDF text by page
+    Extract and chunk text by page (or section for non-PDF files)
     
     Args:
-        pdf_path: Path to the PDF file
+        pdf_path: Path to the file
         document_id: UUID of the document in database
         
     Returns:
         Tuple of (chunks, metadatas, ids)
     """
-    reader = PdfReader(pdf_path)
     chunks = []
     metadatas = []
     ids = []
     
-    for i, page in enumerate(reader.pages):
-        text = page.extract_text()
-        
+    for i, text in enumerate(get_extractor(pdf_path)(pdf_path)):
         if text and text.strip():
             chunks.append(text)
             metadatas.append({
                 "document_id": document_id,
-                "source": pdf_path,
-                "page": i + 1,
-                "chunk_type": "page"
+                "page": i + 1
             })
             ids.append(str(uuid.uuid4()))
     
     return chunks, metadatas, ids
 
 
-def chunk_text_by_size(pdf_path: str, document_id: str, chunk_size: int = 1000, overlap: int = 200) -> Tuple[List[str], List[Dict], List[str]]:
+def chunk_file(
+    file_path: str,
+    document_id: str,
+    chunk_size: int = 1000,
+    overlap: int = 200,
+    max_pages: Optional[int] = None,
+    content_type: Optional[str] = None
+) -> Tuple[List[str], List[Dict], List[str], Dict]:
     """
-    Chunk text by character count with overlap
+    Chunk any supported file by character count with overlap
+    
+    Sections are streamed from the extractor registry one at a time, formats
+    with a fast chunker (plain text) are chunked straight from the file.
+    Kept free of database access so it can run in a process pool. Chunk
+    metadata only holds the document id, page and chunk index, the file
+    name and path are looked up from the Document table when needed.
     
     Args:
-        pdf_path: Path to the PDF file
+        file_path: Path to the file
+        document_id: UUID of the document in database
         chunk_size: Size of each chunk in characters
         overlap: Number of characters to overlap between chunks
+        max_pages: Stop and raise DocumentTooLargeError past this many pages/sections
+        content_type: Optional MIME type of the upload, used when the extension is unknown
         
     Returns:
-        List of text chunks
+        Tuple of (chunks, metadatas, ids, stats) where stats holds
+        the number of pages/sections and characters read
     """
-    reader = PdfReader(pdf_path)
     chunks = []
     metadatas = []
     ids = []
-    
-    for page_num, page in enumerate(reader.pages):
-        text = page.extract_text()
+    stats = {"pages": 0, "characters": 0}
+
+    def add_chunk(page: int, chunk_index: int, chunk: str):
+        chunks.append(chunk)
+        metadatas.append({
+            "document_id": document_id,
+            "page": page,
+            "chunk_index": chunk_index
+        })
+        ids.append(str(uuid.uuid4()))
+
+    fast_chunker = get_fast_chunker(file_path)
+    if fast_chunker is not None:
+        for page, chunk_index, chunk in fast_chunker(file_path, chunk_size, overlap):
+            add_chunk(page, chunk_index, chunk)
+        stats["pages"] = 1
+        stats["characters"] = count_utf8_characters(file_path)
+        return chunks, metadatas, ids, stats
+
+    for page_num, text in enumerate(get_extractor(file_path, content_type)(file_path)):
+        stats["pages"] += 1
+        if max_pages is not None and stats["pages"] > max_pages:
+            raise DocumentTooLargeError(f"Document has more than {max_pages} pages")
         if not text or not text.strip():
             continue
+        stats["characters"] += len(text)
         start = 0
         chunk_index = 0
         while start < len(text):
             end = start + chunk_size
-            chunk = text[start:end]
-            chunks.append(chunk)
-            metadatas.append({
-                "document_id": document_id,
-                "source": pdf_path,
-                "page": page_num + 1,
-                "chunk_type": "size",
-                "chunk_index": chunk_index
-            })
-            ids.append(str(uuid.uuid4()))
+            add_chunk(page_num + 1, chunk_index, text[start:end])
             start += (chunk_size - overlap)
             chunk_index += 1
-    return chunks, metadatas, ids
\ No newline at end of file
+    return chunks, metadatas, ids, stats
+
+
+_utf8_continuation_bytes = bytes(range(0x80, 0xC0))
+
+def count_utf8_characters(file_path: str) -> int:
+    """ Number of characters of a UTF-8 file, counted without decoding it """
+    characters = 0
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(file_read_chunk_size), b''):
+            # every character has exactly one byte that is not a continuation byte
+            characters += len(block.translate(None, _utf8_continuation_bytes))
+    return characters
+
+
+def chunk_text_by_size(pdf_path: str, document_id: str, chunk_size: int = 1000, overlap: int = 200) -> Tuple[List[str], List[Dict], List[str]]:
+    """
+    Chunk text by character count with overlap
+    
+    Args:
+        pdf_path: Path to the file
+        chunk_size: Size of each chunk in characters
+        overlap: Number of characters to overlap between chunks
+        
+    Returns:
+        Tuple of (chunks, metadatas, ids)
+    """
+    chunks, metadatas, ids, _ = chunk_file(pdf_path, document_id, chunk_size, overlap)
+    return chunks, metadatas, ids
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token count of a text, ~4 characters per token for English
+
+    Args:
+        text: Text to estimate
+
+    Returns:
+        Estimated number of tokens
+    """
+    return len(text) // 4 + 1
+
+
+# ===== NEAR-DUPLICATE DETECTION =====
+_word_re = re.compile(r"\w+")
+SIMHASH_BANDS = 4 # 16 bit bands, fingerprints within 3 bits share at least one
+
+
+def simhash(text: str, shingle_size: int = 3) -> int:
+    """
+    64 bit SimHash of a text over its word shingles
+
+    Texts that differ in a few words (page numbers, dates in a footer)
+    get fingerprints a few bits apart.
+
+    Args:
+        text: Text to fingerprint
+        shingle_size: Words per shingle
+
+    Returns:
+        Fingerprint as an unsigned 64 bit integer
+    """
+    words = _word_re.findall(text.lower())
+    if len(words) > shingle_size:
+        words = [" ".join(words[i:i + shingle_size]) for i in range(len(words) - shingle_size + 1)]
+    # distinct shingles vote once, so phrases repeated within a chunk do not
+    # make chunks with different content look alike
+    shingles = set(words)
+    if not shingles:
+        return 0
+    digests = b"".join(hashlib.blake2b(shingle.encode(), digest_size=8).digest() for shingle in shingles)
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8).reshape(len(shingles), 8), axis=1)
+    # every shingle votes for the bits of its hash
+    votes = (2 * bits.astype(np.int64) - 1).sum(axis=0)
+    return int.from_bytes(np.packbits(votes > 0).tobytes(), "big")
+
+
+def normalized_text_hash(text: str) -> str:
+    """
+    Hash of the lower-cased words of a text
+
+    Texts that differ only in case, punctuation or whitespace get the same hash.
+
+    Args:
+        text: Text to hash
+
+    Returns:
+        Hex digest
+    """
+    return hashlib.blake2b(" ".join(_word_re.findall(text.lower())).encode(), digest_size=16).hexdigest()
+
+
+def simhash_bands(fingerprint: int) -> List[int]:
+    """
+    Split a fingerprint into SIMHASH_BANDS bands, tagged with their position
+
+    Stored as a list in the chunk metadata so candidates can be found with
+    $contains on any band; simhash_from_bands restores the fingerprint.
+    """
+    width = 64 // SIMHASH_BANDS
+    mask = (1 << width) - 1
+    return [
+        (i << width) | ((fingerprint >> (64 - width * (i + 1))) & mask)
+        for i in range(SIMHASH_BANDS)
+    ]
+
+
+def simhash_from_bands(bands: List[int]) -> int:
+    """ Fingerprint stored as simhash_bands """
+    width = 64 // SIMHASH_BANDS
+    mask = (1 << width) - 1
+    return sum((band & mask) << (64 - width * ((band >> width) + 1)) for band in bands)
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """ Number of differing bits of two fingerprints """
+    return (a ^ b).bit_count()
@@ -1,76 +1,625 @@
 # Chromadb services for vector storage and retrieval
-import chromadb
 from django.conf import settings
-from typing import List, Dict, Tuple, Optional
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError, transaction
+from django.db.models import F, Sum
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from typing import List, Dict, Tuple, Optional, Sequence
+import contextlib
 import os
-from chromadb.config import Settings
+import random
+import tempfile
+import threading
+import time
+import hashlib
+import heapq
+import itertools
 import logging
+from collections import Counter, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+from .logging_utils import sample_payload
+from .models import Document, EmbeddingVersion
+from .utils import (
+    estimate_tokens, hamming_distance, normalized_text_hash, simhash, simhash_bands, simhash_from_bands
+)
+from .vectorstores import file_lock
 
 # logger
 logger = logging.getLogger(__name__)
 
+def mmr_order(embeddings: np.ndarray, distances: np.ndarray, mmr_lambda: float) -> List[int]:
+    """
+    Order candidates by maximal marginal relevance
+
+    Each step picks the candidate maximising
+    lambda * relevance - (1 - lambda) * max similarity to the picked ones,
+    all scores computed at once with NumPy.
+
+    Args:
+        embeddings: Candidate embeddings, one row per candidate
+        distances: Squared L2 distances of the candidates to the query
+        mmr_lambda: 1.0 = relevance only, 0.0 = diversity only
+
+    Returns:
+        Candidate indices, most marginally relevant first
+    """
+    vectors = embeddings / np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+    # squared L2 between unit vectors is 2 - 2 * cosine
+    relevance = 1.0 - distances / 2.0
+    similarity = vectors @ vectors.T
+
+    remaining = np.ones(len(vectors), dtype=bool)
+    max_similarity = np.full(len(vectors), -np.inf)
+    order = []
+    for _ in range(len(vectors)):
+        scores = relevance if not order else mmr_lambda * relevance - (1 - mmr_lambda) * max_similarity
+        scores = np.where(remaining, scores, -np.inf)
+        picked = int(np.argmax(scores))
+        order.append(picked)
+        remaining[picked] = False
+        max_similarity = np.maximum(max_similarity, similarity[picked])
+    return order
+
+
+def select_chunks(
+    documents: List[str],
+    distances: List[float],
+    embeddings: Optional[Sequence] = None,
+    k: int = 3,
+    max_distance: Optional[float] = None,
+    mmr_lambda: Optional[float] = None,
+    token_budget: Optional[int] = None
+) -> List[int]:
+    """
+    Pick the chunks to put in the prompt from the retrieved candidates
+
+    Candidates past max_distance are dropped, the rest are ranked by MMR
+    (when mmr_lambda is set) so overlapping near-duplicate chunks are not
+    all picked, then up to k chunks are taken in that order while they fit
+    in the token budget. The best candidate is always kept.
+
+    Args:
+        documents: Candidate chunk texts, best match first
+        distances: Candidate distances to the query
+        embeddings: Candidate embeddings, needed for MMR
+        k: Maximum number of chunks
+        max_distance: Distance cutoff
+        mmr_lambda: MMR trade-off, None keeps the distance order
+        token_budget: Estimated tokens of chunk text allowed
+
+    Returns:
+        Indices of the selected candidates
+    """
+    candidates = [i for i, distance in enumerate(distances) if max_distance is None or distance <= max_distance]
+    if mmr_lambda is not None and len(candidates) > 1:
+        order = mmr_order(
+            np.asarray([embeddings[i] for i in candidates], dtype=np.float32),
+            np.asarray([distances[i] for i in candidates], dtype=np.float32),
+            mmr_lambda
+        )
+        candidates = [candidates[i] for i in order]
+
+    selected = []
+    used_tokens = 0
+    for i in candidates:
+        if len(selected) == k:
+            break
+        tokens = estimate_tokens(documents[i])
+        if token_budget is not None and selected and used_tokens + tokens > token_budget:
+            continue
+        selected.append(i)
+        used_tokens += tokens
+    return selected
+
+
+def create_embedding_function(model_name: str):
+    """
+    Embedding function for an embedding model name
+
+    'all-MiniLM-L6-v2' is chromadb's built-in ONNX model, 'ollama/<model>'
+    embeds with the Ollama server at EMBEDDING_OLLAMA_URL and any other name
+    is loaded with sentence-transformers.
+    """
+    from chromadb.utils import embedding_functions
+
+    if model_name == 'all-MiniLM-L6-v2':
+        return embedding_functions.DefaultEmbeddingFunction()
+    if model_name.startswith('ollama/'):
+        return embedding_functions.OllamaEmbeddingFunction(
+            url=getattr(settings, 'EMBEDDING_OLLAMA_URL', 'http://localhost:11434'),
+            model_name=model_name[len('ollama/'):]
+        )
+    try:
+        return embedding_functions.SentenceTransformerEmbeddingFunction(model_name=model_name)
+    except ValueError:
+        raise ImproperlyConfigured(f"Embedding model {model_name} requires the sentence-transformers package")
+
+
+class _FingerprintIndex:
+    """
+    SimHash fingerprints by band, to find a near-duplicate without comparing all pairs
+
+    Fingerprints within 3 bits of each other share at least one of the four
+    bands, so only the fingerprints sharing a band are compared.
+    """
+
+    def __init__(self, max_distance: int):
+        self.max_distance = max_distance
+        self._fingerprints = {}
+        self._by_band = defaultdict(list)
+
+    def add(self, key: str, fingerprint: int) -> None:
+        self._fingerprints[key] = fingerprint
+        for band in simhash_bands(fingerprint):
+            self._by_band[band].append(key)
+
+    def find(self, fingerprint: int) -> Optional[str]:
+        """ Key of the first fingerprint within max_distance bits, None if there is none """
+        for band in simhash_bands(fingerprint):
+            for key in self._by_band.get(band, ()):
+                if hamming_distance(fingerprint, self._fingerprints[key]) <= self.max_distance:
+                    return key
+        return None
+
+
+def jump_consistent_hash(key: int, num_buckets: int) -> int:
+    """
+    Jump consistent hash (Lamping & Veach)
+
+    Maps a 64-bit key to one of num_buckets buckets. Growing from n to n + 1
+    buckets only moves ~1/(n + 1) of the keys, all of them into the new
+    bucket, which keeps shard rebalancing cheap.
+    """
+    bucket, j = -1, 0
+    while j < num_buckets:
+        bucket = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
 class ChromaDBService:
-    def __init__(self):
-        """ Initialize the ChromaDB client """
+    def __init__(self, mode: Optional[str] = None):
+        """
+        Initialize the ChromaDB client
+
+        Args:
+            mode (Optional[str]): 'embedded' or 'http', defaults to settings.CHROMA_MODE
+        """
+        self.mode = mode or getattr(settings, 'CHROMA_MODE', 'embedded')
+        self.client = self._create_client()
+
+        #collection names
+        self.DOCUMENT_COLLECTION_NAME = 'documents'
+        self.QUERY_COLLECTION_NAME = 'cached_queries'
+
+        # document chunks are spread over DOCUMENT_SHARDS collections by document id,
+        # optionally stored in separate directories (DOCUMENT_SHARD_PATHS)
+        self.num_shards = max(1, getattr(settings, 'DOCUMENT_SHARDS', 1))
+        self.shard_paths = [str(path) for path in getattr(settings, 'DOCUMENT_SHARD_PATHS', [])]
+        self._shard_clients = {}
+        self._shard_executor = ThreadPoolExecutor(
+            max_workers=min(self.num_shards, 16),
+            thread_name_prefix='shard-search'
+        ) if self.num_shards > 1 else None
+
+        # semantic cache policy
+        self.cache_max_entries = getattr(settings, 'QUERY_CACHE_MAX_ENTRIES', 10000)
+        self.cache_ttl = getattr(settings, 'QUERY_CACHE_TTL', None)
+        self.cache_eviction_policy = getattr(settings, 'QUERY_CACHE_EVICTION_POLICY', 'lru')
+        self.cache_sweep_interval = getattr(settings, 'QUERY_CACHE_SWEEP_INTERVAL', 300)
+        self.cache_hit_flush_interval = getattr(settings, 'QUERY_CACHE_HIT_FLUSH_INTERVAL', 30)
+        self.cache_eviction_sample = getattr(settings, 'QUERY_CACHE_EVICTION_SAMPLE', 1000)
+        self._last_cache_sweep = 0.0
+        # entries counted at the last size check plus the ones added since, recounted
+        # once past the cap or every QUERY_CACHE_SWEEP_INTERVAL (other processes add too)
+        self._cache_size_estimate = None
+        self._last_cache_count = 0.0
+        # cache hits not written to the collection yet, (version, chat id) -> (hits, last hit time)
+        self._pending_hits = {}
+        self._pending_hits_lock = threading.Lock()
+        self._last_hit_flush = time.monotonic()
+
+        # collections are versioned by embedding model (EmbeddingVersion), the active
+        # version and the one being built are re-read every EMBEDDING_VERSION_CHECK_INTERVAL
+        self.version_check_interval = getattr(settings, 'EMBEDDING_VERSION_CHECK_INTERVAL', 10)
+        self._versions = None
+        self._versions_loaded_at = 0.0
+        self._versions_lock = threading.Lock()
+
+        # collection handles per version, created once and reused by every call
+        self._documents_collections = {}
+        self._queries_collections = {}
+
+        # duplicate chunks are stored once per shard, the stored chunk lists every
+        # document containing it in its document_ids metadata (see add_document_chunks)
+        dedup = getattr(settings, 'CHUNK_DEDUP', {})
+        self.dedup_enabled = dedup.get('ENABLED', False)
+        self.dedup_max_distance = dedup.get('MAX_DISTANCE', 3)
+        self.dedup_min_words = dedup.get('MIN_WORDS', 8)
+        # matching and writing a document's chunks must not interleave with another upload (see _dedup_locked)
+        self._dedup_lock = threading.Lock()
+        # deduplication_stats are served from here for STATS_CACHE_SECONDS, (computed at, stats)
+        self.dedup_stats_cache_seconds = dedup.get('STATS_CACHE_SECONDS', 60)
+        self._dedup_stats = None
+
+        # embedding functions per model, shared by the cache probe and document retrieval
+        self._embedding_functions = {}
+        # runs document retrieval next to the cache probe
+        self._executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'RETRIEVAL_THREADS', 8),
+            thread_name_prefix='retrieval'
+        )
+
+    def _create_client(self, path: Optional[str] = None):
+        """
+        Create the vector store client for the configured backend and mode
+
+        With VECTOR_STORE_BACKEND 'faiss' the collections live in an
+        in-process FAISS index (see vectorstores.FaissClient). Otherwise,
+        ChromaDB 'embedded' opens the files under CHROMA_DB_PATH in-process,
+        which suits a single dev process. 'http' talks to a shared Chroma
+        server so that several workers share one index instead of each opening
+        (and caching) the same SQLite files; the client keeps its HTTP
+        connections alive.
+
+        Args:
+            path (Optional[str]): Storage directory, defaults to CHROMA_DB_PATH / FAISS_INDEX_PATH
+        """
+        if getattr(settings, 'VECTOR_STORE_BACKEND', 'chroma') == 'faiss':
+            return self._create_faiss_client(path)
+
+        # chromadb is imported here rather than at module level, it dominates
+        # the import time of the views (over a second) and is only needed
+        # once the service is created
+        import chromadb
+        from chromadb.config import Settings
+
+        if self.mode == 'http':
+            host = getattr(settings, 'CHROMA_HOST', 'localhost')
+            port = getattr(settings, 'CHROMA_PORT', 8002)
+            logger.info(f"Connecting to ChromaDB server at {host}:{port}")
+            return chromadb.HttpClient(
+                host=host,
+                port=port,
+                settings=Settings(anonymized_telemetry=False)
+            )
+
         # Chromdb_path
-        chromadb_path = getattr(settings, 'CHROMA_DB_PATH', './chromadb_data')
+        chromadb_path = path or getattr(settings, 'CHROMA_DB_PATH', './chromadb_data')
 
         # ensure directory exists
         os.makedirs(chromadb_path, exist_ok=True)
 
         # initialize chromadb persistent client
-        self.client = chromadb.PersistentClient(path=chromadb_path)
+        return chromadb.PersistentClient(path=chromadb_path)
 
-        #collection names
-        self.DOCUMENT_COLLECTION_NAME = 'documents'
-        self.QUERY_COLLECTION_NAME = 'cached_queries'
+    def _create_faiss_client(self, path: Optional[str] = None):
+        """ Create the in-process FAISS client from settings.FAISS_INDEX """
+        try:
+            import faiss  # noqa: F401
+        except ImportError:
+            raise ImproperlyConfigured("VECTOR_STORE_BACKEND 'faiss' requires the faiss-cpu package")
+        from .vectorstores import FaissClient
 
-    def get_or_create_documents_collection(self):
-        """ Get or create document collection """
-        return self.client.get_or_create_collection(
-            name=self.DOCUMENT_COLLECTION_NAME,
-            metadata={"description": "document chunks for RAG"}
+        options = getattr(settings, 'FAISS_INDEX', {})
+        index_path = path or getattr(settings, 'FAISS_INDEX_PATH', './faiss_index')
+        logger.info(f"Opening FAISS index at {index_path} ({options})")
+        return FaissClient(
+            path=index_path,
+            index_type=options.get('TYPE', 'hnsw'),
+            m=options.get('M', 32),
+            ef_construction=options.get('EF_CONSTRUCTION', 200),
+            ef_search=options.get('EF_SEARCH', 64),
+            quantization=options.get('QUANTIZATION'),
+            pq_m=options.get('PQ_M', 16),
+            train_size=options.get('TRAIN_SIZE', 10000),
+            mmap=options.get('MMAP', True),
+            persist_every=options.get('PERSIST_EVERY', 1000),
         )
+
+    def get_versions(self) -> Tuple[EmbeddingVersion, Optional[EmbeddingVersion]]:
+        """
+        Active embedding version and the version being built, if any
+
+        Read from the database at most every EMBEDDING_VERSION_CHECK_INTERVAL
+        seconds, so every process switches shortly after a cutover.
+        """
+        now = time.monotonic()
+        if self._versions is None or now - self._versions_loaded_at > self.version_check_interval:
+            with self._versions_lock:
+                if self._versions is None or now - self._versions_loaded_at > self.version_check_interval:
+                    self._versions = self._load_versions()
+                    self._versions_loaded_at = now
+        return self._versions
+
+    def _load_versions(self) -> Tuple[EmbeddingVersion, Optional[EmbeddingVersion]]:
+        model_name = getattr(settings, 'EMBEDDING_MODEL', 'all-MiniLM-L6-v2')
+        try:
+            with transaction.atomic():
+                versions = {
+                    version.status: version
+                    for version in EmbeddingVersion.objects.filter(status__in=['active', 'building'])
+                }
+                active = versions.get('active')
+                if active is None:
+                    # collections created before versioning hold EMBEDDING_MODEL vectors
+                    active, _ = EmbeddingVersion.objects.get_or_create(
+                        version=1, defaults={'model_name': model_name, 'status': 'active'}
+                    )
+                return active, versions.get('building')
+        except DatabaseError:
+            # the table does not exist yet (earlier data migrations), only version 1 does
+            return EmbeddingVersion(version=1, model_name=model_name, status='active'), None
+
+    def _version_suffix(self, version: EmbeddingVersion) -> str:
+        # version 1 keeps the collection names from before versioning
+        return "" if version.version == 1 else f"-v{version.version}"
+
+    def shard_collection_name(self, shard: int, version: Optional[EmbeddingVersion] = None) -> str:
+        """ Collection name of a shard (of the active version), shard 0 keeps the unsharded name """
+        name = self.DOCUMENT_COLLECTION_NAME + self._version_suffix(version or self.get_versions()[0])
+        return name if shard == 0 else f"{name}_{shard}"
+
+    def queries_collection_name(self, version: Optional[EmbeddingVersion] = None) -> str:
+        """ Name of the cached questions collection (of the active version) """
+        return self.QUERY_COLLECTION_NAME + self._version_suffix(version or self.get_versions()[0])
+
+    def shard_for_document(self, document_id: str) -> int:
+        """ Shard holding the chunks of a document """
+        key = int(hashlib.md5(str(document_id).encode()).hexdigest()[:16], 16)
+        return jump_consistent_hash(key, self.num_shards)
+
+    def get_shard_client(self, shard: int):
+        """ Client storing a shard, one per DOCUMENT_SHARD_PATHS directory """
+        if not self.shard_paths or self.mode == 'http':
+            return self.client
+        path = self.shard_paths[shard % len(self.shard_paths)]
+        if path not in self._shard_clients:
+            self._shard_clients[path] = self._create_client(path)
+        return self._shard_clients[path]
+
+    def get_or_create_documents_collection(self, shard: int = 0, version: Optional[EmbeddingVersion] = None):
+        """ Get or create document collection (of a shard, of the active version) """
+        version = version or self.get_versions()[0]
+        key = (version.version, shard)
+        if key not in self._documents_collections:
+            self._documents_collections[key] = self.get_shard_client(shard).get_or_create_collection(
+                name=self.shard_collection_name(shard, version),
+                metadata={"description": "document chunks for RAG", "embedding_model": version.model_name}
+            )
+        return self._documents_collections[key]
     
-    def get_or_create_queries_collection(self):
-        """ Get or create query collection """
-        return self.client.get_or_create_collection(
-            name=self.QUERY_COLLECTION_NAME,
-            metadata={"description": "cached query for similarity search for RAG"}
-        )
+    def get_or_create_queries_collection(self, version: Optional[EmbeddingVersion] = None):
+        """ Get or create query collection (of the active version) """
+        version = version or self.get_versions()[0]
+        if version.version not in self._queries_collections:
+            self._queries_collections[version.version] = self.client.get_or_create_collection(
+                name=self.queries_collection_name(version),
+                metadata={"description": "cached query for similarity search for RAG", "embedding_model": version.model_name}
+            )
+        return self._queries_collections[version.version]
+
+    def get_embedding_function(self, version: Optional[EmbeddingVersion] = None):
+        """ Embedding function of a version (the active one by default), loaded once per model """
+        model_name = (version or self.get_versions()[0]).model_name
+        if model_name not in self._embedding_functions:
+            self._embedding_functions[model_name] = create_embedding_function(model_name)
+        return self._embedding_functions[model_name]
+
+    @property
+    def embedding_function(self):
+        """ The embedding function of the active version """
+        return self.get_embedding_function()
+
+    def embed_queries(self, queries: List[str], version: Optional[EmbeddingVersion] = None) -> List:
+        """
+        Embed queries once so several searches can reuse the vectors
+
+        Texts are always embedded here rather than by the collections, with
+        the model of the version they are stored in or searched against.
+
+        Args:
+            queries: Query (or chunk) texts
+            version: Embedding version, defaults to the active one
+
+        Returns:
+            One embedding per query
+        """
+        embedding_function = self.get_embedding_function(version)
+        return [np.asarray(embedding, dtype=np.float32) for embedding in embedding_function(queries)]
+
+    def warm_up(self) -> None:
+        """
+        Open both collections and run one embedding + query so the embedding
+        model and the indexes are loaded before the first request
+        """
+        self.get_or_create_queries_collection()
+        query_embeddings = self.embed_queries(["warm up"])
+        for shard in range(self.num_shards):
+            self.get_or_create_documents_collection(shard).query(query_embeddings=query_embeddings, n_results=1)
     
+    def _dedup_lock_path(self) -> str:
+        """
+        Lock file of the deduplicating writers of this host
+
+        CHUNK_DEDUP LOCK_PATH when set, otherwise next to the local store: the
+        FAISS index directory or CHROMA_DB_PATH. A ChromaDB server has no local
+        store, its lock file is named after the server in the temp directory.
+        """
+        lock_path = getattr(settings, 'CHUNK_DEDUP', {}).get('LOCK_PATH')
+        if lock_path:
+            return str(lock_path)
+        if getattr(settings, 'VECTOR_STORE_BACKEND', 'chroma') == 'faiss':
+            lock_dir = getattr(settings, 'FAISS_INDEX_PATH', './faiss_index')
+        elif self.mode == 'http':
+            host = getattr(settings, 'CHROMA_HOST', 'localhost')
+            port = getattr(settings, 'CHROMA_PORT', 8002)
+            return os.path.join(tempfile.gettempdir(), f"raglite-dedup-{host}-{port}.lock")
+        else:
+            lock_dir = getattr(settings, 'CHROMA_DB_PATH', './chromadb_data')
+        os.makedirs(lock_dir, exist_ok=True)
+        return os.path.join(lock_dir, 'dedup.lock')
+
+    @contextlib.contextmanager
+    def _dedup_locked(self):
+        """
+        Serialize deduplicating writers across threads and the processes of this host
+
+        The lock file (see _dedup_lock_path) covers every worker process of
+        the host. Hosts sharing one ChromaDB server are not serialized with
+        each other: run uploads with CHUNK_DEDUP on from a single host there.
+        """
+        with self._dedup_lock, file_lock(self._dedup_lock_path()):
+            yield
+
     # add document chunks to the collection
     def add_document_chunks(
         self,
         chunks: List[str],
         metadatas: List[Dict],
-        ids: List[str]
+        ids: List[str],
+        duplicates: Optional[Dict[str, int]] = None
     ) -> int:
         """ 
-        Add document chunks to the collection 
+        Add document chunks to the collection, each to the shard of its document
+
+        With CHUNK_DEDUP, a chunk with the same normalized text as one already
+        stored in the shard (or an earlier chunk of this call) is not stored or
+        embedded; its document is added to the document_ids of the stored
+        chunk instead. Near-duplicates are only merged by deduplicate_chunks. While a new embedding version is being built the
+        chunks are written to both versions, so the backfill does not miss them.
 
         Args:
             chunks (List[str]): List of document chunks
-            metadatas (List[Dict]): List of metadata for each chunk
+            metadatas (List[Dict]): List of metadata for each chunk, stored chunks get their fingerprint added
             ids (List[str]): List of ids for each chunk
+            duplicates (Optional[Dict[str, int]], optional): Filled with the number of linked
+                (not stored) chunks per document id. Defaults to None.
 
         Returns:
-            int: Number of chunks added
+            int: Number of chunks stored
         """
-        collection = self.get_or_create_documents_collection()
-        collection.add(
-            documents=chunks,
-            metadatas=metadatas,
-            ids=ids
-        )
-        return len(chunks)
+        by_shard = defaultdict(list)
+        for i, metadata in enumerate(metadatas):
+            by_shard[self.shard_for_document(metadata.get("document_id", ""))].append(i)
+        active, building = self.get_versions()
+        stored = 0
+        with self._dedup_locked() if self.dedup_enabled else contextlib.nullcontext():
+            for shard, indexes in by_shard.items():
+                links = {}
+                if self.dedup_enabled:
+                    indexes, links = self._link_duplicates(
+                        self.get_or_create_documents_collection(shard, active), chunks, metadatas, ids, indexes, duplicates
+                    )
+                stored += len(indexes)
+                for version in [active] + ([building] if building else []):
+                    collection = self.get_or_create_documents_collection(shard, version)
+                    # the backfill may have copied the chunk already
+                    write = collection.add if version is active else collection.upsert
+                    # chromadb rejects batches above the client's max batch size,
+                    # so large inputs (e.g. bulk import) are written in slices
+                    batch_size = self.get_shard_client(shard).get_max_batch_size()
+                    for start in range(0, len(indexes), batch_size):
+                        part = indexes[start:start + batch_size]
+                        documents = [chunks[i] for i in part]
+                        write(
+                            documents=documents,
+                            metadatas=[metadatas[i] for i in part],
+                            ids=[ids[i] for i in part],
+                            embeddings=self.embed_queries(documents, version)
+                        )
+                    if links:
+                        # the version being built only has the chunks copied so far,
+                        # the others get the new links when they are copied
+                        linked = list(links) if version is active else collection.get(ids=list(links), include=[])['ids']
+                        if linked:
+                            collection.update(ids=linked, metadatas=[links[chunk_id] for chunk_id in linked])
+        return stored
+
+    def _link_duplicates(
+        self,
+        collection,
+        chunks: List[str],
+        metadatas: List[Dict],
+        ids: List[str],
+        indexes: List[int],
+        duplicates: Optional[Dict[str, int]]
+    ) -> Tuple[List[int], Dict[str, Dict]]:
+        """
+        Find the duplicates among new chunks of one shard
+
+        Chunks are duplicates when their normalized text (lower-cased words)
+        is the same; stored chunks with the text hash of a new chunk are
+        fetched in a few metadata queries. New chunks that are kept get their
+        text hash and SimHash bands (and links, when a later chunk duplicates
+        them) in their metadata, the bands let deduplicate_chunks find
+        near-duplicates later.
+
+        Returns:
+            Indexes of the chunks to store, and the metadata updates of
+            stored chunks gaining a document, by chunk id
+        """
+        text_hashes = {
+            i: normalized_text_hash(chunks[i]) for i in indexes
+            if len(chunks[i].split()) >= self.dedup_min_words
+        }
+        stored = {}
+        by_hash = {}
+        hashes = sorted(set(text_hashes.values()))
+        for start in range(0, len(hashes), 100):
+            rows = collection.get(where={"text_hash": {"$in": hashes[start:start + 100]}}, include=["metadatas"])
+            for chunk_id, metadata in zip(rows['ids'], rows['metadatas']):
+                stored[chunk_id] = metadata
+                by_hash.setdefault(metadata["text_hash"], chunk_id)
+
+        keep = []
+        new_chunks = {}
+        links = {}
+        for i in indexes:
+            text_hash = text_hashes.get(i)
+            match = by_hash.get(text_hash) if text_hash is not None else None
+            if match is None:
+                if text_hash is not None:
+                    metadatas[i] = {**metadatas[i], "text_hash": text_hash, "simhash": simhash_bands(simhash(chunks[i]))}
+                    by_hash[text_hash] = ids[i]
+                    new_chunks[ids[i]] = i
+                keep.append(i)
+                continue
+            document_id = metadatas[i].get("document_id", "")
+            if duplicates is not None:
+                duplicates[document_id] = duplicates.get(document_id, 0) + 1
+            metadata = metadatas[new_chunks[match]] if match in new_chunks else stored[match]
+            document_ids = metadata.get("document_ids") or [metadata.get("document_id", "")]
+            if document_id in document_ids:
+                continue
+            metadata = {**metadata, "document_ids": document_ids + [document_id]}
+            if match in new_chunks:
+                metadatas[new_chunks[match]] = metadata
+            else:
+                stored[match] = metadata
+                links[match] = {"document_ids": metadata["document_ids"]}
+        return keep, links
+
+    def document_filter(self, document_id: str) -> Dict:
+        """ Where clause matching the chunks of a document, including chunks shared with other documents """
+        return {"$or": [{"document_id": document_id}, {"document_ids": {"$contains": document_id}}]}
     
     # search for relevant document chunks
     def search_document_chunks(
         self,
         query:str,
         k:int=3,
-        document_id:Optional[str]=None
+        document_id:Optional[str]=None,
+        max_distance:Optional[float]=None,
+        mmr_lambda:Optional[float]=None,
+        token_budget:Optional[int]=None,
+        query_embedding:Optional[Sequence]=None,
+        version:Optional[EmbeddingVersion]=None
     ) -> Dict:
         """ 
         Search for relevant document chunks 
@@ -79,18 +628,113 @@ class ChromaDBService:
             query (str): Query to search for
             k (int, optional): Number of results to return. Defaults to 3.
             document_id (Optional[str], optional): Document id to search for. Defaults to None.
+            max_distance (Optional[float], optional): Drop chunks farther than this. Defaults to None.
+            mmr_lambda (Optional[float], optional): Re-select with maximal marginal relevance,
+                1.0 = relevance only, 0.0 = diversity only. Defaults to None (plain top-k).
+            token_budget (Optional[int], optional): Estimated tokens of chunk text allowed. Defaults to None.
+            query_embedding (Optional[Sequence], optional): Precomputed query embedding. Defaults to None.
+            version (Optional[EmbeddingVersion], optional): Version the embedding was made with. Defaults to the active one.
 
         Returns:
             Dict: Search results
         """
-        collection = self.get_or_create_documents_collection()
-        where_clause = {"document_id": document_id} if document_id else None
-        results = collection.query(
-            query_texts=[query],
-            n_results=k,
-            where=where_clause
+        return self.search_document_chunks_batch(
+            [query], k, document_id, max_distance, mmr_lambda, token_budget,
+            query_embeddings=[query_embedding] if query_embedding is not None else None,
+            version=version
         )
-        return results
+
+    def search_document_chunks_batch(
+        self,
+        queries:List[str],
+        k:int=3,
+        document_id:Optional[str]=None,
+        max_distance:Optional[float]=None,
+        mmr_lambda:Optional[float]=None,
+        token_budget:Optional[int]=None,
+        query_embeddings:Optional[List]=None,
+        version:Optional[EmbeddingVersion]=None
+    ) -> Dict:
+        """
+        Search relevant document chunks for many queries at once
+
+        The queries are embedded in one batch and searched with one
+        collection query per max batch size, instead of one round trip each.
+        Without a document_id every shard is searched in parallel and the
+        per-shard results, each sorted by distance, are merged with a heap.
+        With MMR or a token budget more candidates are fetched and the final
+        chunks are selected from them (see select_chunks).
+
+        Args:
+            queries (List[str]): Queries to search for
+            k (int, optional): Number of results per query. Defaults to 3.
+            document_id (Optional[str], optional): Document id to search in. Defaults to None.
+            max_distance (Optional[float], optional): Drop chunks farther than this. Defaults to None.
+            mmr_lambda (Optional[float], optional): MMR trade-off, None for plain top-k. Defaults to None.
+            token_budget (Optional[int], optional): Estimated tokens of chunk text allowed. Defaults to None.
+            query_embeddings (Optional[List], optional): Precomputed query embeddings. Defaults to None.
+            version (Optional[EmbeddingVersion], optional): Version the embeddings were made with. Defaults to the active one.
+
+        Returns:
+            Dict: Search results with one list per query, in input order
+        """
+        # embeddings and collections must come from the same version across a cutover
+        version = version or self.get_versions()[0]
+        if query_embeddings is None:
+            query_embeddings = self.embed_queries(queries, version)
+        # a document lives in one shard, other searches fan out to all of them
+        shards = [self.shard_for_document(document_id)] if document_id else list(range(self.num_shards))
+        where_clause = self.document_filter(document_id) if document_id else None
+        reselect = mmr_lambda is not None or token_budget is not None
+        fetch_k = k * getattr(settings, 'RETRIEVAL_FETCH_K_FACTOR', 4) if reselect else k
+        include = ["documents", "metadatas", "distances"] + (["embeddings"] if mmr_lambda is not None else [])
+
+        def query_shard(shard, embeddings):
+            return self.get_or_create_documents_collection(shard, version).query(
+                query_embeddings=embeddings,
+                n_results=fetch_k,
+                where=where_clause,
+                include=include
+            )
+
+        merged = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        batch_size = self.client.get_max_batch_size()
+        for start in range(0, len(queries), batch_size):
+            embeddings = query_embeddings[start:start + batch_size]
+            if len(shards) == 1:
+                shard_results = [query_shard(shards[0], embeddings)]
+            else:
+                shard_results = list(self._shard_executor.map(query_shard, shards, itertools.repeat(embeddings)))
+
+            for i in range(len(shard_results[0]["ids"])):
+                results = self._merge_shard_results(shard_results, i, fetch_k, include)
+                selected = select_chunks(
+                    results["documents"],
+                    results["distances"],
+                    results.get("embeddings"),
+                    k=k,
+                    max_distance=max_distance,
+                    mmr_lambda=mmr_lambda,
+                    token_budget=token_budget
+                )
+                for key in merged:
+                    merged[key].append([results[key][j] for j in selected])
+        return merged
+
+    def _merge_shard_results(self, shard_results: List[Dict], query_index: int, n: int, include: List[str]) -> Dict:
+        """ Top n candidates of one query over all shards, merged by distance with a heap """
+        keys = ["ids"] + include
+        if len(shard_results) == 1:
+            return {key: list(shard_results[0][key][query_index]) for key in keys}
+        ranked = heapq.merge(*[
+            [(distance, shard, j) for j, distance in enumerate(results["distances"][query_index])]
+            for shard, results in enumerate(shard_results)
+        ])
+        top = list(itertools.islice(ranked, n))
+        return {
+            key: [shard_results[shard][key][query_index][j] for _, shard, j in top]
+            for key in keys
+        }
     
     # delete document chunks
     def delete_document_chunks(self, document_id: str) -> int:
@@ -103,12 +747,54 @@ class ChromaDBService:
         Returns:
             int: Number of chunks deleted
         """
-        collection = self.get_or_create_documents_collection()
-        existing = collection.get(ids=[document_id])
-        if existing['ids']:
-            collection.delete(ids=[document_id])
-            return len(existing['ids'])
-        return 0
+        # chunk ids are random UUIDs, chunks are found through their document_id metadata;
+        # every shard is checked so chunks not yet moved by a rebalance are removed too,
+        # and a version being built loses them as well
+        active, building = self.get_versions()
+        deleted = 0
+        with self._dedup_locked() if self.dedup_enabled else contextlib.nullcontext():
+            for version in [active] + ([building] if building else []):
+                for shard in range(self.num_shards):
+                    collection = self.get_or_create_documents_collection(shard, version)
+                    removed, reassigned = self._unlink_document(collection, document_id)
+                    if version is active:
+                        deleted += removed
+                        # the chunk is now stored for the next document, no longer a duplicate of it
+                        for owner, count in reassigned.items():
+                            Document.objects.filter(id=owner).update(
+                                duplicate_chunk_count=Greatest(F('duplicate_chunk_count') - count, 0),
+                                updated_at=timezone.now()
+                            )
+        return deleted
+
+    def _unlink_document(self, collection, document_id: str) -> Tuple[int, Counter]:
+        """
+        Remove a document from one collection
+
+        Chunks shared with other documents are kept and handed to the next
+        document in their document_ids, the others are deleted.
+
+        Returns:
+            Number of chunks deleted, and chunks handed over per new document id
+        """
+        rows = collection.get(where=self.document_filter(document_id), include=["metadatas"])
+        removed, updated, changes = [], [], []
+        reassigned = Counter()
+        for chunk_id, metadata in zip(rows['ids'], rows['metadatas']):
+            document_ids = [linked for linked in (metadata or {}).get("document_ids") or [] if linked != document_id]
+            if not document_ids:
+                removed.append(chunk_id)
+                continue
+            if metadata.get("document_id") == document_id:
+                reassigned[document_ids[0]] += 1
+            updated.append(chunk_id)
+            # keys set to None are removed from the stored metadata
+            changes.append({"document_id": document_ids[0], "document_ids": document_ids if len(document_ids) > 1 else None})
+        if removed:
+            collection.delete(ids=removed)
+        if updated:
+            collection.update(ids=updated, metadatas=changes)
+        return len(removed), reassigned
     
     # checking if document exists
     def check_document_exists(self, document_id: str) -> bool:
@@ -121,9 +807,14 @@ class ChromaDBService:
         Returns:
             bool: True if document exists, False otherwise
         """
-        collection = self.get_or_create_documents_collection()
-        existing = collection.get(ids=[document_id])
-        return len(existing['ids']) > 0
+        home = self.shard_for_document(document_id)
+        for shard in [home] + [shard for shard in range(self.num_shards) if shard != home]:
+            existing = self.get_or_create_documents_collection(shard).get(
+                where=self.document_filter(document_id), limit=1, include=[]
+            )
+            if existing['ids']:
+                return True
+        return False
     
     # add query to the collection
     def add_cached_question(
@@ -140,18 +831,203 @@ class ChromaDBService:
             chat_id: UUID of the chat history record
             answer: The answer (stored in metadata)
         """
+        self.add_cached_questions([query], [chat_id], [answer])
+
+    def add_cached_questions(
+        self,
+        queries:List[str],
+        chat_ids:List[str],
+        answers:List[str]
+        ) -> None:
+        """
+        Add several questions to the cache in one call (one embedding batch)
+        
+        Args:
+            queries: The question texts
+            chat_ids: UUIDs of the chat history records
+            answers: The answers (stored in metadata)
+        """
+        now = time.time()
+        metadatas = [
+            {
+                "chat_id": chat_id,
+                "answer": answer[:500], # limit answer to 500 characters
+                # bookkeeping for TTL and LRU/LFU eviction
+                "created_at": now,
+                "last_hit_at": now,
+                "hit_count": 0,
+            }
+            for chat_id, answer in zip(chat_ids, answers)
+        ]
+        active, building = self.get_versions()
+        for version in [active] + ([building] if building else []):
+            collection = self.get_or_create_queries_collection(version)
+            write = collection.add if version is active else collection.upsert
+            write(
+                documents=queries,
+                metadatas=metadatas,
+                ids=chat_ids,
+                embeddings=self.embed_queries(queries, version)
+            )
+        if self._cache_size_estimate is not None:
+            self._cache_size_estimate += len(chat_ids)
+        self.enforce_cache_policy()
+
+    def _is_expired(self, metadata: Optional[Dict], now: float) -> bool:
+        """ Check if a cached question is past the cache TTL """
+        if not self.cache_ttl:
+            return False
+        return now - (metadata or {}).get("created_at", 0) > self.cache_ttl
+
+    def enforce_cache_policy(self, force: bool = False) -> int:
+        """
+        Apply the cache TTL and size cap to the cached questions
+        
+        Expired entries are swept at most every QUERY_CACHE_SWEEP_INTERVAL
+        seconds. The size is only counted again once the entries added since
+        the last count could exceed QUERY_CACHE_MAX_ENTRIES, or at the sweep
+        interval. Past the cap the cache is trimmed to 90% of it, evicting the
+        least recently hit entries ('lru') or the least hit ones ('lfu'),
+        judged on a sample rather than on every entry (see _evict). Called by
+        the background chat writer, never on the request path.
+        
+        Args:
+            force: Sweep expired entries and count the entries regardless of the intervals
+            
+        Returns:
+            Number of cached questions removed
+        """
         collection = self.get_or_create_queries_collection()
-        collection.add(
-            documents=[query],
-            metadatas=[{"chat_id": chat_id, "answer": answer[:500]}], # limit answer to 500 characters
-            ids=[chat_id]
-        )
+        now = time.time()
+        removed = 0
+
+        if self.cache_ttl and (force or now - self._last_cache_sweep > self.cache_sweep_interval):
+            self._last_cache_sweep = now
+            expired = collection.get(where={"created_at": {"$lt": now - self.cache_ttl}}, include=[])
+            if expired['ids']:
+                collection.delete(ids=expired['ids'])
+                removed += len(expired['ids'])
+
+        recount = force or self._cache_size_estimate is None or now - self._last_cache_count > self.cache_sweep_interval
+        if not recount and self._cache_size_estimate - removed <= self.cache_max_entries:
+            self._cache_size_estimate -= removed
+            return removed
+        count = collection.count()
+        self._cache_size_estimate = count
+        self._last_cache_count = now
+        if count <= self.cache_max_entries:
+            return removed
+
+        # trim below the cap so eviction does not run on every insert
+        target = int(self.cache_max_entries * 0.9)
+        self.flush_cache_hits()
+        evicted = self._evict(collection, count, count - target)
+        self._cache_size_estimate = count - len(evicted)
+        removed += len(evicted)
+        logger.info(f"Evicted {len(evicted)} cached questions ({self.cache_eviction_policy})")
+        return removed
+
+    def _evict(self, collection, count: int, evict: int) -> List[str]:
+        """
+        Delete about evict entries, the least recently or least often hit ones
+
+        Instead of loading the metadata of every entry, the LRU/LFU cutoff is
+        the matching quantile of QUERY_CACHE_EVICTION_SAMPLE entries read at
+        random offsets, and only the ids of entries at or below it are fetched.
+
+        Returns:
+            Ids of the evicted entries
+        """
+        field = "hit_count" if self.cache_eviction_policy == 'lfu' else "last_hit_at"
+        if count <= self.cache_eviction_sample:
+            sample = collection.get(include=["metadatas"])['metadatas']
+        else:
+            sample = []
+            page = max(1, self.cache_eviction_sample // 10)
+            for _ in range(10):
+                offset = random.randrange(0, count - page)
+                sample.extend(collection.get(include=["metadatas"], limit=page, offset=offset)['metadatas'])
+        values = sorted((metadata or {}).get(field, 0) for metadata in sample)
+        if not values:
+            return []
+        cutoff = values[min(len(values), -(-evict * len(values) // count)) - 1]
+        evicted = collection.get(where={field: {"$lte": cutoff}}, limit=evict, include=[])['ids']
+        max_batch = self.client.get_max_batch_size()
+        for start in range(0, len(evicted), max_batch):
+            collection.delete(ids=evicted[start:start + max_batch])
+        return evicted
+
+    def _record_hit(self, version: EmbeddingVersion, chat_id: str, now: float) -> None:
+        """ Count a cache hit in memory, hits are written in one batch every QUERY_CACHE_HIT_FLUSH_INTERVAL """
+        with self._pending_hits_lock:
+            hits, _ = self._pending_hits.get((version.version, chat_id), (0, now))
+            self._pending_hits[(version.version, chat_id)] = (hits + 1, now)
+            flush = time.monotonic() - self._last_hit_flush >= self.cache_hit_flush_interval
+            if flush:
+                self._last_hit_flush = time.monotonic()
+        if flush:
+            self._executor.submit(self.flush_cache_hits)
+
+    def record_cache_hit(self, chat_id: str) -> None:
+        """ Count a hit on a cached question answered outside find_similar_question, e.g. a coalesced query """
+        self._record_hit(self.get_versions()[0], chat_id, time.time())
+
+    def flush_cache_hits(self) -> None:
+        """ Add the hits counted since the last flush to the LRU/LFU bookkeeping of the cached questions """
+        with self._pending_hits_lock:
+            pending, self._pending_hits = self._pending_hits, {}
+        by_version = defaultdict(dict)
+        for (version_number, chat_id), hit in pending.items():
+            by_version[version_number][chat_id] = hit
+        for version_number, hits in by_version.items():
+            collection = self._queries_collections.get(version_number)
+            if collection is None:
+                continue
+            try:
+                stored = collection.get(ids=list(hits), include=["metadatas"])
+                # a question answered moments ago may still be queued in the chat writer,
+                # its recent hits are kept for the next flush
+                now = time.time()
+                with self._pending_hits_lock:
+                    for chat_id in hits.keys() - set(stored['ids']):
+                        count, last_hit_at = hits[chat_id]
+                        if now - last_hit_at < self.cache_hit_flush_interval:
+                            previous, latest = self._pending_hits.get((version_number, chat_id), (0, last_hit_at))
+                            self._pending_hits[(version_number, chat_id)] = (previous + count, max(latest, last_hit_at))
+                metadatas = []
+                for chat_id, metadata in zip(stored['ids'], stored['metadatas']):
+                    metadata = metadata or {}
+                    count, last_hit_at = hits[chat_id]
+                    metadatas.append({
+                        "hit_count": metadata.get("hit_count", 0) + count,
+                        "last_hit_at": max(last_hit_at, metadata.get("last_hit_at", 0)),
+                    })
+                if metadatas:
+                    # update merges the keys into the stored metadata
+                    collection.update(ids=stored['ids'], metadatas=metadatas)
+            except Exception as e:
+                logger.error(f"Recording {len(hits)} cache hits failed: {str(e)}")
+
+    def invalidate_cached_questions(self, chat_ids: List[str]) -> None:
+        """
+        Remove cached questions, e.g. when their source documents changed
+        
+        Args:
+            chat_ids: UUIDs of the chats whose cached questions are dropped
+        """
+        if not chat_ids:
+            return
+        active, building = self.get_versions()
+        for version in [active] + ([building] if building else []):
+            self.get_or_create_queries_collection(version).delete(ids=[str(chat_id) for chat_id in chat_ids])
     
     # search for relevant query
     def find_similar_question(
         self,
         query:str,
-        threshold:float=0.15
+        threshold:float=0.15,
+        query_embedding:Optional[Sequence]=None,
+        version:Optional[EmbeddingVersion]=None
     ) -> Optional[Tuple[str,float]]:
         """
         Find similar cached questions
@@ -159,24 +1035,469 @@ class ChromaDBService:
         Args:
             question: The question to search for
             threshold: Maximum distance for similarity (lower = more similar)
+            query_embedding: Precomputed embedding of the question
+            version: Version the embedding was made with, defaults to the active one
             
         Returns:
             Tuple of (chat_id, distance) if found, None otherwise
         """
-        collection = self.get_or_create_queries_collection()
+        version = version or self.get_versions()[0]
+        collection = self.get_or_create_queries_collection(version)
+        if query_embedding is None:
+            query_embedding = self.embed_queries([query], version)[0]
+        started = time.perf_counter()
         results = collection.query(
-            query_texts=[query],
+            query_embeddings=[query_embedding],
             n_results=1,
-            # include=["metadatas"],
+            include=["metadatas", "distances"],
         )
-        logger.info(f"Similarity search results: {results}")
+        elapsed_ms = round(1000 * (time.perf_counter() - started), 2)
+        best_distance = results['distances'][0][0] if results['ids'][0] else None
+        logger.info(
+            f"Similar question search: {len(results['ids'][0])} results in {elapsed_ms} ms",
+            extra={"event": "similar_question_search", "results": len(results['ids'][0]),
+                   "best_distance": best_distance, "elapsed_ms": elapsed_ms}
+        )
+        if sample_payload():
+            logger.info(f"Similarity search results: {results}", extra={"event": "similar_question_search_payload"})
         if not results['ids'][0]:
             return None
+        chat_id = results['ids'][0][0]
         distance = results['distances'][0][0]
-        if distance < threshold:
-            return results['ids'][0][0], distance
-        return None
+        metadata = results['metadatas'][0][0] or {}
+        if distance >= threshold:
+            return None
+
+        now = time.time()
+        if self._is_expired(metadata, now):
+            collection.delete(ids=[chat_id])
+            return None
+        # recorded for LRU/LFU eviction, written in batches off the request path
+        self._record_hit(version, chat_id, now)
+        return chat_id, distance
     
+    def probe_cache_and_search(
+        self,
+        query:str,
+        document_id:Optional[str]=None,
+        threshold:float=0.15,
+        retrieve:bool=True,
+        **search_options
+    ) -> Tuple[Optional[Tuple[str,float]], Optional[Future]]:
+        """
+        Look the question up in the semantic cache while retrieving its chunks
+
+        The query is embedded once, document retrieval starts on the
+        retrieval pool and the cache probe runs meanwhile, so a cache miss
+        costs one round trip instead of two. On a hit the caller drops (or
+        cancels) the retrieval.
+
+        Args:
+            query: The question
+            document_id: Document id to search in
+            threshold: Maximum distance for a cache hit
+            retrieve: Start the document retrieval, False only probes the cache
+            search_options: k, max_distance, mmr_lambda, token_budget of search_document_chunks
+
+        Returns:
+            Tuple of (find_similar_question result, future of the search results or None)
+        """
+        version = self.get_versions()[0]
+        query_embedding = self.embed_queries([query], version)[0]
+        search = None
+        if retrieve:
+            search = self._executor.submit(
+                self.search_document_chunks,
+                query,
+                document_id=document_id,
+                query_embedding=query_embedding,
+                version=version,
+                **search_options
+            )
+        similar = self.find_similar_question(query, threshold, query_embedding=query_embedding, version=version)
+        return similar, search
+
+    def rebalance_shards(self, from_shards: int, batch_size: int = 500) -> Dict[str, int]:
+        """
+        Move chunks to the shard of their document after DOCUMENT_SHARDS changed
+
+        Chunks are copied with their stored embeddings (nothing is
+        re-embedded), then removed from the old shard; collections of shards
+        that no longer exist are dropped once empty. A chunk shared by
+        documents that now live in different shards is copied to each of
+        them. Safe to re-run after an interruption.
+
+        Args:
+            from_shards: Number of shards before the change
+            batch_size: Chunks moved per call
+
+        Returns:
+            Dict with the number of chunks moved into each shard
+        """
+        moved = defaultdict(int)
+        for source in range(max(from_shards, self.num_shards)):
+            collection = self.get_or_create_documents_collection(source)
+            # collect the misplaced chunk ids first, moving them shifts the pages
+            misplaced = []
+            offset = 0
+            while True:
+                page = collection.get(include=["metadatas"], limit=batch_size, offset=offset)
+                if not page['ids']:
+                    break
+                misplaced.extend(
+                    chunk_id for chunk_id, metadata in zip(page['ids'], page['metadatas'])
+                    if set(self._shards_of_chunk(metadata or {})) != {source}
+                )
+                offset += len(page['ids'])
+
+            for start in range(0, len(misplaced), batch_size):
+                rows = collection.get(
+                    ids=misplaced[start:start + batch_size],
+                    include=["documents", "metadatas", "embeddings"]
+                )
+                by_target = defaultdict(list)
+                kept, kept_changes = [], []
+                for i, metadata in enumerate(rows['metadatas']):
+                    metadata = metadata or {}
+                    for target, document_ids in self._shards_of_chunk(metadata).items():
+                        if target == source:
+                            # the documents still in this shard keep the chunk in place
+                            kept.append(rows['ids'][i])
+                            kept_changes.append({
+                                "document_id": document_ids[0],
+                                "document_ids": document_ids if len(document_ids) > 1 else None
+                            })
+                            continue
+                        copy = {key: value for key, value in metadata.items() if key != "document_ids"}
+                        copy["document_id"] = document_ids[0]
+                        if len(document_ids) > 1:
+                            copy["document_ids"] = document_ids
+                        by_target[target].append((i, copy))
+                for target, entries in by_target.items():
+                    self.get_or_create_documents_collection(target).upsert(
+                        ids=[rows['ids'][i] for i, _ in entries],
+                        documents=[rows['documents'][i] for i, _ in entries],
+                        metadatas=[metadata for _, metadata in entries],
+                        embeddings=[rows['embeddings'][i] for i, _ in entries]
+                    )
+                    moved[self.shard_collection_name(target)] += len(entries)
+                if kept:
+                    collection.update(ids=kept, metadatas=kept_changes)
+                kept = set(kept)
+                collection.delete(ids=[chunk_id for chunk_id in rows['ids'] if chunk_id not in kept])
+                logger.info(f"Moved {len(rows['ids']) - len(kept)} chunks out of {self.shard_collection_name(source)}")
+
+            if source >= self.num_shards and collection.count() == 0:
+                self.get_shard_client(source).delete_collection(self.shard_collection_name(source))
+                self._documents_collections.pop((self.get_versions()[0].version, source), None)
+        return dict(moved)
+
+    def _shards_of_chunk(self, metadata: Dict) -> Dict[int, List[str]]:
+        """ Documents of a chunk grouped by the shard they belong to, in document_ids order """
+        shards = defaultdict(list)
+        for document_id in metadata.get("document_ids") or [metadata.get("document_id", "")]:
+            shards[self.shard_for_document(document_id)].append(document_id)
+        return dict(shards)
+
+    def compact_chunk_metadata(self, keys=("source", "chunk_type"), batch_size: int = 500) -> int:
+        """
+        Remove redundant keys from the metadata of stored chunks, in place
+
+        Chunks keep their ids, documents and embeddings, only the given
+        metadata keys are dropped. Safe to re-run.
+
+        Args:
+            keys: Metadata keys to remove
+            batch_size: Chunks read and updated per call
+
+        Returns:
+            Number of chunks rewritten
+        """
+        rewritten = 0
+        for shard in range(self.num_shards):
+            collection = self.get_or_create_documents_collection(shard)
+            offset = 0
+            while True:
+                # updates keep the row order, so pages can be walked by offset
+                page = collection.get(include=["metadatas"], limit=batch_size, offset=offset)
+                if not page['ids']:
+                    break
+                stale = [
+                    chunk_id for chunk_id, metadata in zip(page['ids'], page['metadatas'])
+                    if any(key in (metadata or {}) for key in keys)
+                ]
+                if stale:
+                    # keys set to None are removed from the stored metadata
+                    collection.update(ids=stale, metadatas=[dict.fromkeys(keys) for _ in stale])
+                    rewritten += len(stale)
+                offset += len(page['ids'])
+            logger.info(f"Compacted chunk metadata of {self.shard_collection_name(shard)}")
+        return rewritten
+
+    def deduplicate_chunks(self, batch_size: int = 500, dry_run: bool = False) -> Dict[str, int]:
+        """
+        Link the near-duplicate chunks of the index, in place
+
+        Every shard is fingerprinted page by page; a chunk within
+        CHUNK_DEDUP MAX_DISTANCE bits of an earlier chunk of the shard is
+        deleted and its document added to the document_ids of the earlier
+        one. Kept chunks get their text hash and fingerprint bands in their
+        metadata, so later uploads are matched against them. Safe to re-run.
+        Besides the fingerprints only the document ids of the kept chunks are
+        held in memory, fingerprint bands are written page by page.
+
+        Args:
+            batch_size: Chunks read and updated per call
+            dry_run: Only count the duplicates
+
+        Returns:
+            Dict with the number of chunks scanned, removed and linked to another document
+        """
+        active, building = self._load_versions()
+        if building is not None:
+            raise ValueError(f"Embedding version {building.version} is being built, deduplicate after the cutover")
+        result = {"scanned": 0, "removed": 0, "linked": 0}
+        with self._dedup_locked():
+            for shard in range(self.num_shards):
+                collection = self.get_or_create_documents_collection(shard, active)
+                index = _FingerprintIndex(self.dedup_max_distance)
+                # kept chunk id -> its document id, or its document_ids once it has several
+                owners = {}
+                # kept chunk id -> document_ids, written before the duplicates are deleted
+                links = {}
+                removed = []
+                duplicates = Counter()
+                offset = 0
+                while True:
+                    page = collection.get(include=["documents", "metadatas"], limit=batch_size, offset=offset)
+                    if not page['ids']:
+                        break
+                    offset += len(page['ids'])
+                    backfill = {}
+                    for chunk_id, document, metadata in zip(page['ids'], page['documents'], page['metadatas']):
+                        metadata = metadata or {}
+                        result["scanned"] += 1
+                        if len((document or "").split()) < self.dedup_min_words:
+                            continue
+                        fingerprint = (
+                            simhash_from_bands(metadata["simhash"]) if metadata.get("simhash") else simhash(document)
+                        )
+                        match = index.find(fingerprint)
+                        if match is None:
+                            index.add(chunk_id, fingerprint)
+                            document_ids = metadata.get("document_ids")
+                            owners[chunk_id] = document_ids if document_ids and len(document_ids) > 1 else metadata.get("document_id", "")
+                            if not metadata.get("simhash"):
+                                backfill[chunk_id] = {"simhash": simhash_bands(fingerprint)}
+                            if not metadata.get("text_hash"):
+                                backfill[chunk_id] = {**backfill.get(chunk_id, {}), "text_hash": normalized_text_hash(document)}
+                            continue
+                        removed.append(chunk_id)
+                        kept = owners[match]
+                        document_ids = list(kept) if isinstance(kept, list) else [kept]
+                        # documents linked to the removed chunk were counted as duplicates already
+                        duplicates[metadata.get("document_id", "")] += 1
+                        for document_id in metadata.get("document_ids") or [metadata.get("document_id", "")]:
+                            if document_id not in document_ids:
+                                document_ids.append(document_id)
+                                result["linked"] += 1
+                        if len(document_ids) > 1:
+                            owners[match] = links[match] = document_ids
+                    if backfill and not dry_run:
+                        # updates keep the paging order, only deletes wait for the end of the scan
+                        collection.update(ids=list(backfill), metadatas=list(backfill.values()))
+                result["removed"] += len(removed)
+                if dry_run:
+                    continue
+                # links are written before the duplicates go, so no document loses a chunk meanwhile
+                linked = list(links)
+                for start in range(0, len(linked), batch_size):
+                    part = linked[start:start + batch_size]
+                    collection.update(ids=part, metadatas=[{"document_ids": links[chunk_id]} for chunk_id in part])
+                for start in range(0, len(removed), batch_size):
+                    collection.delete(ids=removed[start:start + batch_size])
+                for document_id, count in duplicates.items():
+                    Document.objects.filter(id=document_id).update(
+                        duplicate_chunk_count=F('duplicate_chunk_count') + count, updated_at=timezone.now()
+                    )
+                logger.info(f"Removed {len(removed)} near-duplicate chunks from {self.shard_collection_name(shard)}")
+        return result
+
+    def deduplication_stats(self, stored_chunks: Optional[int] = None, fresh: bool = False) -> Dict:
+        """
+        Index size saved by storing near-duplicate chunks once
+
+        Served from memory for CHUNK_DEDUP STATS_CACHE_SECONDS unless fresh.
+
+        Args:
+            stored_chunks: Chunks stored in all shards, counted here when not given
+            fresh: Compute the stats now, e.g. right after deduplicating
+
+        Returns:
+            Dict with the chunks of all documents, the chunks stored, the
+            duplicates linked instead, and the embedding bytes saved
+        """
+        cached = self._dedup_stats
+        if not fresh and cached is not None and time.monotonic() - cached[0] < self.dedup_stats_cache_seconds:
+            return cached[1]
+        totals = Document.objects.filter(status='completed').aggregate(
+            chunks=Sum('chunk_count'), duplicates=Sum('duplicate_chunk_count')
+        )
+        chunks, duplicates = totals['chunks'] or 0, totals['duplicates'] or 0
+        if stored_chunks is None:
+            stored_chunks = sum(self.get_or_create_documents_collection(shard).count() for shard in range(self.num_shards))
+        sample = self.get_or_create_documents_collection(0).get(limit=1, include=["embeddings"])
+        dimensions = len(sample['embeddings'][0]) if len(sample['ids']) else 0
+        stats = {
+            "enabled": self.dedup_enabled,
+            "document_chunks": chunks,
+            "stored_chunks": stored_chunks,
+            "duplicate_chunks": duplicates,
+            "saved_ratio": round(duplicates / chunks, 4) if chunks else 0.0,
+            # float32 vectors, not counting the text, metadata and index overhead
+            "embedding_bytes_saved": duplicates * dimensions * 4,
+        }
+        self._dedup_stats = (time.monotonic(), stats)
+        return stats
+
+    def reembed(self, model_name: str, batch_size: int = 64, pause: float = 0.5, keep_old: bool = False) -> EmbeddingVersion:
+        """
+        Move the collections to another embedding model without downtime
+
+        A new collection version is built next to the active one, which keeps
+        serving queries: new writes go to both versions, the existing chunks
+        and cached questions are re-embedded in batches (pausing between them
+        so the embedding work does not starve the serving processes), a final
+        pass copies rows the paged copy skipped and drops rows deleted
+        meanwhile, then the new version is activated in one transaction.
+        Processes switch within EMBEDDING_VERSION_CHECK_INTERVAL seconds, after which the old collections are removed. Re-running
+        after an interruption resumes the build, rows already copied are not
+        embedded again.
+
+        Args:
+            model_name: Embedding model of the new version
+            batch_size: Rows embedded per batch
+            pause: Seconds to sleep between batches
+            keep_old: Keep the collections of the old version
+
+        Returns:
+            The new active version
+        """
+        active, building = self._load_versions()
+        if building is None and active.model_name == model_name:
+            return active
+        if building is not None and building.model_name != model_name:
+            raise ValueError(f"Version {building.version} is already being built for {building.model_name}")
+        if building is None:
+            latest = EmbeddingVersion.objects.order_by('-version').values_list('version', flat=True).first() or 1
+            building = EmbeddingVersion.objects.create(version=latest + 1, model_name=model_name)
+            logger.info(f"Building embedding version {building.version} ({model_name})")
+            # every process has to write to both versions before the copy starts
+            time.sleep(self.version_check_interval)
+        with self._versions_lock:
+            self._versions = (active, building)
+            self._versions_loaded_at = time.monotonic()
+
+        pairs = [
+            (self.get_or_create_documents_collection(shard, active), self.get_or_create_documents_collection(shard, building))
+            for shard in range(self.num_shards)
+        ]
+        queries = (self.get_or_create_queries_collection(active), self.get_or_create_queries_collection(building))
+        building.total_chunks = sum(source.count() for source, _ in pairs)
+        building.embedded_chunks = building.embedded_questions = 0
+        building.error = ""
+        building.save(update_fields=['total_chunks', 'embedded_chunks', 'embedded_questions', 'error', 'updated_at'])
+        try:
+            for source, target in pairs:
+                self._copy_rows(source, target, building, 'embedded_chunks', batch_size, pause)
+                self._reconcile_rows(source, target, building, batch_size)
+            self._copy_rows(*queries, building, 'embedded_questions', batch_size, pause)
+            self._reconcile_rows(*queries, building, batch_size)
+        except Exception as e:
+            building.error = str(e)
+            building.save(update_fields=['error', 'updated_at'])
+            raise
+
+        with transaction.atomic():
+            EmbeddingVersion.objects.filter(pk=active.pk).update(status='retired', updated_at=timezone.now())
+            EmbeddingVersion.objects.filter(pk=building.pk).update(
+                status='active', activated_at=timezone.now(), updated_at=timezone.now()
+            )
+        building.refresh_from_db()
+        with self._versions_lock:
+            self._versions = (building, None)
+            self._versions_loaded_at = time.monotonic()
+        logger.info(f"Embedding version {building.version} ({model_name}) is active")
+
+        if not keep_old:
+            # processes that have not switched yet still read the old version
+            time.sleep(2 * self.version_check_interval)
+            self.drop_version(active)
+        return building
+
+    def _copy_rows(self, source, target, version: EmbeddingVersion, progress_field: str, batch_size: int, pause: float) -> None:
+        """ Re-embed the rows of source missing from target, recording progress on version """
+        done = 0
+        offset = 0
+        while True:
+            page = source.get(include=["documents", "metadatas"], limit=batch_size, offset=offset)
+            if not page['ids']:
+                break
+            offset += len(page['ids'])
+            present = set(target.get(ids=page['ids'], include=[])['ids'])
+            missing = [i for i, row_id in enumerate(page['ids']) if row_id not in present]
+            if missing:
+                documents = [page['documents'][i] for i in missing]
+                target.upsert(
+                    ids=[page['ids'][i] for i in missing],
+                    documents=documents,
+                    metadatas=[page['metadatas'][i] for i in missing],
+                    embeddings=self.embed_queries(documents, version)
+                )
+            done += len(page['ids'])
+            setattr(version, progress_field, getattr(version, progress_field) + len(page['ids']))
+            version.save(update_fields=[progress_field, 'updated_at'])
+            if missing and pause:
+                time.sleep(pause)
+        logger.info(f"Re-embedded {done} rows into {target.name}")
+
+    def _reconcile_rows(self, source, target, version: EmbeddingVersion, batch_size: int) -> None:
+        """
+        Make target hold exactly the rows of source before the version is activated
+
+        The paged copy walks source by offset while live deletes, TTL sweeps
+        and evictions shift the offsets, so it can skip rows. This final pass
+        compares the full id sets of both collections, re-embeds the rows
+        still missing from target and drops the rows deleted from source.
+        Writes made from now on reach both versions.
+        """
+        source_ids = source.get(include=[])['ids']
+        target_ids = set(target.get(include=[])['ids'])
+        missing = [row_id for row_id in source_ids if row_id not in target_ids]
+        for start in range(0, len(missing), batch_size):
+            rows = source.get(ids=missing[start:start + batch_size], include=["documents", "metadatas"])
+            if rows['ids']:
+                target.upsert(
+                    ids=rows['ids'],
+                    documents=rows['documents'],
+                    metadatas=rows['metadatas'],
+                    embeddings=self.embed_queries(rows['documents'], version)
+                )
+        removed = list(target_ids.difference(source_ids))
+        for start in range(0, len(removed), batch_size):
+            target.delete(ids=removed[start:start + batch_size])
+        if missing or removed:
+            logger.info(f"Reconciled {target.name}: copied {len(missing)} skipped rows, dropped {len(removed)} removed rows")
+
+    def drop_version(self, version: EmbeddingVersion) -> None:
+        """ Delete the collections of a version that is no longer active """
+        for shard in range(self.num_shards):
+            self.get_shard_client(shard).delete_collection(self.shard_collection_name(shard, version))
+            self._documents_collections.pop((version.version, shard), None)
+        self.client.delete_collection(self.queries_collection_name(version))
+        self._queries_collections.pop(version.version, None)
+        logger.info(f"Dropped the collections of embedding version {version.version}")
+
     def get_collection_stats(self) -> Dict:
         """
         Get statistics about ChromaDB collections
@@ -184,24 +1505,64 @@ class ChromaDBService:
         Returns:
             Dict with collection statistics
         """
-        docs_collection = self.get_or_create_documents_collection()
+        shards = [
+            {"name": self.shard_collection_name(shard), "count": self.get_or_create_documents_collection(shard).count()}
+            for shard in range(self.num_shards)
+        ]
         query_collection = self.get_or_create_queries_collection()
+        active, building = self.get_versions()
+        backfill = None
+        if building is not None:
+            building.refresh_from_db()
+            backfill = {
+                "version": building.version,
+                "model": building.model_name,
+                "total_chunks": building.total_chunks,
+                "embedded_chunks": building.embedded_chunks,
+                "embedded_questions": building.embedded_questions,
+                "progress": round(building.embedded_chunks / building.total_chunks, 4) if building.total_chunks else None,
+                "error": building.error or None
+            }
         return {
+            "backend": getattr(settings, 'VECTOR_STORE_BACKEND', 'chroma'),
+            "embedding": {
+                "model": active.model_name,
+                "version": active.version,
+                "backfill": backfill
+            },
             "documents": {
-                "count": docs_collection.count(),
-                "name": self.DOCUMENT_COLLECTION_NAME
+                "count": sum(shard["count"] for shard in shards),
+                "name": self.shard_collection_name(0),
+                "shards": shards
             },
+            "deduplication": self.deduplication_stats(stored_chunks=sum(shard["count"] for shard in shards)),
             "queries": {
                 "count": query_collection.count(),
-                "name": self.QUERY_COLLECTION_NAME
+                "name": self.queries_collection_name(),
+                "max_entries": self.cache_max_entries,
+                "ttl": self.cache_ttl,
+                "eviction_policy": self.cache_eviction_policy
             }
         }
         
 # singleton instance of the service
 _chroma_service = None
+_chroma_service_lock = threading.Lock()
+
+def _reset_after_fork():
+    # clients (and their connections/threads) are not fork-safe, a forked
+    # worker (e.g. gunicorn --preload) opens its own on first use
+    global _chroma_service, _chroma_service_lock
+    _chroma_service = None
+    _chroma_service_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
 
 def get_chroma_service() -> ChromaDBService:
     global _chroma_service
     if _chroma_service is None:
-        _chroma_service = ChromaDBService()
+        # concurrent first requests must not open several clients on the same path
+        with _chroma_service_lock:
+            if _chroma_service is None:
+                _chroma_service = ChromaDBService()
     return _chroma_service
@@ -0,0 +1,564 @@
+# Vector store interface and the in-process FAISS backend
+import atexit
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Protocol, Sequence, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def file_lock(path: str):
+    """ Hold an exclusive lock on a file, shared by every process on the host """
+    with open(path, 'a+') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            while True:
+                try:
+                    # blocks for about 10 seconds, then raises
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class VectorCollection(Protocol):
+    """
+    Collection API used by ChromaDBService
+
+    This is the subset of the chromadb Collection API the app relies on, so
+    chromadb collections satisfy it as is and other backends mirror it,
+    including the shape of the returned dicts.
+    """
+
+    def add(self, ids: List[str], documents: Optional[List[str]] = None,
+            metadatas: Optional[List[Dict]] = None, embeddings: Optional[Sequence] = None) -> None: ...
+
+    def query(self, query_texts: Optional[List[str]] = None, query_embeddings: Optional[Sequence] = None,
+              n_results: int = 10, where: Optional[Dict] = None, include: Sequence[str] = ...) -> Dict: ...
+
+    def get(self, ids: Optional[List[str]] = None, where: Optional[Dict] = None,
+            limit: Optional[int] = None, include: Sequence[str] = ...) -> Dict: ...
+
+    def upsert(self, ids: List[str], documents: Optional[List[str]] = None,
+               metadatas: Optional[List[Dict]] = None, embeddings: Optional[Sequence] = None) -> None: ...
+
+    def update(self, ids: List[str], metadatas: Optional[List[Dict]] = None) -> None: ...
+
+    def delete(self, ids: Optional[List[str]] = None, where: Optional[Dict] = None) -> None: ...
+
+    def count(self) -> int: ...
+
+
+class VectorStoreClient(Protocol):
+    """ Client API used by ChromaDBService, satisfied by chromadb clients and FaissClient """
+
+    def get_or_create_collection(self, name: str, metadata: Optional[Dict] = None, **kwargs) -> VectorCollection: ...
+
+    def delete_collection(self, name: str) -> None: ...
+
+    def get_max_batch_size(self) -> int: ...
+
+
+# ===== FAISS BACKEND =====
+_comparisons = {'$eq': '=', '$ne': '!=', '$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<='}
+
+
+def _where_to_sql(where: Optional[Dict]) -> Tuple[str, List[Any]]:
+    """
+    Translate a chromadb style where filter into SQL over the JSON metadata
+
+    Supports equality, $eq/$ne/$gt/$gte/$lt/$lte, $in/$nin, $contains on
+    list values and $and/$or.
+    """
+    if not where:
+        return "1", []
+    clauses = []
+    params = []
+    for key, value in where.items():
+        if key in ('$and', '$or'):
+            parts = [_where_to_sql(condition) for condition in value]
+            joiner = ' AND ' if key == '$and' else ' OR '
+            clauses.append('(' + joiner.join(sql for sql, _ in parts) + ')')
+            for _, part_params in parts:
+                params.extend(part_params)
+            continue
+        field = "json_extract(metadata, ?)"
+        path = f'$."{key}"'
+        conditions = value if isinstance(value, dict) else {'$eq': value}
+        for operator, operand in conditions.items():
+            if operator in _comparisons:
+                clauses.append(f"{field} {_comparisons[operator]} ?")
+                params.extend([path, operand])
+            elif operator in ('$in', '$nin'):
+                if not operand:
+                    # nothing is in an empty list, so $nin matches every row
+                    clauses.append('1' if operator == '$nin' else '0')
+                    continue
+                placeholders = ', '.join('?' for _ in operand)
+                negate = 'NOT ' if operator == '$nin' else ''
+                clauses.append(f"{field} {negate}IN ({placeholders})")
+                params.extend([path, *operand])
+            elif operator == '$contains':
+                clauses.append("EXISTS (SELECT 1 FROM json_each(metadata, ?) WHERE value = ?)")
+                params.extend([path, operand])
+            else:
+                raise ValueError(f"Unsupported where operator {operator}")
+    return ' AND '.join(clauses), params
+
+
+class FaissCollection:
+    """
+    A collection stored as a FAISS index plus a SQLite table
+
+    SQLite holds ids, documents, JSON metadata and the raw float32 vectors;
+    the FAISS index only holds vectors keyed by the SQLite row id. Rows added
+    before the index is trained (PQ/int8 need enough vectors) or by another
+    process after this one loaded its copy are searched exactly with NumPy,
+    so results are always complete. The index is written out every
+    persist_every changed rows (see FaissClient) and when the client
+    closes, not on every write; until then other processes search the rows
+    it does not cover exactly. Deleted rows disappear from SQLite at once;
+    indexes that cannot remove vectors (HNSW) are rebuilt once enough of
+    them are stale.
+    """
+
+    def __init__(self, path: str, name: str, client: 'FaissClient', metadata: Optional[Dict] = None):
+        self.name = name
+        self.path = path
+        self.client = client
+        self.metadata = metadata or {}
+        self._lock = threading.RLock()
+        self._index = None
+        self._index_version = -1
+        self._index_writable = False
+        # rows covered by the loaded index (vid), and rows added or removed since it was persisted
+        self._indexed_upto = 0
+        self._unpersisted = 0
+
+        os.makedirs(path, exist_ok=True)
+        self._index_path = os.path.join(path, 'index.faiss')
+        self._db = sqlite3.connect(os.path.join(path, 'items.sqlite3'), check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS items (
+                vid INTEGER PRIMARY KEY AUTOINCREMENT,
+                id TEXT NOT NULL UNIQUE,
+                document TEXT,
+                metadata TEXT NOT NULL DEFAULT '{}',
+                embedding BLOB NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT);
+        """)
+        self._db.execute(
+            "INSERT OR IGNORE INTO info (key, value) VALUES ('metadata', ?)", (json.dumps(self.metadata),)
+        )
+        self._db.commit()
+
+    # ----- bookkeeping -----
+    def _info(self, key: str, default: Any = None) -> Any:
+        row = self._db.execute("SELECT value FROM info WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def _set_info(self, key: str, value: Any) -> None:
+        self._db.execute("INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    @contextmanager
+    def _write_lock(self):
+        """ Serialize writers across threads and processes """
+        with self._lock, file_lock(os.path.join(self.path, 'write.lock')):
+            yield
+
+    def _load_index(self, writable: bool = False):
+        """ (Re)load the persisted index when another process changed it """
+        import faiss
+
+        version = self._info('index_version', 0)
+        if self._index is not None and version == self._index_version and (self._index_writable or not writable):
+            return self._index
+        if os.path.exists(self._index_path):
+            if writable or not self.client.mmap:
+                self._index = faiss.read_index(self._index_path)
+            else:
+                # read-only workers map the file and share its pages
+                self._index = faiss.read_index(self._index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            self._index_writable = writable or not self.client.mmap
+            self.client.set_search_parameters(self._index)
+        else:
+            self._index = None
+            self._index_writable = True
+        self._index_version = version
+        self._indexed_upto = self._info('indexed_upto', 0)
+        self._unpersisted = 0
+        return self._index
+
+    def _persist_index(self) -> None:
+        import faiss
+
+        tmp_path = self._index_path + '.tmp'
+        faiss.write_index(self._index, tmp_path)
+        os.replace(tmp_path, self._index_path)
+        self._index_version = self._info('index_version', 0) + 1
+        self._set_info('index_version', self._index_version)
+        # other processes exact-search the rows after the ones the persisted index covers
+        self._set_info('indexed_upto', self._indexed_upto)
+        self._unpersisted = 0
+
+    def _sync_index(self) -> None:
+        """ Train the index when possible and add rows it does not cover yet """
+        index = self._load_index(writable=True)
+        pending = self._db.execute(
+            "SELECT vid, embedding FROM items WHERE vid > ? ORDER BY vid", (self._indexed_upto,)
+        ).fetchall()
+        if not pending:
+            return
+        dimension = len(pending[0][1]) // 4
+        if index is None:
+            index = self._index = self.client.create_index(dimension)
+        trained = False
+        if not index.is_trained:
+            total = self._db.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+            if total < self.client.train_size:
+                return
+            training = self._db.execute("SELECT embedding FROM items").fetchall()
+            index.train(np.vstack([np.frombuffer(row[0], dtype=np.float32) for row in training]))
+            logger.info(f"Trained FAISS index for {self.name} on {len(training)} vectors")
+            trained = True
+            pending = self._db.execute("SELECT vid, embedding FROM items ORDER BY vid").fetchall()
+        vids = np.array([row[0] for row in pending], dtype=np.int64)
+        vectors = np.vstack([np.frombuffer(row[1], dtype=np.float32) for row in pending])
+        index.add_with_ids(vectors, vids)
+        self._indexed_upto = int(vids[-1])
+        self._unpersisted += len(vids)
+        if self._maybe_compact() or trained or self._unpersisted >= self.client.persist_every:
+            self._persist_index()
+
+    def _maybe_compact(self) -> bool:
+        """ Rebuild the index once more than 20% of its vectors were deleted, True if rebuilt """
+        live = self._db.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+        stale = self._index.ntotal - live
+        if not self._index.ntotal or stale <= 0.2 * self._index.ntotal:
+            return False
+        logger.info(f"Rebuilding FAISS index for {self.name} ({stale} stale vectors)")
+        index = self.client.create_index(self._index.d)
+        rows = self._db.execute("SELECT vid, embedding FROM items ORDER BY vid").fetchall()
+        if rows:
+            vectors = np.vstack([np.frombuffer(row[1], dtype=np.float32) for row in rows])
+            if not index.is_trained:
+                index.train(vectors)
+            index.add_with_ids(vectors, np.array([row[0] for row in rows], dtype=np.int64))
+            self._indexed_upto = rows[-1][0]
+        self._index = index
+        return True
+
+    def _insert_rows(self, ids: List[str], documents: Optional[List[str]], metadatas: Optional[List[Dict]],
+                     embeddings: Sequence) -> None:
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        documents = documents or [None] * len(ids)
+        metadatas = metadatas or [{}] * len(ids)
+        self._db.executemany(
+            "INSERT INTO items (id, document, metadata, embedding) VALUES (?, ?, ?, ?)",
+            [
+                (item_id, document, json.dumps(metadata or {}), vector.tobytes())
+                for item_id, document, metadata, vector in zip(ids, documents, metadatas, vectors)
+            ]
+        )
+
+    def _delete_rows(self, sql: str, params: List[Any]) -> List[int]:
+        """ Delete the matching rows from SQLite, returns their vids """
+        vids = [row[0] for row in self._db.execute(f"SELECT vid FROM items WHERE {sql}", params)]
+        if vids:
+            self._db.execute(f"DELETE FROM items WHERE {sql}", params)
+        return vids
+
+    def _remove_from_index(self, vids: List[int]) -> None:
+        if not vids:
+            return
+        index = self._load_index(writable=True)
+        if index is None:
+            return
+        try:
+            index.remove_ids(np.array(vids, dtype=np.int64))
+            self._unpersisted += len(vids)
+        except RuntimeError:
+            # HNSW cannot remove vectors, stale ones are skipped at query time
+            pass
+        if self._maybe_compact() or self._unpersisted >= self.client.persist_every:
+            self._persist_index()
+
+    def persist(self) -> None:
+        """ Write the index out if it changed since it was last persisted """
+        with self._write_lock(), self._db:
+            # an index persisted by another process meanwhile already covers these rows
+            if self._unpersisted and self._index is not None and self._index_version == self._info('index_version', 0):
+                self._persist_index()
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        return np.asarray(self.client.embedding_function(texts), dtype=np.float32)
+
+    # ----- collection API -----
+    def count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+    def add(self, ids: List[str], documents: Optional[List[str]] = None,
+            metadatas: Optional[List[Dict]] = None, embeddings: Optional[Sequence] = None) -> None:
+        if embeddings is None:
+            embeddings = self._embed(documents)
+        with self._write_lock(), self._db:
+            self._insert_rows(ids, documents, metadatas, embeddings)
+            self._sync_index()
+
+    def upsert(self, ids: List[str], documents: Optional[List[str]] = None,
+               metadatas: Optional[List[Dict]] = None, embeddings: Optional[Sequence] = None) -> None:
+        """ Add rows, replacing existing rows with the same ids in the same transaction """
+        if embeddings is None:
+            embeddings = self._embed(documents)
+        if not ids:
+            return
+        with self._write_lock(), self._db:
+            replaced = self._delete_rows(f"id IN ({', '.join('?' for _ in ids)})", list(ids))
+            self._insert_rows(ids, documents, metadatas, embeddings)
+            # the index only changes once both statements succeeded
+            self._remove_from_index(replaced)
+            self._sync_index()
+
+    def update(self, ids: List[str], metadatas: Optional[List[Dict]] = None) -> None:
+        """ Merge metadata into existing rows, keys set to None are removed """
+        if not metadatas:
+            return
+        with self._write_lock(), self._db:
+            for item_id, changes in zip(ids, metadatas):
+                row = self._db.execute("SELECT metadata FROM items WHERE id = ?", (item_id,)).fetchone()
+                if row is None:
+                    continue
+                metadata = json.loads(row[0])
+                metadata.update(changes)
+                metadata = {key: value for key, value in metadata.items() if value is not None}
+                self._db.execute("UPDATE items SET metadata = ? WHERE id = ?", (json.dumps(metadata), item_id))
+
+    def delete(self, ids: Optional[List[str]] = None, where: Optional[Dict] = None) -> None:
+        if ids is None and not where:
+            # like chromadb, an unfiltered delete is refused rather than emptying the collection
+            raise ValueError("Provide ids or where to delete, use delete_collection to remove every row")
+        sql, params = _where_to_sql(where)
+        if ids is not None:
+            if not ids:
+                return
+            sql += f" AND id IN ({', '.join('?' for _ in ids)})"
+            params += list(ids)
+        with self._write_lock(), self._db:
+            self._remove_from_index(self._delete_rows(sql, params))
+
+    def get(self, ids: Optional[List[str]] = None, where: Optional[Dict] = None, limit: Optional[int] = None,
+            offset: Optional[int] = None, include: Sequence[str] = ("metadatas", "documents")) -> Dict:
+        sql, params = _where_to_sql(where)
+        if ids is not None:
+            sql += f" AND id IN ({', '.join('?' for _ in ids) or 'NULL'})"
+            params += list(ids)
+        sql += " ORDER BY vid"
+        if limit is not None or offset:
+            # LIMIT -1 is no limit in SQLite, OFFSET needs a LIMIT clause
+            sql += " LIMIT ? OFFSET ?"
+            params += [-1 if limit is None else limit, offset or 0]
+        with self._lock:
+            rows = self._db.execute(f"SELECT vid, id, document, metadata, embedding FROM items WHERE {sql}", params).fetchall()
+        return self._result([rows], include, nested=False)
+
+    def query(self, query_texts: Optional[List[str]] = None, query_embeddings: Optional[Sequence] = None,
+              n_results: int = 10, where: Optional[Dict] = None,
+              include: Sequence[str] = ("metadatas", "documents", "distances")) -> Dict:
+        vectors = self._embed(query_texts) if query_embeddings is None else np.asarray(query_embeddings, dtype=np.float32)
+        with self._lock:
+            if where:
+                # filtered queries (e.g. one document) search their candidates exactly
+                sql, params = _where_to_sql(where)
+                candidates = self._db.execute(f"SELECT vid, embedding FROM items WHERE {sql}", params).fetchall()
+                hits = [self._exact_search(vector, candidates, n_results) for vector in vectors]
+            else:
+                hits = self._ann_search(vectors, n_results)
+
+            all_vids = {vid for query_hits in hits for vid, _ in query_hits}
+            rows = {}
+            if all_vids:
+                placeholders = ', '.join('?' for _ in all_vids)
+                for row in self._db.execute(
+                    f"SELECT vid, id, document, metadata, embedding FROM items WHERE vid IN ({placeholders})",
+                    list(all_vids)
+                ):
+                    rows[row[0]] = row
+        ranked_rows = []
+        distances = []
+        for query_hits in hits:
+            # vectors deleted since the index was built have no row anymore
+            live = [(rows[vid], distance) for vid, distance in query_hits if vid in rows][:n_results]
+            ranked_rows.append([row for row, _ in live])
+            distances.append([float(distance) for _, distance in live])
+        result = self._result(ranked_rows, include, nested=True)
+        result['distances'] = distances if 'distances' in include else None
+        return result
+
+    def _exact_search(self, vector: np.ndarray, candidates: List[Tuple], n_results: int) -> List[Tuple[int, float]]:
+        """ Squared L2 distances against candidate rows, best first """
+        if not candidates:
+            return []
+        matrix = np.vstack([np.frombuffer(row[1], dtype=np.float32) for row in candidates])
+        distances = ((matrix - vector) ** 2).sum(axis=1)
+        best = np.argsort(distances)[:n_results]
+        return [(candidates[i][0], float(distances[i])) for i in best]
+
+    def _ann_search(self, vectors: np.ndarray, n_results: int) -> List[List[Tuple[int, float]]]:
+        index = self._load_index()
+        indexed_upto = self._indexed_upto if index is not None and index.is_trained else 0
+        # rows not covered by the loaded index are searched exactly
+        unindexed = self._db.execute("SELECT vid, embedding FROM items WHERE vid > ?", (indexed_upto,)).fetchall()
+        hits = [self._exact_search(vector, unindexed, n_results) for vector in vectors]
+        if index is not None and index.is_trained and index.ntotal:
+            # over-fetch to make up for deleted vectors still in the index
+            stale = max(index.ntotal - self.count(), 0)
+            k = min(index.ntotal, n_results + stale if stale < 4 * n_results else 4 * n_results)
+            distances, vids = index.search(vectors, k)
+            for query_hits, row_distances, row_vids in zip(hits, distances, vids):
+                query_hits.extend((int(vid), float(distance)) for vid, distance in zip(row_vids, row_distances) if vid >= 0)
+                query_hits.sort(key=lambda hit: hit[1])
+        return hits
+
+    def _result(self, grouped_rows: List[List[Tuple]], include: Sequence[str], nested: bool) -> Dict:
+        """ Build a chromadb shaped result from (vid, id, document, metadata, embedding) rows """
+        def pick(column, convert=lambda value: value):
+            values = [[convert(row[column]) for row in rows] for rows in grouped_rows]
+            return values if nested else values[0]
+
+        return {
+            'ids': pick(1),
+            'documents': pick(2) if 'documents' in include else None,
+            'metadatas': pick(3, json.loads) if 'metadatas' in include else None,
+            'embeddings': pick(4, lambda blob: np.frombuffer(blob, dtype=np.float32)) if 'embeddings' in include else None,
+            'included': list(include),
+        }
+
+
+class FaissClient:
+    """
+    Client for FAISS collections stored under one directory
+
+    Index options:
+        index_type: 'flat' (exact, best for small corpora) or 'hnsw'
+        m / ef_construction / ef_search: HNSW graph degree and build/search beam width
+        quantization: None, 'int8' (scalar quantizer, 4x smaller) or 'pq' (product quantizer)
+        pq_m: number of PQ sub-vectors, must divide the embedding dimension
+        train_size: vectors collected before a quantized index is trained
+        mmap: memory-map persisted indexes in processes that only read
+        persist_every: rows added or removed before an index is written out again,
+            the remaining changes are written when the client closes
+    """
+
+    def __init__(self, path: str, embedding_function=None, index_type: str = 'hnsw', m: int = 32,
+                 ef_construction: int = 200, ef_search: int = 64, quantization: Optional[str] = None,
+                 pq_m: int = 16, train_size: int = 10000, mmap: bool = True, persist_every: int = 1000):
+        self.path = str(path)
+        self.index_type = index_type
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.quantization = quantization
+        self.pq_m = pq_m
+        self.train_size = train_size
+        self.mmap = mmap
+        self.persist_every = persist_every
+        self._embedding_function = embedding_function
+        self._collections: Dict[str, FaissCollection] = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        atexit.register(self.close)
+
+    @property
+    def embedding_function(self):
+        if self._embedding_function is None:
+            # same default model as chromadb, so both backends produce the same vectors
+            from chromadb.utils.embedding_functions import DefaultEmbeddingFunction
+            self._embedding_function = DefaultEmbeddingFunction()
+        return self._embedding_function
+
+    def index_factory_string(self) -> str:
+        """ FAISS index_factory description for the configured options """
+        codec = {'int8': 'SQ8', 'pq': f'PQ{self.pq_m}'}.get(self.quantization)
+        if self.index_type == 'flat':
+            return f"IDMap2,{codec or 'Flat'}"
+        return f"IDMap2,HNSW{self.m}" + (f",{codec}" if codec else "")
+
+    def create_index(self, dimension: int):
+        import faiss
+
+        index = faiss.index_factory(dimension, self.index_factory_string(), faiss.METRIC_L2)
+        inner = faiss.downcast_index(index.index)
+        if hasattr(inner, 'hnsw'):
+            inner.hnsw.efConstruction = self.ef_construction
+        self.set_search_parameters(index)
+        return index
+
+    def set_search_parameters(self, index) -> None:
+        import faiss
+
+        if self.index_type == 'hnsw':
+            faiss.ParameterSpace().set_index_parameter(index, 'efSearch', self.ef_search)
+
+    def get_or_create_collection(self, name: str, metadata: Optional[Dict] = None, **kwargs) -> FaissCollection:
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = FaissCollection(os.path.join(self.path, name), name, self, metadata)
+            return self._collections[name]
+
+    def get_collection(self, name: str) -> FaissCollection:
+        if not os.path.isdir(os.path.join(self.path, name)):
+            raise ValueError(f"Collection {name} does not exist")
+        return self.get_or_create_collection(name)
+
+    def list_collections(self) -> List[str]:
+        return sorted(
+            entry for entry in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, entry))
+        )
+
+    def delete_collection(self, name: str) -> None:
+        with self._lock:
+            collection = self._collections.pop(name, None)
+            if collection is not None:
+                collection._db.close()
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+    def get_max_batch_size(self) -> int:
+        return 5000
+
+    def close(self) -> None:
+        """ Write out the index changes not persisted yet """
+        with self._lock:
+            collections = list(self._collections.values())
+        for collection in collections:
+            try:
+                collection.persist()
+            except Exception as e:
+                logger.error(f"Persisting FAISS index for {collection.name} failed: {str(e)}")
@@ -2,31 +2,114 @@
 from rest_framework import viewsets, status
 from rest_framework.response import Response
 from rest_framework.decorators import action
+from rest_framework.permissions import IsAdminUser
 from rest_framework.parsers import MultiPartParser, FormParser
+from rest_framework.utils.encoders import JSONEncoder
+from django.conf import settings
 from django.core.files.uploadedfile import UploadedFile
+from django.http import FileResponse, Http404, StreamingHttpResponse
+from django.db import connection
+from django.db.models import Avg, Count, Max, Prefetch, Q, Sum, TextField
+from django.db.models.functions import Cast
+from django.utils import timezone
+from django.utils.http import parse_etags
 
 import hashlib
+import json
 import logging
-from datetime import datetime
+import math
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
-from .models import Document, Chat
-from .serializers import DocumentSerializer, ChatSerializer, DocumentUploadSerializer, QuerySerializer
-from .llm_services import get_llm_service
+from .models import Document, Chat, Conversation
+from .serializers import (
+    DocumentSerializer, ChatSerializer, ChatListSerializer, ConversationSerializer,
+    DocumentUploadSerializer, QuerySerializer, BatchQuerySerializer, retrieval_options
+)
+from .pagination import CreatedAtCursorPagination
+from .llm_services import GenerationError, get_llm_service
 from .vectordb_services import get_chroma_service
-from .utils import chunk_text_by_size, calculate_hash, extract_text_from_pdf
+from .chat_writer import get_chat_writer
+from .conversations import format_history, get_history, schedule_summary_update
+from .singleflight import SingleFlight
+from .admission import AdmissionRejected, get_admission_controller
+from .warmup import get_warm_up_state, is_ready, start_warm_up
+from .logging_utils import sample_payload
+from .prewarm import prewarm_report, schedule_prewarm
+from .profiling import get_profile, hottest_functions, list_profiles
+from .utils import chunk_file, calculate_hash, DocumentTooLargeError
 
 logger = logging.getLogger(__name__)
 
-class DocumentViewSet(viewsets.ModelViewSet):
+class ConditionalListMixin:
+    """
+    ETag / If-None-Match support for list endpoints
+
+    The ETag is derived from a single aggregate query (row count and latest
+    updated_at) plus the requested page, so an unchanged list answers
+    304 Not Modified without fetching or serializing any rows.
+    """
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        summary = queryset.order_by().aggregate(count=Count('pk'), last_updated=Max('updated_at'))
+        etag = '"{}"'.format(hashlib.md5(
+            f"{summary['count']}:{summary['last_updated']}:{request.get_full_path()}".encode()
+        ).hexdigest())
+        if_none_match = parse_etags(request.headers.get('If-None-Match', ''))
+        if etag in if_none_match or '*' in if_none_match:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        response = super().list(request, *args, **kwargs)
+        response['ETag'] = etag
+        return response
+
+class DocumentViewSet(ConditionalListMixin, viewsets.ModelViewSet):
     """ ViewSet for document CRUD operations """
     queryset = Document.objects.all()
     serializer_class = DocumentSerializer
     parser_classes = [MultiPartParser, FormParser]
+    pagination_class = CreatedAtCursorPagination
+
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        self._invalidate_cached_answers(serializer.instance)
+
+    def perform_destroy(self, instance):
+        # caches are looked up through the document links, invalidate before they cascade
+        self._invalidate_cached_answers(instance)
+        get_chroma_service().delete_document_chunks(str(instance.id))
+        instance.file.delete(save=False)
+        super().perform_destroy(instance)
+
+    def _invalidate_cached_answers(self, document):
+        """
+        Stop serving cached answers built from a deleted or updated document
+        
+        Chats are found through their document links, or through their stored
+        source chunks for chats saved before all sources were linked.
+        """
+        get_chat_writer().flush(document_id=document.id)
+        chat_ids = list(
+            Chat.objects.annotate(chunks_text=Cast('source_chunks_metadata', TextField()))
+            .filter(Q(documents=document) | Q(chunks_text__contains=str(document.id)))
+            .filter(invalidated_at__isnull=True)
+            .values_list('id', flat=True)
+            .distinct()
+        )
+        if not chat_ids:
+            return
+        # queryset updates skip auto_now, updated_at is bumped so list ETags change
+        now = timezone.now()
+        Chat.objects.filter(id__in=chat_ids).update(invalidated_at=now, updated_at=now)
+        get_chroma_service().invalidate_cached_questions(chat_ids)
+        logger.info(f"Invalidated {len(chat_ids)} cached answers for document {document.id}")
     
     @action(detail=False, methods=['post'])
     def upload(self, request):
         """
-        Upload a PDF document and process it
+        Upload a document (PDF, TXT, Markdown, HTML, DOCX) and process it
         POST /ragengine/documents/upload/
         
         Flow:
@@ -34,13 +117,18 @@ class DocumentViewSet(viewsets.ModelViewSet):
         2. Calculate file hash
         3. Check if already exists
         4. Save to database
-        5. Extract text from PDF
+        5. Extract text (extractor picked by file type)
         6. Chunk text
-        7. Store in ChromaDB
+        7. Store in ChromaDB, duplicates of stored chunks are linked instead (CHUNK_DEDUP)
         8. Update document status
+        9. Queue FAQ pre-warming of the semantic cache (FAQ_PREWARM)
         """
         # Step 1: Validate file
         serializer = DocumentUploadSerializer(data=request.data)
+        # set by MaxSizeUploadHandler when the body was cut off while streaming
+        upload_rejected = getattr(request, 'upload_rejected', None)
+        if upload_rejected:
+            return Response({'file': [upload_rejected]}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         uploaded_file = serializer.validated_data['file']
@@ -69,26 +157,34 @@ class DocumentViewSet(viewsets.ModelViewSet):
             file_path = document.file.path
             logger.info(f"File path: {file_path}")
 
-            # Step 6: Extract text and page countfrom PDF
-            full_text, page_count = extract_text_from_pdf(file_path)
-            logger.info(f"Extracted {len(full_text)} characters and {page_count} pages from PDF")
-
-            # Step 7: Chunk text
-            chunks, metadatas, ids = chunk_text_by_size(file_path, str(document.id))
+            # Step 6 & 7: Extract text section by section and chunk it
+            chunks, metadatas, ids, file_stats = chunk_file(
+                file_path,
+                str(document.id),
+                max_pages=getattr(settings, 'MAX_DOCUMENT_PAGES', None),
+                content_type=uploaded_file.content_type
+            )
+            page_count = file_stats['pages']
+            logger.info(f"Extracted {file_stats['characters']} characters and {page_count} pages/sections")
             logger.info(f"Created {len(chunks)} text chunks")
 
-            # Step 8: Store in ChromaDB
+            # Step 8: Store in ChromaDB, duplicates of stored chunks are only linked
             chroma_service = get_chroma_service()
-            chroma_service.add_document_chunks(chunks, metadatas, ids)
-            logger.info(f"Stored {len(chunks)} text chunks in ChromaDB")
+            duplicates = {}
+            stored = chroma_service.add_document_chunks(chunks, metadatas, ids, duplicates=duplicates)
+            logger.info(f"Stored {stored} text chunks in ChromaDB, linked {len(chunks) - stored} duplicates")
             
             # Step 9: Update document status
             document.status = 'completed'
             document.page_count = page_count
             document.chunk_count = len(chunks)
+            document.duplicate_chunk_count = duplicates.get(str(document.id), 0)
             document.save()
             logger.info(f"Document {document.id} completed")
 
+            # Step 10: Pre-warm the cache with likely questions while the LLM is idle
+            schedule_prewarm(document.id)
+
             return Response(
                 {
                     'message': 'Document uploaded and processed successfully',
@@ -96,11 +192,18 @@ class DocumentViewSet(viewsets.ModelViewSet):
                     'processing': {
                         'pages': page_count,
                         'chunks': len(chunks),
-                        'characters': len(full_text)
+                        'duplicate_chunks': document.duplicate_chunk_count,
+                        'characters': file_stats['characters']
                     }
                 },
                 status=status.HTTP_200_OK
             )
+        except DocumentTooLargeError as e:
+            # rejected documents are removed so the same file can be retried later
+            logger.info(f"Document {document.id} rejected: {str(e)}")
+            document.file.delete(save=False)
+            document.delete()
+            return Response({'file': [str(e)]}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
         except Exception as e:
             logger.error(f"Error processing document: {str(e)}")
             document.status = 'failed'
@@ -114,10 +217,69 @@ class DocumentViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
     
-class ChatViewSet(viewsets.ModelViewSet):
+def normalize_query(query: str) -> str:
+    """ Case and whitespace insensitive form of a query, used to coalesce duplicates """
+    return " ".join(query.lower().split())
+
+def chunk_sources(*metadata_lists) -> dict:
+    """
+    Name and file of every document the chunks came from, in one query
+
+    Chunk metadata only stores the document id, so names and paths are
+    resolved here rather than repeated in every chunk of the vector store.
+
+    Args:
+        *metadata_lists: Lists of chunk metadata
+
+    Returns:
+        Dict of document id -> {'document_name', 'source'}
+    """
+    document_ids = {
+        metadata['document_id']
+        for metadatas in metadata_lists for metadata in metadatas or []
+        if metadata and metadata.get('document_id')
+    }
+    if not document_ids:
+        return {}
+    return {
+        str(document_id): {'document_name': name, 'source': file}
+        for document_id, name, file in Document.objects.filter(id__in=document_ids).values_list('id', 'name', 'file')
+    }
+
+def with_sources(metadatas, sources=None) -> list:
+    """ Chunk metadata for a response, with document name and file from chunk_sources """
+    if sources is None:
+        sources = chunk_sources(metadatas)
+    return [{**metadata, **sources.get(metadata.get('document_id'), {})} for metadata in metadatas or []]
+
+# in-flight generations shared by identical concurrent queries
+_query_flights = SingleFlight()
+
+class ChatViewSet(ConditionalListMixin, viewsets.ModelViewSet):
     """ ViewSet for chat history """
     queryset = Chat.objects.all()
     serializer_class = ChatSerializer
+    pagination_class = CreatedAtCursorPagination
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == 'list':
+            # only document ids are listed, avoid one query per chat
+            return queryset.prefetch_related(Prefetch('documents', queryset=Document.objects.only('id')))
+        return queryset.prefetch_related('documents')
+
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return ChatListSerializer
+        return super().get_serializer_class()
+
+    def get_object(self):
+        try:
+            return super().get_object()
+        except Http404:
+            # query returns the chat_id before the background writer saved the chat
+            get_chat_writer().flush()
+            return super().get_object()
 
     @action(detail=False, methods=['post'])
     def query(self, request):
@@ -126,15 +288,19 @@ class ChatViewSet(viewsets.ModelViewSet):
         POST /ragengine/chats/query/
         
         Flow:
-        1. Validate question
+        1. Validate question, rewrite follow-ups of a conversation into a standalone question
         2. Check for exact match in SQLite
-        3. Check for similar question in ChromaDB
-        4. If not cached, search documents
+        3. Check for similar question in ChromaDB, while searching documents
+        4. If not cached, use the retrieved chunks
         5. Generate answer with LLM
-        6. Save to SQLite and ChromaDB
+        6. Queue save to SQLite and ChromaDB (background chat writer)
         7. Return answer
+
+        The returned chat_id is written shortly after the response, reading
+        it through /chats/<id>/ waits for the chat writer. With "stream": true
+        the answer is sent as one NDJSON line after blank keep-alive lines,
+        closing the connection aborts the generation.
         """
-        logger.info(f"Query: {request.data}")
         # Step 1: Validate query
         serializer = QuerySerializer(data=request.data)
         if not serializer.is_valid():
@@ -143,110 +309,447 @@ class ChatViewSet(viewsets.ModelViewSet):
         
         query = serializer.validated_data.get('query') or serializer.validated_data.get('question')
         document_id = serializer.validated_data.get('document_id')
-        model = serializer.validated_data.get('model')
+        model = serializer.validated_data.get('model') or 'llama3.2'
+        temperature = serializer.validated_data.get('temperature', 0.7)
+        retrieval = retrieval_options(serializer.validated_data)
+        logger.info(
+            f"Query: {len(query)} characters, model {model}",
+            extra={"event": "query", "query_chars": len(query), "model": model,
+                   "document_id": document_id, "conversation_id": serializer.validated_data.get('conversation_id')}
+        )
+        if sample_payload():
+            logger.info(f"Query: {request.data}", extra={"event": "query_payload"})
+
+        # follow-ups are rewritten into standalone questions, which retrieval and the caches work on
+        conversation = None
+        history = ""
+        conversation_id = serializer.validated_data.get('conversation_id')
+        if conversation_id:
+            conversation = Conversation.objects.filter(id=conversation_id).first()
+            if conversation is None:
+                return Response({'message': 'Conversation not found'}, status=status.HTTP_404_NOT_FOUND)
+            history = format_history(*get_history(conversation, model))
+            if history:
+                try:
+                    with get_admission_controller().admit(model):
+                        query = get_llm_service().rewrite_query(query, history, model_name=model)
+                except AdmissionRejected as e:
+                    return self._rejected_response(e)
+                logger.info(f"Follow-up rewritten to a standalone query of {len(query)} characters")
         
         # Step 2: Check for exact match in SQLite
-        exact_match = Chat.objects.filter(question__iexact=query).first()
+        exact_match = Chat.objects.filter(question__iexact=query, invalidated_at__isnull=True).first()
         if exact_match:
-            logger.info(f"Exact match found for query: {query}")
-            return Response({
-                'answer': exact_match.answer,
-                'source': 'cache match',
-                'chat_id': exact_match.id,
-                'source_chunks': exact_match.source_chunks_metadata,
-            }, status=status.HTTP_200_OK)
+            logger.info(f"Exact match found: chat {exact_match.id}")
+            # counted on the cached question like a similar match, for eviction and the pre-warm hit rate
+            try:
+                get_chroma_service().record_cache_hit(str(exact_match.id))
+            except Exception as e:
+                logger.error(f"Recording exact match cache hit failed: {str(e)}")
+            return self._cached_response(exact_match, query, conversation, 'cache match')
         
+        flight_key = (
+            normalize_query(query),
+            str(document_id) if document_id else None,
+            model,
+            temperature,
+            tuple(sorted(retrieval.items())),
+            # turns of different conversations are answered and recorded separately
+            str(conversation.id) if conversation else None
+        )
+
         # Step 3: Check for similar question in ChromaDB
+        # the query is embedded once and the documents are searched at the same time,
+        # a cache hit drops the retrieval. A query joining a generation in flight
+        # uses the leader's chunks, so it only probes the cache
         chroma_service = get_chroma_service()
-        similar_questions = chroma_service.find_similar_question(query)
+        similar_questions, retrieval_future = chroma_service.probe_cache_and_search(
+            query,
+            document_id=str(document_id) if document_id else None,
+            retrieve=not _query_flights.running(flight_key),
+            **retrieval
+        )
         if similar_questions:
             chat_id, distance = similar_questions
             logger.info(f"Similar question found (distance: {distance:.4f})")
             try:
-                cached_chat = Chat.objects.get(id=chat_id)
-                logger.info(f"Cached chat found for query: {query}")
-                return Response({
-                    'answer': cached_chat.answer,
-                    'source': 'cache similar',
-                    'chat_id': cached_chat.id,
-                    'source_chunks': cached_chat.source_chunks_metadata,
-                    'similarity_score': 1- distance # convert distance to similarity score
-                }, status=status.HTTP_200_OK)
+                cached_chat = Chat.objects.get(id=chat_id, invalidated_at__isnull=True)
+                logger.info(f"Cached chat found: {chat_id}")
+                if retrieval_future is not None:
+                    retrieval_future.cancel()
+                # convert distance to similarity score
+                return self._cached_response(cached_chat, query, conversation, 'cache similar', 1 - distance)
             except Chat.DoesNotExist:
-                logger.info(f"Cached chat not found for query: {query}")
+                logger.info(f"Cached chat not found: {chat_id}")
             
-        # Step 4: No cache hit - search documents
-        logger.info("No cache hit - searching documents")
-        
+        # Step 4: No cache hit - use the retrieved chunks and generate the answer
+        # identical queries already in flight are coalesced onto one generation,
+        # which only takes a generation slot once the chunks are retrieved
+        logger.info("No cache hit - using retrieved documents")
+        cancel_event = threading.Event()
+
+        def generate():
+            # a follower that ends up leading (the flight finished meanwhile) retrieves here
+            recorded = {}
+            payload, status_code = self._generate_answer(
+                query, document_id, model, temperature, retrieval, history, conversation,
+                search_results=retrieval_future.result() if retrieval_future is not None else None,
+                cancel_event=cancel_event, recorded=recorded
+            )
+            return payload, status_code, recorded
+
+        # Step 8: Return answer
+        if serializer.validated_data['stream']:
+            return self._streamed_flight(flight_key, generate, cancel_event, query, conversation)
+        payload, status_code, headers = self._run_flight(flight_key, generate, query, conversation)
+        return Response(payload, status=status_code, headers=headers)
+
+    def _run_flight(self, flight_key, generate, query, conversation):
+        """
+        Answer of the generation in flight for the key, started here unless one is running
+
+        Returns:
+            Tuple of (response payload, status code, headers)
+        """
+        try:
+            (payload, status_code, recorded), shared = _query_flights.do(flight_key, generate)
+        except AdmissionRejected as e:
+            return self._rejection(e)
+        except Exception as e:
+            logger.error(f"Error processing query: {str(e)}")
+            return {'message': 'Failed to process query. Please try again.'}, status.HTTP_500_INTERNAL_SERVER_ERROR, None
+        if shared and status_code == status.HTTP_201_CREATED:
+            # followers reuse the leader's answer, counted as a cache hit with a chat of their own
+            logger.info(f"Coalesced query onto in-flight generation of chat {payload['chat_id']}")
+            payload = {**payload, 'source': 'cache coalesced'}
+            payload.update(self._record_follower(recorded, query, conversation))
+            status_code = status.HTTP_200_OK
+        return payload, status_code, None
+
+    def _record_follower(self, recorded, query, conversation) -> dict:
+        """
+        Queue the chat of a query coalesced onto another one's generation
+
+        The question is not cached again, the hit is counted on the leader's
+        cached question so LRU/LFU eviction sees it.
+
+        Returns:
+            Payload fields of the follower's chat
+        """
+        leader = recorded['chat']
+        chat = Chat(
+            question=query,
+            answer=leader.answer,
+            model=leader.model,
+            source_chunks_metadata=leader.source_chunks_metadata,
+            conversation=conversation
+        )
+        get_chat_writer().submit(chat, recorded['document_ids'], cache_question=False)
         try:
+            get_chroma_service().record_cache_hit(str(leader.id))
+        except Exception as e:
+            logger.error(f"Recording coalesced cache hit failed: {str(e)}")
+        return {'chat_id': chat.id}
+
+    def _streamed_flight(self, flight_key, generate, cancel_event, query, conversation):
+        """
+        Answer of the flight as NDJSON, preceded by a blank line every QUERY_STREAM_KEEPALIVE seconds
+
+        The answer is generated in a separate thread. A client that goes away
+        fails the next blank line, which closes the stream and aborts the
+        generation unless other requests joined it.
+        """
+        results = queue.Queue()
+
+        def run():
+            try:
+                results.put(self._run_flight(flight_key, generate, query, conversation))
+            finally:
+                connection.close()
+
+        threading.Thread(target=run, name='query-stream', daemon=True).start()
+        keepalive = getattr(settings, 'QUERY_STREAM_KEEPALIVE', 1.0)
+
+        def stream():
+            answered = False
+            try:
+                while True:
+                    try:
+                        payload, status_code, _ = results.get(timeout=keepalive)
+                    except queue.Empty:
+                        yield "\n"
+                        continue
+                    answered = True
+                    yield json.dumps({'status': status_code, **payload}, cls=JSONEncoder) + "\n"
+                    return
+            finally:
+                if not answered and not _query_flights.followers(flight_key):
+                    logger.info("Client closed the query stream, aborting the generation")
+                    cancel_event.set()
+        return StreamingHttpResponse(stream(), content_type='application/x-ndjson')
+
+    def _rejection(self, error):
+        """ Payload, 429/503 status and Retry-After header for a generation refused by admission control """
+        logger.info(f"Query rejected by admission control: {str(error)}")
+        return (
+            {'message': str(error), 'retry_after': error.retry_after},
+            error.status_code,
+            {'Retry-After': str(error.retry_after)}
+        )
+
+    def _rejected_response(self, error):
+        """ 429/503 with Retry-After for a generation refused by admission control """
+        payload, status_code, headers = self._rejection(error)
+        return Response(payload, status=status_code, headers=headers)
+
+    def _cached_response(self, cached_chat, query, conversation, source, similarity_score=None):
+        """
+        Answer from a cached chat, recording it as a turn when asked within a conversation
+        """
+        payload = {
+            'answer': cached_chat.answer,
+            'source': source,
+            'chat_id': cached_chat.id,
+            'source_chunks': with_sources(cached_chat.source_chunks_metadata),
+        }
+        if similarity_score is not None:
+            payload['similarity_score'] = similarity_score
+        if conversation is not None:
+            turn = Chat(
+                question=query,
+                answer=cached_chat.answer,
+                model=cached_chat.model,
+                source_chunks_metadata=cached_chat.source_chunks_metadata,
+                similarity_score=similarity_score,
+                conversation=conversation
+            )
+            # the question is cached already, only the turn and its document links are saved
+            document_ids = [document.id for document in cached_chat.documents.all()]
+            get_chat_writer().submit(turn, document_ids, cache_question=False)
+            schedule_summary_update(conversation.id, cached_chat.model or 'llama3.2')
+            payload.update(chat_id=turn.id, conversation_id=conversation.id)
+        return Response(payload, status=status.HTTP_200_OK)
+
+    def _generate_answer(
+        self, query, document_id, model, temperature=0.7, retrieval=None, history="",
+        conversation=None, search_results=None, cancel_event=None, recorded=None
+    ):
+        """
+        Retrieve context (unless already retrieved), generate an answer and queue the chat for saving
+
+        Returns:
+            Tuple of (response payload, status code)
+        """
+        if search_results is None:
             # Search ChromaDB for relevant chunks
-            search_results = chroma_service.search_document_chunks(
+            search_results = get_chroma_service().search_document_chunks(
                 query,
-                k=3,
-                document_id=document_id if document_id else None
+                document_id=str(document_id) if document_id else None,
+                **(retrieval or {})
             )
-            if not search_results['documents'][0]:
-                return Response(
-                    {'message': 'No relevant documents found. Please upload documents first.'},
-                    status=status.HTTP_404_NOT_FOUND
-                )
-            # build context from retrieved chunks
-            chunks = search_results['documents'][0]
-            metadatas = search_results['metadatas'][0]
-            ids = search_results['ids'][0]
-            context = "\n\n---\n\n".join(chunks)
-            logger.info(f"Retrieved {len(chunks)} chunks from ChromaDB")
-
-            # Step 5: Generate answer with LLM
-            llm_service = get_llm_service()
-            answer = llm_service.generate_answer(
-                query,
-                context,
-                model_name=model if model else 'llama3.2'          
+        return self._answer_from_chunks(
+            query,
+            document_id,
+            model,
+            search_results['documents'][0],
+            search_results['metadatas'][0],
+            temperature,
+            cancel_event,
+            history=history,
+            conversation=conversation,
+            recorded=recorded
+        )
+
+    def _answer_from_chunks(
+        self, query, document_id, model, chunks, metadatas, temperature=0.7,
+        cancel_event=None, history="", conversation=None, sources=None, persist=True, batch=False,
+        recorded=None
+    ):
+        """
+        Generate an answer from retrieved chunks and queue the chat for saving
+
+        The generation holds one of the model's generation slots (admission
+        control), an answer in the LLM response cache is returned without
+        waiting for one. A batch generation waits for a slot behind
+        interactive ones instead of being rejected. It is aborted after
+        GENERATION_DEADLINE seconds or once cancel_event is set. sources are
+        the documents of the chunks from chunk_sources, looked up here when
+        not given. With persist False the answer is only returned, no chat is
+        saved and nothing is cached (batch runs such as evaluations). recorded
+        is filled with the queued chat and its document ids.
+
+        Returns:
+            Tuple of (response payload, status code)
+
+        Raises:
+            AdmissionRejected: no generation slot became free (interactive generations only)
+        """
+        if not chunks:
+            return (
+                {'message': 'No relevant documents found. Please upload documents first.'},
+                status.HTTP_404_NOT_FOUND
             )
-            if not answer:
-                return Response(
-                    {'message': 'Failed to generate answer. Please try again.'},
-                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                )
-            
-            logger.info(f"Generated answer ({len(answer)} characters)")
+        # build context from retrieved chunks
+        context = "\n\n---\n\n".join(chunks)
+        logger.info(f"Retrieved {len(chunks)} chunks from ChromaDB")
 
-            # Step 6: Save to SQLite
-            chat = Chat.objects.create(
-                question=query,
-                answer=answer,
-                model=model if model else 'llama3.2',
-                source_chunks_metadata=metadatas,
-                similarity_score=None # new question so no similarity score
+        # Step 5: Generate answer with LLM
+        # a failed generation is reported to the client and never saved or cached
+        llm_service = get_llm_service()
+        metrics = {}
+        try:
+            answer = llm_service.cached_answer(query, context, temperature, model, history)
+            if answer is None:
+                with get_admission_controller().admit(model, batch=batch):
+                    answer = llm_service.generate_answer(
+                        query,
+                        context,
+                        temperature=temperature,
+                        model_name=model,
+                        deadline=getattr(settings, 'GENERATION_DEADLINE', None),
+                        cancel_event=cancel_event,
+                        history=history,
+                        metrics=metrics
+                    )
+        except GenerationError as e:
+            return {'message': f'{str(e)}. Please try again.'}, e.status_code
+        if not answer:
+            return (
+                {'message': 'Failed to generate answer. Please try again.'},
+                status.HTTP_500_INTERNAL_SERVER_ERROR
             )
-            # Associate with documents if specific document was queried
-            if document_id:
-                try:
-                    from .models import Document
-                    doc = Document.objects.get(id=document_id)
-                    chat.documents.add(doc)
-                except Document.DoesNotExist:
-                    pass
-            # Step 7: Cache question in ChromaDB
-            chroma_service = get_chroma_service()
-            chroma_service.add_cached_question(query, str(chat.id), answer)
-            logger.info("Cached question in ChromaDB")
-            
-            # Step 8: Return answer
-            return Response({
+        
+        logger.info(f"Generated answer ({len(answer)} characters)")
+
+        if not persist:
+            return {
                 'answer': answer,
                 'source': 'generated',
-                'chat_id': chat.id,
-                'source_chunks': metadatas,
+                'source_chunks': with_sources(metadatas, sources),
                 'chunks_used': len(chunks)
-            }, status=status.HTTP_201_CREATED)
-        except Exception as e:
-            logger.error(f"Error processing query: {str(e)}")
-            return Response(
-                {'message': 'Failed to process query. Please try again.'},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
+            }, status.HTTP_200_OK
+
+        # Step 6 & 7: Save to SQLite and cache question in ChromaDB
+        # written in batches by the background chat writer, off the response path
+        chat = Chat(
+            question=query,
+            answer=answer,
+            model=model,
+            source_chunks_metadata=metadatas,
+            similarity_score=None, # new question so no similarity score
+            conversation=conversation,
+            **metrics
+        )
+        # Associate with the queried document and every document the context came from,
+        # so cached answers can be invalidated when one of them changes
+        document_ids = {str(document_id)} if document_id else set()
+        document_ids.update(metadata['document_id'] for metadata in metadatas if metadata.get('document_id'))
+        get_chat_writer().submit(chat, sorted(document_ids))
+        logger.info(f"Queued chat {chat.id} for saving and caching")
+        if recorded is not None:
+            recorded.update(chat=chat, document_ids=sorted(document_ids))
+
+        payload = {
+            'answer': answer,
+            'source': 'generated',
+            'chat_id': chat.id,
+            'source_chunks': with_sources(metadatas, sources),
+            'chunks_used': len(chunks)
+        }
+        if conversation is not None:
+            # turns leaving the history window are folded into the summary in the background
+            schedule_summary_update(conversation.id, model)
+            payload['conversation_id'] = conversation.id
+        return payload, status.HTTP_201_CREATED
+
+    @action(detail=False, methods=['post'])
+    def batch_query(self, request):
+        """
+        Answer many questions in one call, e.g. an evaluation run
+        POST /ragengine/chats/batch_query/
+        
+        Flow:
+        1. Validate questions
+        2. Search documents for all questions at once (one embedding batch)
+        3. Generate answers concurrently, bounded by the backend's concurrency and the model's generation slots
+        4. Return results in input order, as JSON or streamed as NDJSON
+
+        Batch answers are not saved as chats and not added to the semantic cache.
+        """
+        # Step 1: Validate questions
+        serializer = BatchQuerySerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        queries = serializer.validated_data['queries']
+        document_id = serializer.validated_data.get('document_id')
+        model = serializer.validated_data.get('model') or 'llama3.2'
+        temperature = serializer.validated_data.get('temperature', 0.7)
+        retrieval = retrieval_options(serializer.validated_data)
+        logger.info(f"Batch query: {len(queries)} questions, model {model}")
+
+        # Step 2: Search documents for all questions at once
+        search_results = get_chroma_service().search_document_chunks_batch(
+            queries,
+            document_id=str(document_id) if document_id else None,
+            **retrieval
+        )
+
+        # documents of all retrieved chunks are resolved once for the whole batch
+        sources = chunk_sources(*search_results['metadatas'])
+
+        # Step 3: Generate answers, at most as many at once as the backend serves
+        # batch generations share the model's slots with interactive queries but are never rejected,
+        # admission keeps a slot free for interactive queries and lets them go first
+        cancel_event = threading.Event()
+
+        def answer(index):
+            try:
+                payload, status_code = self._answer_from_chunks(
+                    queries[index],
+                    document_id,
+                    model,
+                    search_results['documents'][index],
+                    search_results['metadatas'][index],
+                    temperature,
+                    cancel_event,
+                    sources=sources,
+                    persist=False,
+                    batch=True
+                )
+            except Exception as e:
+                logger.error(f"Error processing batch query {index}: {str(e)}")
+                payload, status_code = {'message': 'Failed to process query.'}, status.HTTP_500_INTERNAL_SERVER_ERROR
+            return {'index': index, 'query': queries[index], 'status': status_code, **payload}
+
+        executor = ThreadPoolExecutor(
+            max_workers=min(
+                get_llm_service().get_backend_concurrency(model),
+                max(1, get_admission_controller().limit(model) - 1)
+            ),
+            thread_name_prefix='batch-query'
+        )
+        # map yields in input order, whatever order the generations finish in
+        results = executor.map(answer, range(len(queries)))
+
+        # Step 4: Return results
+        if serializer.validated_data['stream']:
+            def stream():
+                try:
+                    for result in results:
+                        yield json.dumps(result, cls=JSONEncoder) + "\n"
+                finally:
+                    # a client that goes away stops the remaining generations and aborts the running ones
+                    cancel_event.set()
+                    executor.shutdown(wait=False, cancel_futures=True)
+            return StreamingHttpResponse(stream(), content_type='application/x-ndjson')
+
+        try:
+            results = list(results)
+        finally:
+            cancel_event.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+        return Response({'count': len(results), 'results': results}, status=status.HTTP_200_OK)
+
     @action(detail=False, methods=['post'])
     def testinput(self, request):
         """
@@ -265,4 +768,177 @@ class ChatViewSet(viewsets.ModelViewSet):
             'answer': 'Test input successful',
             'request': request.data
         }, status=status.HTTP_200_OK)
-            
\ No newline at end of file
+
+
+class ConversationViewSet(ConditionalListMixin, viewsets.ModelViewSet):
+    """ ViewSet for conversations, turns are asked through /chats/query/ with conversation_id """
+    queryset = Conversation.objects.all()
+    serializer_class = ConversationSerializer
+    pagination_class = CreatedAtCursorPagination
+
+    @action(detail=True, methods=['get'])
+    def chats(self, request, pk=None):
+        """
+        Turns of a conversation, oldest first
+        GET /ragengine/conversations/{id}/chats/
+        """
+        conversation = self.get_object()
+        get_chat_writer().flush(conversation_id=conversation.id)
+        turns = conversation.chats.order_by('created_at').prefetch_related(
+            Prefetch('documents', queryset=Document.objects.only('id'))
+        )
+        return Response(ChatListSerializer(turns, many=True).data, status=status.HTTP_200_OK)
+
+
+class StatsViewSet(viewsets.ViewSet):
+    """ ViewSet for vector store, cache and generation statistics """
+
+    def list(self, request):
+        """
+        Collection, cache, admission and generation statistics
+        GET /ragengine/stats/?hours=24
+        """
+        try:
+            hours = float(request.query_params.get('hours', getattr(settings, 'STATS_WINDOW_HOURS', 24)))
+        except ValueError:
+            return Response({'message': 'hours must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+        if not math.isfinite(hours) or hours <= 0:
+            return Response({'message': 'hours must be a positive number'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            since = timezone.now() - timedelta(hours=hours)
+        except OverflowError:
+            return Response({'message': 'hours is too large'}, status=status.HTTP_400_BAD_REQUEST)
+        llm_service = get_llm_service()
+        models = self._generation_stats(since)
+
+        # models served by the same Ollama server add up to its load
+        backends = {}
+        for model, row in models.items():
+            backend = backends.setdefault(llm_service.get_backend_url(model) or 'unknown', {
+                'models': [], 'generations': 0, 'prompt_tokens': 0, 'completion_tokens': 0,
+                'eval_seconds': 0.0, 'cold_loads': 0
+            })
+            backend['models'].append(model)
+            for key in ('generations', 'prompt_tokens', 'completion_tokens', 'eval_seconds', 'cold_loads'):
+                backend[key] += row[key]
+        for backend in backends.values():
+            backend['tokens_per_second'] = self._rate(backend['completion_tokens'], backend['eval_seconds'])
+            backend['eval_seconds'] = round(backend['eval_seconds'], 3)
+
+        return Response({
+            'collections': get_chroma_service().get_collection_stats(),
+            'llm': {
+                'window_hours': hours,
+                'models': models,
+                'backends': backends,
+                'response_cache': llm_service.get_cache_stats(),
+                'admission': get_admission_controller().stats(),
+                'prewarm': prewarm_report(),
+            },
+        }, status=status.HTTP_200_OK)
+
+    def _generation_stats(self, since) -> dict:
+        """ Per model token throughput, prompt size and load times of the chats generated since """
+        cold_load = getattr(settings, 'LLM_COLD_LOAD_SECONDS', 1.0)
+        rows = (
+            Chat.objects.filter(created_at__gte=since, eval_count__isnull=False)
+            .values('model')
+            .annotate(
+                generations=Count('id'),
+                prompt_tokens=Sum('prompt_eval_count'),
+                avg_prompt_tokens=Avg('prompt_eval_count'),
+                max_prompt_tokens=Max('prompt_eval_count'),
+                completion_tokens=Sum('eval_count'),
+                prompt_eval_seconds=Sum('prompt_eval_duration'),
+                eval_seconds=Sum('eval_duration'),
+                avg_load_seconds=Avg('load_duration'),
+                max_load_seconds=Max('load_duration'),
+                cold_loads=Count('id', filter=Q(load_duration__gt=cold_load)),
+            )
+            .order_by('model')
+        )
+        models = {}
+        for row in rows:
+            row['prompt_tokens'] = row['prompt_tokens'] or 0
+            row['completion_tokens'] = row['completion_tokens'] or 0
+            row['eval_seconds'] = row['eval_seconds'] or 0.0
+            row['tokens_per_second'] = self._rate(row['completion_tokens'], row['eval_seconds'])
+            row['prompt_tokens_per_second'] = self._rate(row['prompt_tokens'], row['prompt_eval_seconds'])
+            row['eval_seconds'] = round(row['eval_seconds'], 3)
+            models[row.pop('model')] = row
+        return models
+
+    @staticmethod
+    def _rate(tokens, seconds):
+        return round(tokens / seconds, 2) if seconds else None
+
+
+class ProfileViewSet(viewsets.ViewSet):
+    """ ViewSet for the request profiles stored by ProfilingMiddleware, staff only """
+    permission_classes = [IsAdminUser]
+
+    def list(self, request):
+        """
+        Stored profiles, newest first
+        GET /ragengine/profiles/
+        """
+        return Response(list_profiles(), status=status.HTTP_200_OK)
+
+    def retrieve(self, request, pk=None):
+        """
+        Request details and hottest functions of a profile
+        GET /ragengine/profiles/<id>/?limit=30&sort=self|total
+        """
+        profile = get_profile(pk)
+        if profile is None:
+            return Response({'message': 'Profile not found'}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            # a zero or negative limit would slice from the end of the list
+            limit = max(1, int(request.query_params.get('limit', 30)))
+        except ValueError:
+            return Response({'message': 'limit must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+        sort = request.query_params.get('sort', 'self')
+        if sort not in ('self', 'total'):
+            return Response({'message': 'sort must be self or total'}, status=status.HTTP_400_BAD_REQUEST)
+        functions = hottest_functions(profile, limit, sort)
+        profile.pop('file_path')
+        return Response({**profile, 'functions': functions}, status=status.HTTP_200_OK)
+
+    @action(detail=True, methods=['get'])
+    def download(self, request, pk=None):
+        """
+        The profile file, pstats (cProfile) or speedscope JSON (sampled)
+        GET /ragengine/profiles/<id>/download/
+        """
+        profile = get_profile(pk)
+        if profile is None or not os.path.exists(profile['file_path']):
+            return Response({'message': 'Profile not found'}, status=status.HTTP_404_NOT_FOUND)
+        return FileResponse(open(profile['file_path'], 'rb'), as_attachment=True, filename=profile['file'])
+
+
+class HealthViewSet(viewsets.ViewSet):
+    """ ViewSet for liveness and readiness probes """
+
+    def list(self, request):
+        """
+        Liveness probe
+        GET /ragengine/health/
+        """
+        return Response({'status': 'ok'}, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'])
+    def ready(self, request):
+        """
+        Readiness probe, 200 once the start-up warm-up has finished
+        GET /ragengine/health/ready/
+
+        Starts the warm-up if this process has not run it yet (servers not
+        recognised at start-up) and retries a failed one.
+        """
+        if not is_ready():
+            start_warm_up()
+        warm_up_state = get_warm_up_state()
+        return Response(
+            warm_up_state,
+            status=status.HTTP_200_OK if is_ready() else status.HTTP_503_SERVICE_UNAVAILABLE
+        )
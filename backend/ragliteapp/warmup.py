@@ -0,0 +1,101 @@
+# Start-up warm-up of the service singletons
+import logging
+import os
+import threading
+import time
+from typing import Dict
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_state = {
+    "status": "pending", # pending -> warming -> ready | failed
+    "started_at": None,
+    "finished_at": None,
+    "timings": {},
+    "error": None,
+}
+_lock = threading.Lock()
+
+
+def warm_up() -> None:
+    """
+    Build the service singletons and load their heavy resources
+
+    Opens the ChromaDB client, caches the collection handles, runs one
+    embedding so the model is loaded, and preloads the LLM models listed in
+    WARMUP_LLM_MODELS, so the first request after a deploy or worker fork
+    does not pay for any of it.
+    """
+    from .llm_services import get_llm_service
+    from .vectordb_services import get_chroma_service
+
+    _state.update(status="warming", started_at=time.time(), error=None)
+    timings = _state["timings"]
+    try:
+        start = time.perf_counter()
+        chroma_service = get_chroma_service()
+        timings["chroma_client"] = round(time.perf_counter() - start, 3)
+
+        start = time.perf_counter()
+        chroma_service.warm_up()
+        timings["chroma_collections_and_embedding"] = round(time.perf_counter() - start, 3)
+
+        llm_service = get_llm_service()
+        for model_name in getattr(settings, 'WARMUP_LLM_MODELS', []):
+            start = time.perf_counter()
+            llm_service.preload_model(model_name)
+            timings[f"llm_{model_name}"] = round(time.perf_counter() - start, 3)
+
+        _state["status"] = "ready"
+        logger.info(f"Warm-up finished: {timings}")
+    except Exception as e:
+        _state.update(status="failed", error=str(e))
+        logger.error(f"Warm-up failed: {str(e)}")
+    finally:
+        _state["finished_at"] = time.time()
+
+
+def start_warm_up() -> None:
+    """
+    Run warm_up in a background thread so start-up is not blocked
+
+    Does nothing while a warm-up runs or after one succeeded. A failed warm-up
+    is started again once WARMUP_RETRY_INTERVAL seconds have passed.
+    """
+    with _lock:
+        if _state["status"] in ("warming", "ready"):
+            return
+        if _state["status"] == "failed":
+            retry_interval = getattr(settings, 'WARMUP_RETRY_INTERVAL', 30)
+            if time.time() - (_state["finished_at"] or 0) < retry_interval:
+                return
+            logger.info("Retrying failed warm-up")
+        _state["status"] = "warming"
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+
+def _reset_after_fork():
+    # singletons are dropped in forked workers, which warm up again from their first
+    # readiness check; starting a thread here would run inside os.fork of the parent
+    global _lock
+    _lock = threading.Lock()
+    _state.update(status="pending", started_at=None, finished_at=None, timings={}, error=None)
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def is_ready() -> bool:
+    """ True once warm-up has completed, always True with WARMUP_ON_STARTUP off """
+    if not getattr(settings, 'WARMUP_ON_STARTUP', True):
+        return True
+    return _state["status"] == "ready"
+
+
+def get_warm_up_state() -> Dict:
+    """ Copy of the warm-up state for the readiness endpoint """
+    if not getattr(settings, 'WARMUP_ON_STARTUP', True):
+        return {**_state, "status": "disabled", "timings": {}}
+    return {**_state, "timings": dict(_state["timings"])}
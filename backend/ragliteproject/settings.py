@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/6.0/ref/settings/
 
 from pathlib import Path
 
+from decouple import config
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -47,6 +49,7 @@ MIDDLEWARE = [
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "ragliteapp.profiling.ProfilingMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -74,12 +77,58 @@ WSGI_APPLICATION = "ragliteproject.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/6.0/ref/settings/#databases
 
-DATABASES = {
-    "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+# DB_ENGINE=sqlite (default) suits small deployments, DB_ENGINE=postgres is meant
+# for production where concurrent chat writes would stall on SQLite's single writer lock
+DB_ENGINE = config("DB_ENGINE", default="sqlite")
+
+if DB_ENGINE == "postgres":
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": config("DB_NAME", default="raglite"),
+            "USER": config("DB_USER", default="raglite"),
+            "PASSWORD": config("DB_PASSWORD", default=""),
+            "HOST": config("DB_HOST", default="localhost"),
+            "PORT": config("DB_PORT", default="5432"),
+            "OPTIONS": {
+                # psycopg connection pool, connections stay open and are reused across requests
+                "pool": {
+                    "min_size": config("DB_POOL_MIN_SIZE", default=2, cast=int),
+                    "max_size": config("DB_POOL_MAX_SIZE", default=10, cast=int),
+                    "timeout": config("DB_POOL_TIMEOUT", default=10, cast=int),
+                },
+            },
+        }
+    }
+else:
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": config("DB_NAME", default=str(BASE_DIR / "db.sqlite3")),
+            # keep the connection across requests, pragmas run once per connection
+            "CONN_MAX_AGE": None,
+            "OPTIONS": {
+                # take the write lock at BEGIN instead of failing on upgrade
+                "transaction_mode": "IMMEDIATE",
+                "timeout": 20,
+                # WAL lets readers run alongside the single writer
+                "init_command": (
+                    "PRAGMA journal_mode=WAL;"
+                    "PRAGMA synchronous=NORMAL;"
+                    "PRAGMA temp_store=MEMORY;"
+                    "PRAGMA cache_size=-20000;"
+                    "PRAGMA mmap_size=134217728;"
+                ),
+            },
+        }
     }
-}
+
+# Chats are saved by a background writer in batches (see ragliteapp/chat_writer.py)
+CHAT_WRITE_ASYNC = config("CHAT_WRITE_ASYNC", default=True, cast=bool)
+CHAT_WRITE_BATCH_SIZE = 50
+CHAT_WRITE_FLUSH_INTERVAL = 0.5 # seconds
+CHAT_WRITE_RETRIES = 3 # retries of a failed batch before its chats are saved one by one
+CHAT_WRITE_RETRY_BACKOFF = 0.5 # seconds, doubled on every retry
 
 
 # Password validation
@@ -168,8 +217,93 @@ REST_FRAMEWORK = {
 MEDIA_ROOT = BASE_DIR / "media"
 MEDIA_URL = "/media/"
 
+# Upload limits
+# size is enforced while the request body streams in (see MaxSizeUploadHandler),
+# pages (or sections for non-PDF files) are enforced during extraction, sections longer than
+# ragliteapp.extractors.max_section_size are split and each part counts as a page
+MAX_UPLOAD_SIZE = 15 * 1024 * 1024
+MAX_DOCUMENT_PAGES = 1000
+
+FILE_UPLOAD_HANDLERS = [
+    "ragliteapp.upload_handlers.MaxSizeUploadHandler",
+    "django.core.files.uploadhandler.MemoryFileUploadHandler",
+    "django.core.files.uploadhandler.TemporaryFileUploadHandler",
+]
+
 CHROMA_DB_PATH = BASE_DIR / "chromadb"
 
+# "embedded" opens CHROMA_DB_PATH in-process (single-process dev), "http" connects to a
+# shared Chroma server (`chroma run --path ./chromadb --port 8002`) for multi-worker deployments
+CHROMA_MODE = config("CHROMA_MODE", default="embedded")
+CHROMA_HOST = config("CHROMA_HOST", default="localhost")
+CHROMA_PORT = config("CHROMA_PORT", default=8002, cast=int) # 8000 and 11434 are used by ollama
+
+# Vector index backend: "chroma" (CHROMA_MODE above) or "faiss" (in-process, needs faiss-cpu)
+VECTOR_STORE_BACKEND = config("VECTOR_STORE_BACKEND", default="chroma")
+FAISS_INDEX_PATH = BASE_DIR / "faiss_index"
+FAISS_INDEX = {
+    "TYPE": "hnsw", # "flat" (exact, small corpora) or "hnsw"
+    "M": 32, # HNSW graph degree
+    "EF_CONSTRUCTION": 200,
+    "EF_SEARCH": 64, # higher = better recall, slower queries
+    "QUANTIZATION": None, # None (float32), "int8" (4x smaller) or "pq" (product quantization)
+    "PQ_M": 16, # PQ sub-vectors, must divide the embedding dimension (384)
+    "TRAIN_SIZE": 10000, # vectors collected before a quantized index is trained
+    "MMAP": True, # memory-map the index in workers that only read it
+    "PERSIST_EVERY": 1000, # changed rows before the index file is rewritten (and on shutdown)
+}
+
+# Document chunks are spread over DOCUMENT_SHARDS collections by document id (shard 0 is
+# "documents"), each shard optionally in its own directory (embedded ChromaDB / FAISS).
+# Run `python manage.py rebalance_shards --from-shards <old count>` after changing it
+DOCUMENT_SHARDS = config("DOCUMENT_SHARDS", default=1, cast=int)
+DOCUMENT_SHARD_PATHS = [] # e.g. [BASE_DIR / "chromadb", "/mnt/disk2/chromadb"], shard i uses paths[i % len]
+
+# Duplicate chunks (headers, footers, disclaimers repeated across documents) can be stored
+# once per shard and linked to every document containing them. With ENABLED, uploads only merge
+# chunks whose normalized text (lower-cased words) is identical. `python manage.py dedup_chunks`
+# also merges near-duplicates: chunks whose 64 bit SimHash differs in up to MAX_DISTANCE bits
+# (pairs within 3 bits are always found, further ones only when they share one of the four 16 bit
+# bands), and chunks stored before. Chunks with fewer than MIN_WORDS words are always stored.
+# Deduplicating writers of a host serialize on a lock file, LOCK_PATH overrides its default place
+# next to the local store. The /stats/ figures are recomputed every STATS_CACHE_SECONDS.
+CHUNK_DEDUP = {
+    "ENABLED": config("CHUNK_DEDUP", default=False, cast=bool),
+    "MAX_DISTANCE": 3,
+    "MIN_WORDS": 8,
+    "LOCK_PATH": None,
+    "STATS_CACHE_SECONDS": 60,
+}
+
+# Embedding model of the collections that exist before any re-embedding ("all-MiniLM-L6-v2" is
+# chromadb's built-in model, "ollama/<model>" embeds with Ollama, other names load a
+# sentence-transformers model). Switch models without downtime with
+# `python manage.py reembed_collections --model <name>`, the active model is tracked in EmbeddingVersion
+EMBEDDING_MODEL = config("EMBEDDING_MODEL", default="all-MiniLM-L6-v2")
+EMBEDDING_OLLAMA_URL = "http://localhost:11434"
+EMBEDDING_VERSION_CHECK_INTERVAL = 10 # seconds before a process picks up a new embedding version
+EMBEDDING_BACKFILL = {
+    "BATCH_SIZE": 64, # rows re-embedded per batch
+    "PAUSE": 0.5, # seconds between batches, leaves CPU to the serving processes
+}
+
+# Retrieval defaults, k / max_distance / mmr can be overridden per query
+RETRIEVAL_K = 3
+RETRIEVAL_MAX_DISTANCE = None # squared L2 cutoff, None keeps every candidate
+RETRIEVAL_MMR = True # re-select candidates by maximal marginal relevance
+RETRIEVAL_MMR_LAMBDA = 0.5 # 1.0 = relevance only, 0.0 = diversity only
+RETRIEVAL_FETCH_K_FACTOR = 4 # candidates fetched per requested chunk for MMR / the token budget
+CONTEXT_TOKEN_BUDGET = 1500 # estimated tokens of chunk text put in the prompt
+RETRIEVAL_THREADS = 8 # document searches running next to semantic cache probes
+
+# Semantic query cache (cached_queries collection)
+QUERY_CACHE_MAX_ENTRIES = 10000
+QUERY_CACHE_TTL = 7 * 24 * 3600 # seconds, None keeps entries until evicted
+QUERY_CACHE_EVICTION_POLICY = "lru" # "lru" (least recently hit) or "lfu" (least hit)
+QUERY_CACHE_SWEEP_INTERVAL = 300 # seconds between sweeps of expired entries
+QUERY_CACHE_HIT_FLUSH_INTERVAL = 30 # seconds hits are counted in memory before their LRU/LFU bookkeeping is written
+QUERY_CACHE_EVICTION_SAMPLE = 1000 # entries sampled to find the LRU/LFU eviction cutoff
+
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
@@ -182,6 +316,9 @@ LOGGING = {
             'format': '{levelname} {message}',
             'style': '{',
         },
+        'json': {
+            '()': 'ragliteapp.logging_utils.JSONFormatter',
+        },
     },
     "handlers": {
         "console": {
@@ -191,27 +328,37 @@ LOGGING = {
         "file": {
             "class": "logging.FileHandler",
             "filename": "raglite.log",
-            "formatter": "verbose",
+            "formatter": "json",
+        },
+        # console and file are written by a background thread, off the request path
+        # ("handlers" on a queue handler needs the dictConfig of Python 3.12+)
+        "queue": {
+            "class": "ragliteapp.logging_utils.QueueHandler",
+            "handlers": ["console", "file"],
+            "respect_handler_level": True,
         },
     },
     "loggers": {
         "ragliteapp": {
-            "handlers": ["console", "file"],
+            "handlers": ["queue"],
             "level": "INFO",
             "propagate": False,
         },
         'django': {
-            'handlers': ['console', 'file'],
+            'handlers': ['queue'],
             'level': 'INFO',
             'propagate': False,
         },
         '': {
-            'handlers': ['console', 'file'],
+            'handlers': ['queue'],
             'level': 'INFO',
             'propagate': False,
         },
     },
 }
+# share of requests whose full payloads (questions, answers, search results) are logged,
+# the others only log sizes and timings
+LOG_PAYLOAD_SAMPLE_RATE = config("LOG_PAYLOAD_SAMPLE_RATE", default=0.0, cast=float)
 
 # LLM_URLS = ["http://localhost:11434", "http://localhost:8000"]
 # LLM_MODELS = ["llama3.2", "phi3:mini","nemotron-3-nano","nemotron-mini"]
@@ -232,4 +379,73 @@ LLM_URLS = [
         "url": "http://localhost:8000/api/generate",
         "model": "nemotron-mini"
     }
-]
\ No newline at end of file
+]
+# concurrent generations per Ollama server (match its OLLAMA_NUM_PARALLEL), an entry in
+# LLM_URLS can override it with "max_concurrency"
+LLM_BACKEND_CONCURRENCY = 4
+# Admission control of generations (per process), cache hits are never queued. Beyond
+# GENERATION_MAX_QUEUE waiting requests a model answers 429, after GENERATION_QUEUE_TIMEOUT
+# seconds of waiting 503, both with Retry-After. An LLM_URLS entry can override the limit
+# with "max_generations"
+GENERATION_MAX_CONCURRENT = 2
+GENERATION_MAX_QUEUE = 8
+GENERATION_QUEUE_TIMEOUT = 30 # seconds
+GENERATION_DEADLINE = 300 # seconds a generation may stream before it is aborted
+# streamed queries ("stream": true) send a blank line this often while the answer is generated,
+# a client that went away is noticed on the next one and its generation aborted
+QUERY_STREAM_KEEPALIVE = 1.0 # seconds
+# Django cache where models with live generations are marked busy (None disables it), read by
+# FAQ pre-warming to wait for idle time. The default local memory cache only covers this process,
+# with several worker processes point it at a shared cache (database, Redis or Memcached)
+GENERATION_ACTIVITY_CACHE = "default"
+GENERATION_HEARTBEAT_SECONDS = 1.0
+# Conversations: recent turns put in the prompt as is, older ones folded into a summary
+CONVERSATION_HISTORY_TURNS = 4
+CONVERSATION_HISTORY_TOKENS = 800 # estimated tokens of the recent turns
+CONVERSATION_SUMMARY_WORDS = 150
+# LLM response cache (per process) of answers and follow-up rewrites, used for temperature 0
+# generations, or for every generation with ALWAYS (sampled answers are then reused instead of
+# re-sampled); conversation summaries and pre-warm questions never repeat and are not cached
+LLM_RESPONSE_CACHE = {
+    "MAX_ENTRIES": 1000,
+    "ALWAYS": config("LLM_RESPONSE_CACHE_ALWAYS", default=False, cast=bool),
+}
+# Pre-warming of the semantic cache after an upload: likely questions are generated for a few
+# sections of the document and answered while the model has no live generations in any process
+# sharing GENERATION_ACTIVITY_CACHE; a live request aborts the running pre-warm generation, which
+# is retried once idle again.
+# `python manage.py prewarm_faqs` pre-warms existing documents
+FAQ_PREWARM = {
+    "ENABLED": config("FAQ_PREWARM", default=False, cast=bool),
+    "MODEL": "llama3.2",
+    "SECTIONS": 5, # sections per document questions are generated for
+    "QUESTIONS_PER_SECTION": 3,
+    "MAX_CONCURRENT": 1, # documents pre-warmed at once
+    "IDLE_POLL_SECONDS": 2,
+    "ATTEMPTS": 5, # tries per generation when live traffic keeps interrupting it
+}
+# generation statistics at /ragengine/stats/: default window, and the model load time above
+# which a generation counts as a cold load (model not in memory)
+STATS_WINDOW_HOURS = 24
+LLM_COLD_LOAD_SECONDS = 1.0
+
+# On-demand profiling of single requests: staff users send "X-Profile: 1" (cProfile, pstats)
+# or "X-Profile: sample" (stack sampler, speedscope JSON), or ?profile=1 / ?profile=sample.
+# Profiles are stored under PATH by request id (X-Profile-Id response header) and listed with
+# their hottest functions at /ragengine/profiles/. Disabled, the middleware is not loaded at all
+REQUEST_PROFILING = {
+    "ENABLED": config("REQUEST_PROFILING", default=False, cast=bool),
+    "PATH": BASE_DIR / "profiles",
+    "HEADER": "X-Profile",
+    "QUERY_PARAM": "profile",
+    "SAMPLE_INTERVAL": 0.001, # seconds between stack samples
+    "MAX_PROFILES": 100, # older profiles are deleted
+}
+# questions accepted by one /ragengine/chats/batch_query/ request
+BATCH_QUERY_MAX_QUESTIONS = 5000
+
+# Warm-up of the ChromaDB client, embedding model and LLM models when a server process starts
+# (see ragliteapp/warmup.py), readiness is reported at /ragengine/health/ready/
+WARMUP_ON_STARTUP = config("WARMUP_ON_STARTUP", default=True, cast=bool)
+WARMUP_LLM_MODELS = ["llama3.2"]
+WARMUP_RETRY_INTERVAL = 30 # seconds before a readiness probe starts a failed warm-up again